@@ -0,0 +1,69 @@
+"""Move orders of finished events to the orders_archive collection.
+
+An event is finished once its `starts_at` is older than the retention window.
+Only validated and cancelled orders are moved, pending ones stay in the hot
+collection until they reach a final state. Each batch is copied to the archive
+before it is deleted from `orders`, and copies that already exist are skipped,
+so the job can be interrupted and run again at any time.
+
+    python archive_orders.py --retention-days 30
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+
+from schema import ARCHIVABLE_ORDER_STATUSES, ensure_order_archive
+
+async def archive_event(db, event_id: str, batch_size: int, dry_run: bool) -> int:
+    query = {"event_id": event_id, "status": {"$in": ARCHIVABLE_ORDER_STATUSES}}
+    if dry_run:
+        return await db.orders.count_documents(query)
+
+    archived = 0
+    while True:
+        batch = await db.orders.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return archived
+        try:
+            await db.orders_archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Left over from an interrupted run, the archive already has them
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        await db.orders.delete_many({"_id": {"$in": [order["_id"] for order in batch]}})
+        archived += len(batch)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--retention-days", type=int, default=30, help="days after the event date to keep orders hot")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="count orders without moving them")
+    args = parser.parse_args()
+
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'eventpay_db')
+
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+    await ensure_order_archive(db)
+
+    cutoff = datetime.utcnow() - timedelta(days=args.retention_days)
+    events = await db.events.find({"starts_at": {"$lt": cutoff}}, {"name": 1}).to_list(None)
+    print(f"{len(events)} events finished before {cutoff:%d/%m/%Y}")
+
+    total = 0
+    for event in events:
+        archived = await archive_event(db, str(event["_id"]), args.batch_size, args.dry_run)
+        if archived:
+            print(f"{event['name']}: {archived} orders {'to archive' if args.dry_run else 'archived'}")
+        total += archived
+
+    print(f"Total: {total} orders {'to archive' if args.dry_run else 'archived'}")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
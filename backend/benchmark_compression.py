@@ -0,0 +1,119 @@
+"""Bytes saved versus CPU cost of response compression.
+
+Builds realistic `/api/orders` and `/api/events/{id}/products` payloads with the
+same serializers the API uses and compresses them with every gzip level and
+brotli quality worth considering, so COMPRESSION_GZIP_LEVEL,
+COMPRESSION_BROTLI_QUALITY and COMPRESSION_MIN_SIZE can be tuned with numbers.
+
+    python benchmark_compression.py --orders 200 --products 40 --images 10
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from server import brotli, order_to_response, product_to_response
+
+PRODUCT_NAMES = [
+    "Cerveja Lata 350ml", "Refrigerante 600ml", "Hambúrguer Artesanal",
+    "Porção de Batata Frita", "Água Mineral 500ml", "Caipirinha", "Pizza Brotinho",
+    "Espetinho de Carne", "Pastel de Queijo", "Energético 250ml",
+]
+
+def fake_image(size: int) -> str:
+    # Random bytes compress about as badly as a real JPEG does
+    return base64.b64encode(os.urandom(size)).decode()
+
+def build_products(count: int, images: int, image_size: int) -> bytes:
+    event_id = str(ObjectId())
+    products = []
+    for i in range(count):
+        products.append(product_to_response({
+            "_id": ObjectId(),
+            "event_id": event_id,
+            "name": PRODUCT_NAMES[i % len(PRODUCT_NAMES)],
+            "description": f"{PRODUCT_NAMES[i % len(PRODUCT_NAMES)]} servido no bar principal do evento",
+            "price": round(random.uniform(4, 40), 2),
+            "stock": random.randint(0, 500),
+            "reserved": random.randint(0, 20),
+            "image_base64": fake_image(image_size) if i < images else None,
+            "available": True,
+        }))
+    return json.dumps(products).encode()
+
+def build_orders(count: int) -> bytes:
+    user_id = str(ObjectId())
+    event_id = str(ObjectId())
+    now = datetime.utcnow()
+    orders = []
+    for i in range(count):
+        items = [{
+            "product_id": str(ObjectId()),
+            "product_name": random.choice(PRODUCT_NAMES),
+            "quantity": random.randint(1, 4),
+            "unit_price": round(random.uniform(4, 40), 2),
+        } for _ in range(random.randint(1, 6))]
+        subtotal = sum(item["quantity"] * item["unit_price"] for item in items)
+        orders.append(order_to_response({
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "event_id": event_id,
+            "event_name": "Festival de Música 2025",
+            "items": items,
+            "subtotal": subtotal,
+            "platform_fee": subtotal * 0.10,
+            "credits_used": 0.0,
+            "total": subtotal * 1.10,
+            "organizer_amount": subtotal,
+            "payment_status": "paid",
+            "qr_code": f"ORDER-{uuid.uuid4()}",
+            "status": random.choice(["pending", "validated"]),
+            "created_at": now - timedelta(minutes=i),
+        }))
+    return json.dumps(orders).encode()
+
+def measure(compress, body: bytes, repeat: int):
+    compressed = compress(body)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        compress(body)
+    elapsed = (time.perf_counter() - started) / repeat
+    return len(compressed), elapsed
+
+def run(name: str, body: bytes, repeat: int):
+    print(f"\n{name}: {len(body):,} bytes")
+    print(f"{'codec':<12}{'bytes':>12}{'saved':>9}{'ms/resp':>10}{'MB/s':>9}")
+    codecs = [(f"gzip-{level}", lambda b, level=level: gzip.compress(b, compresslevel=level)) for level in (1, 6, 9)]
+    if brotli is not None:
+        codecs += [(f"br-{quality}", lambda b, quality=quality: brotli.compress(b, quality=quality)) for quality in (1, 4, 6, 11)]
+    for codec, compress in codecs:
+        size, elapsed = measure(compress, body, repeat)
+        saved = 1 - size / len(body)
+        print(f"{codec:<12}{size:>12,}{saved:>8.1%}{elapsed * 1000:>10.2f}{len(body) / elapsed / 1e6:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200, help="orders in the /api/orders payload")
+    parser.add_argument("--products", type=int, default=40, help="products in the menu payload")
+    parser.add_argument("--images", type=int, default=10, help="products with an inline image")
+    parser.add_argument("--image-size", type=int, default=30_000, help="raw bytes per inline image")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    run(f"/api/orders ({args.orders} orders)", build_orders(args.orders), args.repeat)
+    run(f"/api/events/{{id}}/products ({args.products} products, no images)",
+        build_products(args.products, 0, 0), args.repeat)
+    run(f"/api/events/{{id}}/products ({args.products} products, {args.images} images)",
+        build_products(args.products, args.images, args.image_size), args.repeat)
+
+if __name__ == "__main__":
+    main()
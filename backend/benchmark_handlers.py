@@ -0,0 +1,227 @@
+"""In-process benchmarks of the hot API handlers.
+
+Drives the FastAPI app through an ASGI client (no network, no uvicorn) against
+a dedicated benchmark database, seeded with generate_data.py at each dataset
+size. Every case is timed pytest-benchmark style (warm-up rounds, then min,
+median, p95, mean and ops/s). Results can be saved as a JSON baseline and later
+runs compared against it: a case whose median is slower than the baseline by
+more than --threshold is reported as a regression and the run exits with 1.
+
+    python benchmark_handlers.py --sizes 1000,100000 --save benchmark_baseline.json
+    python benchmark_handlers.py --sizes 1000,100000 --compare benchmark_baseline.json
+
+Use --memory to run on the in-memory storage engine (repositories.py) instead
+of a MongoDB server: handler logic only, the numbers are not comparable with a
+real database. The analytics aggregations, which are not part of the storage
+layer, then run on mongomock-motor.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import server
+from generate_data import Generator
+from repositories import memory_storage
+
+BENCH_PASSWORD = "synthetic123"
+
+def stats(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "rounds": len(samples),
+        "min_ms": samples[0] * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[int(len(samples) * 0.95) - 1] * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "ops": 1 / statistics.fmean(samples),
+    }
+
+async def bench(call, rounds: int, warmup: int) -> dict:
+    # Every call must succeed, a handler failing fast would look like a speedup
+    for _ in range(warmup):
+        expect(await call())
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = await call()
+        samples.append(time.perf_counter() - started)
+        expect(response)
+    return stats(samples)
+
+class MemoryCollection:
+    """The insert_many of a collection, as Generator uses it, on the in-memory repositories."""
+
+    def __init__(self, storage, name: str):
+        self.storage = storage
+        self.name = name
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        if self.name == "orders":
+            await self.storage.orders.insert_many(documents)
+        elif self.name == "credit_transactions":
+            self.storage.credits.transactions.update((document["_id"], document) for document in documents)
+        else:
+            repository = getattr(self.storage, self.name)
+            for document in documents:
+                await repository.create(document)
+
+class MemoryDatabase:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return MemoryCollection(self.storage, name)
+
+async def seed(db, size: int, seed_value: int, memory: bool):
+    for collection in ("users", "events", "products", "orders", "credit_transactions", "stock_holds", "outbox"):
+        await db.drop_collection(collection)
+    args = argparse.Namespace(
+        users=max(size // 20, 10), events=10, products=50, orders=size,
+        password=BENCH_PASSWORD, seed=seed_value, batch_size=5_000, concurrency=4
+    )
+    if memory:
+        server.storage = memory_storage()
+        generator = Generator(MemoryDatabase(server.storage), args)
+    else:
+        generator = Generator(db, args)
+    await generator.run()
+    # The first synthetic user is the heaviest buyer, make it an admin for the admin routes
+    user = await server.storage.users.get_by_email("user0@synthetic.eventpay.com")
+    await server.storage.users.set_role(str(user["_id"]), "admin")
+    server.principal_cache.invalidate(str(user["_id"]))
+    return generator
+
+def expect(response: httpx.Response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.method} {response.request.url}: {response.status_code} {response.text[:200]}")
+    return response
+
+async def run_size(client: httpx.AsyncClient, db, size: int, args) -> dict:
+    print(f"\nSeeding {size:,} orders...")
+    generator = await seed(db, size, args.seed, args.memory)
+    if not args.memory:
+        await server.create_indexes()
+
+    login = expect(await client.post("/api/auth/login", json={
+        "email": "user0@synthetic.eventpay.com", "password": BENCH_PASSWORD
+    })).json()
+    headers = {"Authorization": f"Bearer {login['token']}"}
+    event = generator.events[-1]
+    event_id = str(event["_id"])
+    products = generator.products[-1]
+
+    def order_body(items: int) -> dict:
+        return {"event_id": event_id, "items": [{
+            "product_id": str(product["_id"]),
+            "product_name": product["name"],
+            "quantity": 1,
+            "unit_price": product["price"],
+        } for product in products[:items]]}
+
+    cases = {
+        "login": lambda: client.post("/api/auth/login", json={
+            "email": "user0@synthetic.eventpay.com", "password": BENCH_PASSWORD
+        }),
+        "get_current_user": lambda: client.get("/api/auth/me", headers=headers),
+        "get_events": lambda: client.get("/api/events", params={"status": "active"}),
+        "get_event_products": lambda: client.get(f"/api/events/{event_id}/products"),
+        "get_my_orders": lambda: client.get("/api/orders", headers=headers),
+        "get_all_orders": lambda: client.get("/api/admin/orders", headers=headers),
+        "get_reports": lambda: client.get("/api/admin/reports", headers=headers),
+    }
+    for items in (1, 10, 50):
+        cases[f"create_order[{items}]"] = lambda items=items: client.post("/api/orders", json=order_body(items), headers=headers)
+
+    results = {}
+    for name, call in cases.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only.split(",")):
+            continue
+        rounds = args.rounds if name != "login" else max(args.rounds // 5, 3)
+        results[name] = await bench(lambda call=call: call(), rounds, args.warmup)
+        result = results[name]
+        print(f"  {name:<22}{result['median_ms']:>10.2f} ms median{result['p95_ms']:>10.2f} ms p95{result['ops']:>10.0f} ops/s")
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    print(f"\nComparison against baseline ({threshold:.0%} threshold)")
+    for size, cases in results.items():
+        for name, result in cases.items():
+            reference = baseline.get("results", {}).get(size, {}).get(name)
+            if reference is None:
+                continue
+            change = result["median_ms"] / reference["median_ms"] - 1
+            flag = "REGRESSION" if change > threshold else ""
+            print(f"  {size:>9} {name:<22}{reference['median_ms']:>10.2f} -> {result['median_ms']:>8.2f} ms {change:>+7.1%} {flag}")
+            if flag:
+                regressions.append(f"{size}/{name}")
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000", help="comma separated dataset sizes in orders (up to 1000000)")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--only", help="comma separated case name prefixes to run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--memory", action="store_true", help="use the in-memory storage engine instead of MongoDB")
+    parser.add_argument("--save", help="write the results to this JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.20, help="allowed median slowdown before failing")
+    args = parser.parse_args()
+
+    if args.memory:
+        from mongomock_motor import AsyncMongoMockClient
+        client = AsyncMongoMockClient()
+    else:
+        client = AsyncIOMotorClient(os.environ.get('MONGO_URL', 'mongodb://localhost:27017'))
+    db = client[os.environ.get('BENCH_DB_NAME', 'eventpay_bench')]
+    server.db = server.catalog_db = server.reports_db = db
+    server.storage = memory_storage() if args.memory else server.motor_storage(db, db, db)
+
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        for handler in server.app.router.on_startup:
+            # mongomock cannot create the archive collection, indexes do not matter there anyway
+            if not (args.memory and handler is server.create_indexes):
+                await handler()
+        try:
+            for size in (int(size) for size in args.sizes.split(",")):
+                results[str(size)] = await run_size(http, db, size, args)
+        finally:
+            await server.app.router.shutdown()
+
+    report = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": "memory" if args.memory else "mongodb",
+            "rounds": args.rounds,
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as baseline:
+            json.dump(report, baseline, indent=2)
+        print(f"\nBaseline written to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
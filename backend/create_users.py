@@ -2,6 +2,7 @@ import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.context import CryptContext
 import os
+from datetime import datetime
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -23,7 +24,7 @@ async def create_admin():
             "phone": "+55 11 99999-9999",
             "role": "admin",
             "credits": 100.0,
-            "created_at": "2025-01-01T00:00:00"
+            "created_at": datetime(2025, 1, 1)
         }
         await db.users.insert_one(admin_user)
         print("✅ Admin criado com sucesso!")
@@ -42,7 +43,7 @@ async def create_admin():
             "phone": "+55 11 98888-8888",
             "role": "user",
             "credits": 50.0,
-            "created_at": "2025-01-01T00:00:00"
+            "created_at": datetime(2025, 1, 1)
         }
         await db.users.insert_one(regular_user)
         print("✅ Usuário teste criado!")
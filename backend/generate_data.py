@@ -0,0 +1,253 @@
+"""Generate a production-sized synthetic dataset.
+
+Creates the test users from create_users.py plus N synthetic users, M events
+with products, and a realistic order distribution: a few heavy buyers and many
+light ones, popular products, 1 to 6 items per order, some orders paid partly
+with credits and most orders of past events validated. Every synthetic user
+shares one precomputed bcrypt hash, documents are written with concurrent
+unordered insert_many batches, and the whole dataset (ids included) is
+derived from --seed, so two runs with the same arguments are identical.
+
+    python generate_data.py --users 100000 --events 50 --products 30 --orders 2000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from create_users import create_admin, pwd_context
+
+PRODUCTS = [
+    ("Cerveja Lata 350ml", 8.0), ("Refrigerante 600ml", 6.0), ("Hambúrguer Artesanal", 25.0),
+    ("Porção de Batata Frita", 18.0), ("Água Mineral 500ml", 4.0), ("Caipirinha", 15.0),
+    ("Pizza Brotinho", 12.0), ("Espetinho de Carne", 10.0), ("Pastel de Queijo", 9.0),
+    ("Energético 250ml", 14.0), ("Chopp 500ml", 12.0), ("Cachorro-Quente", 11.0),
+]
+CITIES = [
+    ("São Paulo", -23.55, -46.63), ("Rio de Janeiro", -22.91, -43.17), ("Belo Horizonte", -19.92, -43.94),
+    ("Curitiba", -25.43, -49.27), ("Porto Alegre", -30.03, -51.23), ("Salvador", -12.97, -38.50), ("Recife", -8.05, -34.88),
+]
+
+class Generator:
+    def __init__(self, db, args):
+        self.db = db
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.start = datetime(2025, 1, 1)
+        # Fixed "today" so which events are past (and validated) does not depend on the clock
+        self.now = self.start + timedelta(days=300)
+        self.pending = set()
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.written = {}
+
+    def object_id(self) -> ObjectId:
+        return ObjectId(self.rng.getrandbits(96).to_bytes(12, "big"))
+
+    def skewed(self, count: int, skew: float) -> int:
+        # Index in [0, count) where low indexes are picked far more often
+        return min(int(count * self.rng.random() ** skew), count - 1)
+
+    async def insert(self, collection: str, documents: list):
+        async with self.semaphore:
+            await self.db[collection].insert_many(documents, ordered=False)
+        self.written[collection] = self.written.get(collection, 0) + len(documents)
+
+    async def write(self, collection: str, documents: list):
+        # Keep up to --concurrency batches in flight while the next one is generated
+        task = asyncio.create_task(self.insert(collection, documents))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        if len(self.pending) >= self.args.concurrency:
+            await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def flush(self):
+        if self.pending:
+            await asyncio.gather(*self.pending)
+
+    def build_events(self):
+        organizer_id = str(self.object_id())
+        self.events = []
+        self.products = []
+        for i in range(self.args.events):
+            starts_at = self.start + timedelta(days=self.rng.randint(0, 365), hours=self.rng.randint(12, 22))
+            city, latitude, longitude = self.rng.choice(CITIES)
+            event = {
+                "_id": self.object_id(),
+                "name": f"Festival {i + 1}",
+                "description": f"Edição {i + 1} do festival com shows e praça de alimentação",
+                "date": starts_at.strftime("%d/%m/%Y %H:%M"),
+                "starts_at": starts_at,
+                "location": city,
+                "geo": {"type": "Point", "coordinates": [longitude, latitude]},
+                "image_base64": None,
+                "status": "active" if starts_at > self.now else "finished",
+                "organizer_id": organizer_id,
+                "created_at": starts_at - timedelta(days=self.rng.randint(15, 90)),
+            }
+            products = []
+            for j in range(self.args.products):
+                name, price = PRODUCTS[j % len(PRODUCTS)]
+                products.append({
+                    "_id": self.object_id(),
+                    "event_id": str(event["_id"]),
+                    "name": name if j < len(PRODUCTS) else f"{name} {j // len(PRODUCTS) + 1}",
+                    "description": f"{name} servido no bar principal",
+                    "price": price,
+                    "stock": 1_000_000,
+                    "reserved": 0,
+                    "image_base64": None,
+                    "available": True,
+                    "created_at": event["created_at"],
+                })
+            self.events.append(event)
+            self.products.append(products)
+
+    async def write_orders(self):
+        users = self.args.users
+        self.credits_granted = [0.0] * users
+        self.credits_used = [0.0] * users
+        for i in range(users):
+            if self.rng.random() < 0.3:
+                self.credits_granted[i] = float(self.rng.choice([10, 20, 50, 100]))
+
+        batch = []
+        for _ in range(self.args.orders):
+            user = self.skewed(users, 2.5)
+            event_index = self.skewed(len(self.events), 1.5)
+            event = self.events[event_index]
+            products = self.products[event_index]
+
+            items = []
+            for product_index in {self.skewed(len(products), 2.0) for _ in range(self.rng.choice((1, 1, 1, 2, 2, 3, 4, 6)))}:
+                product = products[product_index]
+                items.append({
+                    "product_id": str(product["_id"]),
+                    "product_name": product["name"],
+                    "quantity": self.rng.choice((1, 1, 1, 2, 2, 3)),
+                    "unit_price": product["price"],
+                })
+            subtotal = sum(item["quantity"] * item["unit_price"] for item in items)
+            platform_fee = subtotal * 0.10
+
+            credits_used = 0.0
+            available = self.credits_granted[user] - self.credits_used[user]
+            if available > 0 and self.rng.random() < 0.5:
+                credits_used = min(available, subtotal + platform_fee)
+                self.credits_used[user] += credits_used
+
+            created_at = event["starts_at"] + timedelta(minutes=self.rng.gauss(60, 90))
+            validated = created_at < self.now and self.rng.random() < 0.8
+            batch.append({
+                "_id": self.object_id(),
+                "user_id": str(self.user_ids[user]),
+                "event_id": str(event["_id"]),
+                "event_name": event["name"],
+                "items": items,
+                "subtotal": subtotal,
+                "platform_fee": platform_fee,
+                "credits_used": credits_used,
+                "total": max(subtotal + platform_fee - credits_used, 0),
+                "organizer_amount": subtotal,
+                "payment_status": "paid",
+                "qr_code": f"ORDER-{uuid.UUID(int=self.rng.getrandbits(128), version=4)}",
+                "status": "validated" if validated else "pending",
+                "validated_at": created_at + timedelta(minutes=self.rng.randint(5, 240)) if validated else None,
+                "created_at": created_at,
+            })
+            if len(batch) == self.args.batch_size:
+                await self.write("orders", batch)
+                batch = []
+        if batch:
+            await self.write("orders", batch)
+
+    async def write_users(self, password_hash: str):
+        batch = []
+        transactions = []
+        for i, user_id in enumerate(self.user_ids):
+            created_at = self.start - timedelta(days=self.rng.randint(1, 400))
+            batch.append({
+                "_id": user_id,
+                "email": f"user{i}@synthetic.eventpay.com",
+                "password_hash": password_hash,
+                "name": f"Usuário Sintético {i}",
+                "phone": f"+55 11 9{self.rng.randint(0, 99999999):08d}",
+                "role": "user",
+                "credits": self.credits_granted[i] - self.credits_used[i],
+                "created_at": created_at,
+            })
+            if self.credits_granted[i]:
+                transactions.append({
+                    "_id": self.object_id(),
+                    "user_id": str(user_id),
+                    "amount": self.credits_granted[i],
+                    "type": "conversion",
+                    "created_at": created_at + timedelta(days=1),
+                })
+            if len(batch) == self.args.batch_size:
+                await self.write("users", batch)
+                batch = []
+            if len(transactions) == self.args.batch_size:
+                await self.write("credit_transactions", transactions)
+                transactions = []
+        if batch:
+            await self.write("users", batch)
+        if transactions:
+            await self.write("credit_transactions", transactions)
+
+    async def run(self):
+        started = time.perf_counter()
+        # One bcrypt hash for everyone, hashing per user would dominate the run
+        password_hash = pwd_context.hash(self.args.password)
+        self.user_ids = [self.object_id() for _ in range(self.args.users)]
+
+        self.build_events()
+        await self.write("events", self.events)
+        for products in self.products:
+            await self.write("products", products)
+        await self.write_orders()
+        await self.write_users(password_hash)
+        await self.flush()
+
+        elapsed = time.perf_counter() - started
+        for collection, count in self.written.items():
+            print(f"{collection}: {count:,}")
+        print(f"Done in {elapsed:.1f}s ({self.written.get('orders', 0) / elapsed:,.0f} orders/s)")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--products", type=int, default=20, help="products per event")
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--password", default="synthetic123", help="password shared by all synthetic users")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=5_000)
+    parser.add_argument("--concurrency", type=int, default=4, help="insert_many batches in flight")
+    parser.add_argument("--drop", action="store_true", help="drop users, events, products, orders and credit transactions first")
+    parser.add_argument("--no-test-users", action="store_true", help="skip the admin and test user of create_users.py")
+    args = parser.parse_args()
+
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'eventpay_db')
+
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    if args.drop:
+        for collection in ("users", "events", "products", "orders", "credit_transactions"):
+            await db.drop_collection(collection)
+
+    await Generator(db, args).run()
+    client.close()
+
+    if not args.no_test_users:
+        await create_admin()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,180 @@
+"""Image decoding, resizing and QR rendering, and the process pool they run in.
+
+Kept out of server.py so pool workers only import Pillow, not the API (no Mongo
+client, no logging setup), and so process_images.py can use the pipeline without
+loading the app. The render functions are plain CPU work on bytes.
+"""
+import asyncio
+import base64
+import binascii
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional, uploads are then stored as sent
+    Image = None
+
+try:
+    import qrcode
+except ImportError:  # qrcode is optional, the QR endpoints answer 503 without it
+    qrcode = None
+
+load_dotenv(Path(__file__).parent / '.env')
+
+# Uploaded images are re-encoded on a process pool into a small variant for lists
+# and a large one for detail views, metadata stripped
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'webp')  # webp or jpeg
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 80))
+IMAGE_SMALL_SIZE = int(os.environ.get('IMAGE_SMALL_SIZE', 320))
+IMAGE_LARGE_SIZE = int(os.environ.get('IMAGE_LARGE_SIZE', 1280))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+
+ACCEPTED_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP"}
+OUTPUT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+def output_format(preferred: str) -> str:
+    # Pillow can be built without libwebp
+    if preferred == "webp" and not features.check("webp"):
+        return "jpeg"
+    return preferred
+
+def decode_upload(image_base64: str, max_bytes: int) -> bytes:
+    # The app sends data URIs ("data:image/jpeg;base64,..."), plain base64 is accepted too
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.partition(",")[2]
+    if len(image_base64) * 3 // 4 > max_bytes:
+        raise ValueError("image too large")
+    try:
+        return base64.b64decode(image_base64, validate=True)
+    except binascii.Error:
+        raise ValueError("invalid base64")
+
+def render_variants(image_base64: str, sizes: dict, preferred_format: str, quality: int,
+                    max_bytes: int, max_pixels: int) -> dict:
+    """Data URIs of the upload resized to fit each of `sizes` (name -> longest side)."""
+    data = decode_upload(image_base64, max_bytes)
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        with Image.open(BytesIO(data)) as probe:
+            probe.verify()
+            if probe.format not in ACCEPTED_FORMATS:
+                raise ValueError(f"unsupported format {probe.format}")
+            width, height = probe.size
+        if width * height > max_pixels:
+            raise ValueError("too many pixels")
+        image = Image.open(BytesIO(data))
+        # JPEG can decode straight at a fraction of the size, far cheaper than a full decode
+        image.draft("RGB", (max(sizes.values()),) * 2)
+        # Applies the EXIF orientation, the metadata itself is not written back
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(str(e))
+
+    name = output_format(preferred_format)
+    save_format, mime = OUTPUT_FORMATS[name]
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+    if has_alpha and name == "webp":
+        image = image.convert("RGBA")
+    elif has_alpha:
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.info = {}
+
+    variants = {}
+    for variant, side in sorted(sizes.items(), key=lambda item: -item[1]):
+        resized = image.copy()
+        resized.thumbnail((side, side), Image.LANCZOS)
+        output = BytesIO()
+        resized.save(output, save_format, quality=quality, optimize=True)
+        variants[variant] = f"data:{mime};base64,{base64.b64encode(output.getvalue()).decode()}"
+    return variants
+
+def qr_matrix(code: str) -> list:
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=4)
+    qr.add_data(code)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+def render_qr(code: str, output: str, size: int) -> bytes:
+    """The QR of `code` as an SVG or PNG of `size` pixels, quiet zone included."""
+    matrix = qr_matrix(code)
+    modules = len(matrix)
+    if output == "svg":
+        # One path of unit squares in module coordinates, scaled by the viewBox
+        path = "".join(
+            f"M{x} {y}h1v1h-1z" for y, row in enumerate(matrix) for x, dark in enumerate(row) if dark
+        )
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+            f'viewBox="0 0 {modules} {modules}" shape-rendering="crispEdges">'
+            f'<rect width="100%" height="100%" fill="#fff"/><path d="{path}" fill="#000"/></svg>'
+        ).encode()
+
+    image = Image.new("1", (modules, modules), 1)
+    image.putdata([0 if dark else 1 for row in matrix for dark in row])
+    # Whole pixels per module keep the edges sharp for scanners
+    scale = max(size // modules, 1)
+    image = image.resize((modules * scale, modules * scale), Image.NEAREST)
+    if image.width < size:
+        # The leftover pixels widen the quiet zone
+        canvas = Image.new("1", (size, size), 1)
+        canvas.paste(image, ((size - image.width) // 2,) * 2)
+        image = canvas
+    buffer = BytesIO()
+    image.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def render_qr_batch(tickets: list, output: str, size: int) -> list:
+    return [(name, render_qr(code, output, size)) for name, code in tickets]
+
+def zip_files(files: list) -> bytes:
+    buffer = BytesIO()
+    # PNG is already compressed, SVG text is worth deflating
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files:
+            compression = zipfile.ZIP_STORED if name.endswith(".png") else zipfile.ZIP_DEFLATED
+            archive.writestr(name, content, compress_type=compression)
+    return buffer.getvalue()
+
+# Process pool
+image_pool_executor = None
+
+def image_pool() -> ProcessPoolExecutor:
+    global image_pool_executor
+    if image_pool_executor is None:
+        # spawn: forking a process that runs driver and logging threads is not safe
+        image_pool_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return image_pool_executor
+
+async def prepare_image(image_base64: Optional[str]) -> dict:
+    """Image fields to store for an upload: `image_base64` (large) and `image_small`.
+
+    Raises ValueError for an upload that is not a valid image or is too large.
+    """
+    if not image_base64:
+        return {"image_base64": None, "image_small": None}
+    if Image is None:
+        return {"image_base64": image_base64, "image_small": None}
+    
+    variants = await asyncio.get_running_loop().run_in_executor(
+        image_pool(), render_variants, image_base64,
+        {"small": IMAGE_SMALL_SIZE, "large": IMAGE_LARGE_SIZE},
+        IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_BYTES, IMAGE_MAX_PIXELS
+    )
+    return {"image_base64": variants["large"], "image_small": variants["small"]}
@@ -0,0 +1,118 @@
+"""Rewrite ISO string timestamps as native BSON datetimes.
+
+Converts `created_at` on users, events, products, orders, credit_transactions
+and stock_holds, `validated_at` on orders, and fills `starts_at` on events from
+their free-text `date`. Documents are processed in _id order, in batches, and
+the last _id of every batch is checkpointed in the `migrations` collection, so
+an interrupted run picks up where it stopped.
+
+    python migrate_datetimes.py --batch-size 1000
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from schema import parse_event_date
+
+TIMESTAMP_FIELDS = [
+    ("users", "created_at"),
+    ("events", "created_at"),
+    ("products", "created_at"),
+    ("orders", "created_at"),
+    ("orders", "validated_at"),
+    ("credit_transactions", "created_at"),
+    ("stock_holds", "created_at"),
+]
+
+def parse_timestamp(value: str):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+async def migrate(db, collection: str, source: str, target: str, parse, pending: dict, batch_size: int, dry_run: bool):
+    checkpoint_id = f"datetimes.{collection}.{target}"
+    checkpoint = await db.migrations.find_one({"_id": checkpoint_id}) or {}
+    if checkpoint.get("done"):
+        print(f"{collection}.{target}: already migrated")
+        return
+
+    last_id = checkpoint.get("last_id")
+    migrated = checkpoint.get("migrated", 0)
+    skipped = checkpoint.get("skipped", 0)
+
+    while True:
+        query = dict(pending)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db[collection].find(query, {source: 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        updates = []
+        for document in batch:
+            value = parse(document[source])
+            if value is None:
+                skipped += 1
+                continue
+            # Match on the original value so concurrent writes are never overwritten
+            updates.append(UpdateOne(
+                {"_id": document["_id"], source: document[source]},
+                {"$set": {target: value}}
+            ))
+
+        if updates and not dry_run:
+            result = await db[collection].bulk_write(updates, ordered=False)
+            migrated += result.modified_count
+        elif dry_run:
+            migrated += len(updates)
+
+        last_id = batch[-1]["_id"]
+        if not dry_run:
+            await db.migrations.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_id": last_id, "migrated": migrated, "skipped": skipped}},
+                upsert=True
+            )
+        print(f"{collection}.{target}: {migrated} migrated, {skipped} skipped", end="\r")
+
+    if not dry_run:
+        await db.migrations.update_one({"_id": checkpoint_id}, {"$set": {"done": True}}, upsert=True)
+    print(f"{collection}.{target}: {migrated} migrated, {skipped} skipped")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="count documents without writing")
+    parser.add_argument("--restart", action="store_true", help="discard checkpoints and scan from the start")
+    args = parser.parse_args()
+
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'eventpay_db')
+
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    if args.restart:
+        await db.migrations.delete_many({"_id": {"$regex": "^datetimes\\."}})
+
+    for collection, field in TIMESTAMP_FIELDS:
+        await migrate(
+            db, collection, field, field, parse_timestamp,
+            {field: {"$type": "string"}}, args.batch_size, args.dry_run
+        )
+
+    # Free-text event dates get a native copy, the original text is kept for display
+    await migrate(
+        db, "events", "date", "starts_at", parse_event_date,
+        {"date": {"$type": "string"}, "starts_at": {"$exists": False}}, args.batch_size, args.dry_run
+    )
+
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""Generate the small and large image variants of existing events and products.
+
+Documents saved before the image pipeline keep the original upload in
+`image_base64` and have no `image_small`, so lists still send the full image
+for them. This re-encodes them with the same process pool the API uses, in _id
+order and in batches. Updates match the original image, so a concurrent edit is
+never overwritten, and documents already processed are skipped, so the job can
+be interrupted and run again.
+
+    python process_images.py --batch-size 20
+"""
+import argparse
+import asyncio
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import image_variants
+
+async def process(db, collection: str, batch_size: int, dry_run: bool):
+    query = {"image_base64": {"$nin": [None, ""]}, "image_small": {"$exists": False}}
+    if dry_run:
+        print(f"{collection}: {await db[collection].count_documents(query)} images to process")
+        return
+
+    processed = 0
+    failed = []
+    last_id = None
+    while True:
+        batch_query = dict(query, _id={"$gt": last_id}) if last_id is not None else query
+        batch = await db[collection].find(batch_query, {"image_base64": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        results = await asyncio.gather(
+            *(image_variants.prepare_image(document["image_base64"]) for document in batch),
+            return_exceptions=True
+        )
+        for document, image in zip(batch, results):
+            if isinstance(image, ValueError):
+                failed.append(str(document["_id"]))
+                continue
+            if isinstance(image, Exception):
+                raise image
+            await db[collection].update_one(
+                {"_id": document["_id"], "image_base64": document["image_base64"]},
+                {"$set": image}
+            )
+            processed += 1
+
+        last_id = batch[-1]["_id"]
+        print(f"{collection}: {processed} processed, {len(failed)} invalid", end="\r")
+
+    print(f"{collection}: {processed} processed, {len(failed)} invalid")
+    if failed:
+        print(f"  invalid images left as they are: {', '.join(failed)}")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=20, help="images in flight on the process pool")
+    parser.add_argument("--dry-run", action="store_true", help="count images without processing them")
+    args = parser.parse_args()
+
+    if image_variants.Image is None:
+        raise SystemExit("Pillow is not installed")
+
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'eventpay_db')
+
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+
+    for collection in ("events", "products"):
+        await process(db, collection, args.batch_size, args.dry_run)
+
+    if image_variants.image_pool_executor is not None:
+        image_variants.image_pool_executor.shutdown()
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,230 @@
+"""Reconcile the credit balance of every user against the ledger and the orders.
+
+The expected balance of a user is the sum of their credit transactions
+(purchases excluded, they mirror the orders) minus the credits used by their
+orders, hot and archived, plus debits still waiting in the outbox. Users are
+read in _id chunks; for each chunk the ledger, order and outbox sums come from
+$group aggregations over the chunk's user id range, sorted by user, and are
+merge-joined with the balances, so memory is bounded by --chunk-size whatever
+the number of users. Progress is checkpointed in credit_reconciliations after
+every chunk and --resume continues the last unfinished run. Users whose balance
+drifts more than --tolerance are stored in credit_drift. With --fix their
+balance is set to the expected one, after checking that user again and only if
+the balance did not change since. Users with credit orders still in an order
+ingestion journal (ORDER_INGESTION_MODE=queued) are left alone: those credits
+are debited already but the orders are not in `orders` yet. Only the journals
+under --journal are seen, the ones of this host.
+
+    python reconcile_credits.py --chunk-size 5000
+    python reconcile_credits.py --resume --fix
+"""
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+def ledger_pipeline(match: dict) -> list:
+    return [
+        {"$match": dict(match, type={"$ne": "purchase"})},
+        {"$group": {"_id": "$user_id", "total": {"$sum": "$amount"}}},
+        {"$sort": {"_id": 1}}
+    ]
+
+def orders_pipeline(match: dict) -> list:
+    match = dict(match, credits_used={"$gt": 0})
+    return [
+        {"$match": match},
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": match}]}},
+        {"$group": {"_id": "$user_id", "total": {"$sum": "$credits_used"}}},
+        {"$sort": {"_id": 1}}
+    ]
+
+def outbox_pipeline(match: dict) -> list:
+    # Orders whose debit the dispatcher has not applied yet
+    return [
+        {"$match": dict(match, pending="debit_credits")},
+        {"$group": {"_id": "$user_id", "total": {"$sum": "$credits_used"}}},
+        {"$sort": {"_id": 1}}
+    ]
+
+async def sums(db, match: dict) -> tuple:
+    return await asyncio.gather(
+        db.credit_transactions.aggregate(ledger_pipeline(match), allowDiskUse=True).to_list(None),
+        db.orders.aggregate(orders_pipeline(match), allowDiskUse=True).to_list(None),
+        db.outbox.aggregate(outbox_pipeline(match)).to_list(None),
+    )
+
+def queued_credit_users(journal_path: Path) -> set:
+    """Users with credits spent on orders found in the ingestion journals.
+
+    A journal also keeps orders already inserted until the worker truncates it,
+    those users are skipped too and get fixed by the next run.
+    """
+    users = set()
+    for journal in [journal_path, *journal_path.parent.glob(journal_path.name + ".*")]:
+        try:
+            lines = journal.read_text().splitlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            try:
+                order = json.loads(line)
+            except ValueError:
+                # The line a worker is writing
+                continue
+            if order.get("credits_used", 0) > 0:
+                users.add(order["user_id"])
+    return users
+
+def merge_join(user_ids: list, *streams: list):
+    """(user id, totals) for every user, each stream sorted by user id like `user_ids`.
+
+    Rows of user ids that are not in `user_ids` are counted in the returned
+    `unknown` list (deleted users, bad ids).
+    """
+    positions = [0] * len(streams)
+    joined = []
+    unknown = []
+    for user_id in user_ids:
+        totals = []
+        for i, stream in enumerate(streams):
+            while positions[i] < len(stream) and stream[positions[i]]["_id"] < user_id:
+                unknown.append(stream[positions[i]]["_id"])
+                positions[i] += 1
+            if positions[i] < len(stream) and stream[positions[i]]["_id"] == user_id:
+                totals.append(stream[positions[i]]["total"])
+                positions[i] += 1
+            else:
+                totals.append(0.0)
+        joined.append((user_id, totals))
+    for i, stream in enumerate(streams):
+        unknown += [row["_id"] for row in stream[positions[i]:]]
+    return joined, unknown
+
+def expected_balance(ledger: float, used: float, in_flight: float) -> float:
+    return ledger - used + in_flight
+
+async def recheck(db, user_id) -> tuple:
+    """Balance and expected balance of one user, read again."""
+    user = await db.users.find_one({"_id": user_id}, {"credits": 1})
+    ledger, used, in_flight = await sums(db, {"user_id": str(user_id)})
+    total = lambda rows: rows[0]["total"] if rows else 0.0
+    return user.get("credits", 0.0) if user else None, expected_balance(total(ledger), total(used), total(in_flight))
+
+async def reconcile_chunk(db, run: dict, users: list, last_chunk: bool, args) -> dict:
+    user_ids = [str(user["_id"]) for user in users]
+    # Hex strings sort like the ObjectIds they encode. The ranges of consecutive
+    # chunks touch, so rows of users that no longer exist are seen too
+    user_range = {}
+    if run["last_user_id"] is not None:
+        user_range["$gt"] = str(run["last_user_id"])
+    if not last_chunk:
+        user_range["$lte"] = user_ids[-1]
+    ledger, used, in_flight = await sums(db, {"user_id": user_range} if user_range else {})
+    joined, unknown = merge_join(user_ids, ledger, used, in_flight)
+
+    counts = {"users": len(users), "drifted": 0, "drift_total": 0.0, "fixed": 0, "unknown_users": len(set(unknown))}
+    for user, (user_id, totals) in zip(users, joined):
+        balance = user.get("credits", 0.0)
+        expected = expected_balance(*totals)
+        drift = balance - expected
+        if abs(drift) <= args.tolerance:
+            continue
+
+        fixed = False
+        queued = False
+        if args.fix:
+            balance, expected = await recheck(db, user["_id"])
+            if balance is None or abs(balance - expected) <= args.tolerance:
+                continue
+            # Read after the balance, an order debited before that read is journaled
+            # right after its debit
+            queued = user_id in queued_credit_users(args.journal)
+            if not queued:
+                # A concurrent order or conversion changes the balance and the update does not apply
+                result = await db.users.update_one({"_id": user["_id"], "credits": balance}, {"$set": {"credits": expected}})
+                fixed = result.modified_count == 1
+                counts["fixed"] += fixed
+            drift = balance - expected
+
+        counts["drifted"] += 1
+        counts["drift_total"] += drift
+        await db.credit_drift.replace_one({"_id": {"run": run["_id"], "user_id": user_id}}, {
+            "_id": {"run": run["_id"], "user_id": user_id},
+            "balance": balance,
+            "expected": expected,
+            "drift": drift,
+            "magnitude": abs(drift),
+            "fixed": fixed,
+            "queued_orders": queued,
+            "checked_at": datetime.utcnow()
+        }, upsert=True)
+    return counts
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunk-size", type=int, default=5000, help="users per chunk")
+    parser.add_argument("--tolerance", type=float, default=0.005, help="drift ignored as rounding")
+    parser.add_argument("--fix", action="store_true", help="set drifted balances to the expected value")
+    parser.add_argument("--resume", action="store_true", help="continue the last unfinished run")
+    parser.add_argument("--top", type=int, default=20, help="largest drifts to print")
+    parser.add_argument("--journal", type=Path,
+                        default=Path(os.environ.get('ORDER_OUTBOX_PATH', Path(__file__).parent / 'order_outbox.ndjson')),
+                        help="order ingestion journal (ORDER_OUTBOX_PATH), users with queued orders are not fixed")
+    args = parser.parse_args()
+
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'eventpay_db')
+
+    client = AsyncIOMotorClient(mongo_url)
+    db = client[db_name]
+    # The per chunk $match on user_id needs these
+    await db.credit_transactions.create_index([("user_id", 1), ("type", 1)])
+    await db.outbox.create_index("user_id")
+
+    run = None
+    if args.resume:
+        run = await db.credit_reconciliations.find_one({"finished_at": None}, sort=[("started_at", -1)])
+        if run:
+            print(f"Resuming run {run['_id']} after {run['users']:,} users")
+    if run is None:
+        run = {
+            "started_at": datetime.utcnow(), "finished_at": None, "fix": args.fix, "last_user_id": None,
+            "users": 0, "drifted": 0, "drift_total": 0.0, "fixed": 0, "unknown_users": 0
+        }
+        run["_id"] = (await db.credit_reconciliations.insert_one(run)).inserted_id
+
+    while True:
+        query = {"_id": {"$gt": run["last_user_id"]}} if run["last_user_id"] is not None else {}
+        users = await db.users.find(query, {"credits": 1}).sort("_id", 1).limit(args.chunk_size).to_list(args.chunk_size)
+        if not users:
+            break
+        counts = await reconcile_chunk(db, run, users, len(users) < args.chunk_size, args)
+        for key, value in counts.items():
+            run[key] += value
+        run["last_user_id"] = users[-1]["_id"]
+        checkpoint = {key: run[key] for key in counts}
+        await db.credit_reconciliations.update_one({"_id": run["_id"]}, {"$set": dict(
+            checkpoint, last_user_id=run["last_user_id"], updated_at=datetime.utcnow()
+        )})
+        print(f"{run['users']:,} users checked, {run['drifted']:,} drifted", end="\r")
+
+    await db.credit_reconciliations.update_one({"_id": run["_id"]}, {"$set": {"finished_at": datetime.utcnow()}})
+    print(f"{run['users']:,} users checked, {run['drifted']:,} drifted ({run['drift_total']:+.2f} credits in total)"
+          + (f", {run['fixed']:,} fixed" if args.fix else ""))
+    if run["unknown_users"]:
+        print(f"  {run['unknown_users']:,} user ids in the ledger or orders without a user")
+
+    drifts = await db.credit_drift.find({"_id.run": run["_id"]}).sort("magnitude", -1).limit(args.top).to_list(args.top)
+    for drift in drifts:
+        print(f"  {drift['_id']['user_id']}: balance {drift['balance']:.2f}, expected {drift['expected']:.2f} "
+              f"({drift['drift']:+.2f}){' fixed' if drift['fixed'] else ''}"
+              f"{' not fixed, orders queued' if drift.get('queued_orders') else ''}")
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
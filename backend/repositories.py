@@ -0,0 +1,843 @@
+"""Storage of users, events, products, orders, credits, stock holds and the outbox.
+
+Handlers reach these through `Storage` (the `get_storage` dependency in
+server.py) instead of the Mongo collections, so the same handler code runs on
+MongoDB (`motor_storage`) or fully in memory (`memory_storage`), which the
+handler benchmarks, tests and quick local runs use. The analytics aggregations
+are not part of it and always use Mongo.
+
+The in-memory engine keeps plain dicts keyed by `_id` plus dict indexes for
+every lookup the handlers make (email, event, user, QR code). Documents have
+the same shape as in Mongo, `_id` included, and are copied on the way in and
+out. Nothing awaits between reading and writing a document, so its updates are
+as atomic as their Mongo counterparts on a single event loop.
+"""
+import math
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Order ids remembered per user to apply each order's credit debit once
+DEBIT_MEMORY = 50
+# Mongo's radius for spherical geometry
+EARTH_RADIUS_M = 6378100
+
+def available_stock(product: dict) -> int:
+    return max(product["stock"] - product.get("reserved", 0), 0)
+
+def has_available_stock(quantity: int) -> dict:
+    return {"$expr": {"$gte": [
+        {"$subtract": ["$stock", {"$ifNull": ["$reserved", 0]}]},
+        quantity
+    ]}}
+
+def projection(fields: Optional[Iterable[str]]) -> Optional[dict]:
+    return {field: 1 for field in fields} if fields else None
+
+def ignore_duplicates(error: BulkWriteError):
+    # Documents written by an earlier attempt are fine, anything else is not
+    if any(write_error["code"] != 11000 for write_error in error.details.get("writeErrors", [])):
+        raise error
+
+class Storage:
+    """The repositories the handlers read and write through."""
+
+    def __init__(self, users, events, products, orders, credits, holds, outbox):
+        self.users = users
+        self.events = events
+        self.products = products
+        self.orders = orders
+        self.credits = credits
+        self.holds = holds
+        self.outbox = outbox
+
+# MongoDB
+class MotorUsers:
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return await self.db.users.find_one({"_id": ObjectId(user_id)})
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return await self.db.users.find_one({"email": email})
+
+    async def get_many(self, user_ids: List[str], fields: Optional[List[str]] = None) -> List[dict]:
+        query = {"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}
+        return await self.db.users.find(query, projection(fields)).to_list(None)
+
+    async def get_credits(self, user_id: str) -> float:
+        user = await self.db.users.find_one({"_id": ObjectId(user_id)}, {"credits": 1})
+        return user.get("credits", 0.0) if user else 0.0
+
+    async def create(self, user: dict) -> str:
+        result = await self.db.users.insert_one(user)
+        return str(result.inserted_id)
+
+    async def set_role(self, user_id: str, role: str):
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$set": {"role": role}})
+
+class MotorEvents:
+    def __init__(self, db, catalog_db):
+        self.db = db
+        self.catalog_db = catalog_db
+
+    async def get(self, event_id: str, primary: bool = False) -> Optional[dict]:
+        database = self.db if primary else self.catalog_db
+        return await database.events.find_one({"_id": ObjectId(event_id)})
+
+    async def list(self, status: Optional[str] = None, fields: Optional[List[str]] = None,
+                   limit: Optional[int] = None) -> List[dict]:
+        query = {"status": status} if status else {}
+        return await self.catalog_db.events.find(query, projection(fields)).to_list(limit)
+
+    async def nearby(self, longitude: float, latitude: float, max_distance: float, status: Optional[str],
+                     starts_from: Optional[datetime], starts_to: Optional[datetime],
+                     offset: int, limit: int) -> List[dict]:
+        """Events with coordinates within `max_distance` meters, closest first, with `distance`."""
+        query = {}
+        if status:
+            query["status"] = status
+        if starts_from or starts_to:
+            query["starts_at"] = {}
+            if starts_from:
+                query["starts_at"]["$gte"] = starts_from
+            if starts_to:
+                query["starts_at"]["$lt"] = starts_to
+        # $geoNear uses the 2dsphere index and returns the events closest first
+        return await self.catalog_db.events.aggregate([
+            {"$geoNear": {
+                "near": {"type": "Point", "coordinates": [longitude, latitude]},
+                "key": "geo",
+                "distanceField": "distance",
+                "maxDistance": max_distance,
+                "spherical": True,
+                "query": query
+            }},
+            {"$skip": offset},
+            {"$limit": limit}
+        ]).to_list(None)
+
+    async def create(self, event: dict) -> str:
+        result = await self.db.events.insert_one(event)
+        return str(result.inserted_id)
+
+    async def update(self, event_id: str, fields: dict, unset: Iterable[str] = ()) -> bool:
+        update = {"$set": fields}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        result = await self.db.events.update_one({"_id": ObjectId(event_id)}, update)
+        return result.matched_count > 0
+
+    async def delete(self, event_id: str) -> bool:
+        result = await self.db.events.delete_one({"_id": ObjectId(event_id)})
+        return result.deleted_count > 0
+
+class MotorProducts:
+    def __init__(self, db, catalog_db):
+        self.db = db
+        self.catalog_db = catalog_db
+
+    async def get(self, product_id: str) -> Optional[dict]:
+        return await self.db.products.find_one({"_id": ObjectId(product_id)})
+
+    async def list_by_event(self, event_id: str) -> List[dict]:
+        return await self.catalog_db.products.find({"event_id": event_id}).to_list(1000)
+
+    async def list(self, fields: Optional[List[str]] = None) -> List[dict]:
+        return await self.catalog_db.products.find({}, projection(fields)).to_list(None)
+
+    async def create(self, product: dict) -> str:
+        result = await self.db.products.insert_one(product)
+        return str(result.inserted_id)
+
+    async def update(self, product_id: str, fields: dict) -> Optional[dict]:
+        """Sets `fields` and returns the product as it was before, None if it does not exist."""
+        return await self.db.products.find_one_and_update({"_id": ObjectId(product_id)}, {"$set": fields})
+
+    async def delete(self, product_id: str) -> Optional[dict]:
+        return await self.db.products.find_one_and_delete({"_id": ObjectId(product_id)})
+
+    async def take(self, product_id: str, quantity: int, held: int) -> bool:
+        """Takes `quantity` from the stock, `held` of it from the caller's reservation.
+
+        The rest must be available to everyone, otherwise nothing changes.
+        """
+        query = {"_id": ObjectId(product_id)}
+        if quantity > held:
+            query.update(has_available_stock(quantity - held))
+        result = await self.db.products.update_one(query, {"$inc": {"stock": -quantity, "reserved": -held}})
+        return result.modified_count > 0
+
+    async def restock(self, product_id: str, quantity: int):
+        await self.db.products.update_one({"_id": ObjectId(product_id)}, {"$inc": {"stock": quantity}})
+
+    async def reserve(self, product_id: str, quantity: int) -> bool:
+        query = {"_id": ObjectId(product_id)}
+        query.update(has_available_stock(quantity))
+        result = await self.db.products.update_one(query, {"$inc": {"reserved": quantity}})
+        return result.modified_count > 0
+
+    async def release(self, product_id: str, quantity: int):
+        await self.db.products.update_one({"_id": ObjectId(product_id)}, {"$inc": {"reserved": -quantity}})
+
+class MotorOrders:
+    def __init__(self, db, reports_db):
+        self.db = db
+        self.reports_db = reports_db
+
+    async def insert(self, order: dict):
+        await self.db.orders.insert_one(order)
+
+    async def insert_many(self, orders: List[dict]):
+        """Inserts the orders, skipping those already stored (replays)."""
+        try:
+            await self.db.orders.insert_many(orders, ordered=False)
+        except BulkWriteError as e:
+            ignore_duplicates(e)
+
+    async def get(self, order_id: str, archived: bool = False) -> Optional[dict]:
+        collection = self.db.orders_archive if archived else self.db.orders
+        return await collection.find_one({"_id": ObjectId(order_id)})
+
+    async def get_by_qr_code(self, qr_code: str, archived: bool = False) -> Optional[dict]:
+        collection = self.db.orders_archive if archived else self.db.orders
+        return await collection.find_one({"qr_code": qr_code})
+
+    async def list_by_user(self, user_id: str, archived: bool = False) -> List[dict]:
+        collection = self.db.orders_archive if archived else self.db.orders
+        return await collection.find({"user_id": user_id}).to_list(1000)
+
+    async def lookup(self, order_ids: List[ObjectId], qr_codes: List[str], fields: Optional[List[str]] = None,
+                     archived: bool = False) -> List[dict]:
+        """Orders matching any of the ids or QR codes, in one query."""
+        collection = self.db.orders_archive if archived else self.db.orders
+        query = {"$or": [{"_id": {"$in": order_ids}}, {"qr_code": {"$in": qr_codes}}]}
+        return await collection.find(query, projection(fields)).to_list(None)
+
+    async def existing_ids(self, order_ids: List[ObjectId]) -> set:
+        orders = await self.db.orders.find({"_id": {"$in": order_ids}}, {"_id": 1}).to_list(None)
+        return {order["_id"] for order in orders}
+
+    async def set_validated(self, order_id: ObjectId, validated_at: datetime):
+        await self.db.orders.update_one(
+            {"_id": order_id},
+            {"$set": {"status": "validated", "validated_at": validated_at}}
+        )
+
+    async def list_recent(self, event_id: Optional[str], created_from: Optional[datetime],
+                          created_to: Optional[datetime], limit: int) -> List[dict]:
+        query = {}
+        if event_id:
+            query["event_id"] = event_id
+        if created_from or created_to:
+            query["created_at"] = {}
+            if created_from:
+                query["created_at"]["$gte"] = created_from
+            if created_to:
+                query["created_at"]["$lt"] = created_to
+        return await self.reports_db.orders.find(query).sort("created_at", -1).to_list(limit)
+
+    async def list_paid(self, limit: int) -> List[dict]:
+        return await self.reports_db.orders.find({"payment_status": "paid"}).to_list(limit)
+
+    async def recent_user_ids(self, created_from: datetime, limit: int) -> List[str]:
+        """Ids of the users with orders since `created_from`, most recent buyer first."""
+        users = await self.reports_db.orders.aggregate([
+            {"$match": {"created_at": {"$gte": created_from}}},
+            {"$group": {"_id": "$user_id", "last_order_at": {"$max": "$created_at"}}},
+            {"$sort": {"last_order_at": -1}},
+            {"$limit": limit}
+        ], allowDiskUse=True).to_list(limit)
+        return [user["_id"] for user in users]
+
+    async def list_qr_codes(self, event_id: str, status: Optional[str], limit: int) -> List[dict]:
+        query = {"event_id": event_id}
+        if status:
+            query["status"] = status
+        return await self.reports_db.orders.find(query, {"qr_code": 1}).sort("_id", 1).to_list(limit)
+
+class MotorCredits:
+    def __init__(self, db):
+        self.db = db
+
+    async def add(self, user_id: str, amount: float, kind: str):
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$inc": {"credits": amount}})
+        await self.db.credit_transactions.insert_one({
+            "user_id": user_id,
+            "amount": amount,
+            "type": kind,
+            "created_at": datetime.utcnow()
+        })
+
+    async def spend(self, user_id: str, amount: float) -> bool:
+        """Takes `amount` from the balance, only if the balance covers it."""
+        result = await self.db.users.update_one(
+            {"_id": ObjectId(user_id), "credits": {"$gte": amount}},
+            {"$inc": {"credits": -amount}}
+        )
+        return result.modified_count == 1
+
+    async def refund(self, user_id: str, amount: float):
+        await self.db.users.update_one({"_id": ObjectId(user_id)}, {"$inc": {"credits": amount}})
+
+    async def debit_orders(self, debits: List[dict]):
+        """Debits `credits_used` of each order (`_id`, `user_id`) once, however often it is called."""
+        # The ids of the user's last debits make the $inc apply once per order
+        await self.db.users.bulk_write([
+            UpdateOne(
+                {"_id": ObjectId(debit["user_id"]), "recent_debits": {"$ne": debit["_id"]}},
+                {
+                    "$inc": {"credits": -debit["credits_used"]},
+                    "$push": {"recent_debits": {"$each": [debit["_id"]], "$slice": -DEBIT_MEMORY}}
+                }
+            )
+            for debit in debits
+        ], ordered=False)
+
+    async def record_purchases(self, debits: List[dict]):
+        # One ledger entry per order, keyed by the order id
+        try:
+            await self.db.credit_transactions.insert_many([purchase_transaction(debit) for debit in debits], ordered=False)
+        except BulkWriteError as e:
+            ignore_duplicates(e)
+
+class MotorHolds:
+    """Cart reservations, at most one per user and product (unique index)."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def list_active(self, user_id: str) -> List[dict]:
+        return await self.db.stock_holds.find({
+            "user_id": user_id,
+            "expires_at": {"$gt": datetime.utcnow()}
+        }).to_list(1000)
+
+    async def get(self, user_id: str, product_id: str) -> Optional[dict]:
+        """The user's hold on the product, expired or not while the sweeper has not released it."""
+        return await self.db.stock_holds.find_one({"user_id": user_id, "product_id": product_id})
+
+    async def create(self, hold: dict) -> Optional[str]:
+        """Inserts the hold, None if the user already holds the product."""
+        try:
+            result = await self.db.stock_holds.insert_one(hold)
+        except DuplicateKeyError:
+            return None
+        return str(result.inserted_id)
+
+    async def update(self, hold_id: ObjectId, held: int, quantity: int, expires_at: datetime) -> bool:
+        """Sets the quantity and expiry, only if the hold still holds `held`."""
+        result = await self.db.stock_holds.update_one(
+            {"_id": hold_id, "quantity": held},
+            {"$set": {"quantity": quantity, "expires_at": expires_at}}
+        )
+        return result.matched_count > 0
+
+    async def remove(self, hold_id: ObjectId, held: int) -> bool:
+        """Deletes the hold, only if it still holds `held`."""
+        result = await self.db.stock_holds.delete_one({"_id": hold_id, "quantity": held})
+        return result.deleted_count > 0
+
+    async def delete(self, hold_id: str, user_id: str) -> Optional[dict]:
+        return await self.db.stock_holds.find_one_and_delete({"_id": ObjectId(hold_id), "user_id": user_id})
+
+    async def take(self, user_id: str, product_id: str) -> Optional[dict]:
+        """Deletes and returns the user's active hold on the product, for a checkout."""
+        return await self.db.stock_holds.find_one_and_delete({
+            "user_id": user_id,
+            "product_id": product_id,
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+
+    async def pop_expired(self) -> Optional[dict]:
+        """Deletes and returns one expired hold, each one is returned to a single caller."""
+        return await self.db.stock_holds.find_one_and_delete({"expires_at": {"$lte": datetime.utcnow()}})
+
+class MotorOutbox:
+    """Entries of the order outbox, leased by one dispatcher at a time."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def add(self, entries: List[dict]):
+        """Inserts the entries, skipping those already there from an earlier attempt."""
+        try:
+            await self.db.outbox.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            ignore_duplicates(e)
+
+    async def lease(self, now: datetime, limit: int, owner: str, locked_until: datetime) -> List[dict]:
+        """Locks up to `limit` due entries for `owner` and returns those it got."""
+        due = await self.db.outbox.find(
+            {"next_attempt_at": {"$lte": now}, "locked_until": {"$lte": now}}, {"_id": 1}
+        ).sort("next_attempt_at", 1).limit(limit).to_list(limit)
+        if not due:
+            return []
+        ids = [entry["_id"] for entry in due]
+        await self.db.outbox.update_many(
+            {"_id": {"$in": ids}, "locked_until": {"$lte": now}},
+            {"$set": {"locked_until": locked_until, "owner": owner}}
+        )
+        return await self.db.outbox.find(
+            {"_id": {"$in": ids}, "owner": owner, "locked_until": locked_until}
+        ).to_list(None)
+
+    async def delete(self, entry_ids: List[ObjectId]):
+        await self.db.outbox.delete_many({"_id": {"$in": entry_ids}})
+
+    async def postpone(self, entry_ids: List[ObjectId], next_attempt_at: datetime, now: datetime):
+        await self.db.outbox.update_many(
+            {"_id": {"$in": entry_ids}},
+            {"$set": {"next_attempt_at": next_attempt_at, "locked_until": now}}
+        )
+
+    async def update(self, entry_id: ObjectId, fields: dict):
+        await self.db.outbox.update_one({"_id": entry_id}, {"$set": fields})
+
+    async def dead_letter(self, entry: dict):
+        """Moves the entry from the outbox to the dead letter collection."""
+        await self.db.outbox_dead_letter.insert_one(entry)
+        await self.db.outbox.delete_one({"_id": entry["_id"]})
+
+    async def get_dead_letter(self, entry_id: str) -> Optional[dict]:
+        return await self.db.outbox_dead_letter.find_one({"_id": ObjectId(entry_id)})
+
+    async def delete_dead_letter(self, entry_id: ObjectId):
+        await self.db.outbox_dead_letter.delete_one({"_id": entry_id})
+
+    async def counts(self) -> dict:
+        return {
+            "pending": await self.db.outbox.count_documents({}),
+            "dead_letter": await self.db.outbox_dead_letter.count_documents({})
+        }
+
+def purchase_transaction(debit: dict) -> dict:
+    return {
+        "_id": debit["_id"],
+        "user_id": debit["user_id"],
+        "amount": -debit["credits_used"],
+        "type": "purchase",
+        "order_id": str(debit["_id"]),
+        "created_at": debit["created_at"]
+    }
+
+def motor_storage(db, catalog_db, reports_db) -> Storage:
+    """Repositories on Mongo. Catalog and report reads use their own read preference."""
+    return Storage(
+        users=MotorUsers(db),
+        events=MotorEvents(db, catalog_db),
+        products=MotorProducts(db, catalog_db),
+        orders=MotorOrders(db, reports_db),
+        credits=MotorCredits(db),
+        holds=MotorHolds(db),
+        outbox=MotorOutbox(db),
+    )
+
+# In memory
+def copy(document: Optional[dict], fields: Optional[Iterable[str]] = None) -> Optional[dict]:
+    if document is None:
+        return None
+    if fields:
+        return {key: document[key] for key in ("_id", *fields) if key in document}
+    return dict(document)
+
+class MemoryUsers:
+    def __init__(self):
+        self.documents = {}
+        self.by_email = {}
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return copy(self.documents.get(ObjectId(user_id)))
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return copy(self.documents.get(self.by_email.get(email)))
+
+    async def get_many(self, user_ids: List[str], fields: Optional[List[str]] = None) -> List[dict]:
+        users = (self.documents.get(ObjectId(user_id)) for user_id in user_ids)
+        return [copy(user, fields) for user in users if user is not None]
+
+    async def get_credits(self, user_id: str) -> float:
+        user = self.documents.get(ObjectId(user_id))
+        return user.get("credits", 0.0) if user else 0.0
+
+    async def create(self, user: dict) -> str:
+        user.setdefault("_id", ObjectId())
+        self.documents[user["_id"]] = dict(user)
+        self.by_email[user["email"]] = user["_id"]
+        return str(user["_id"])
+
+    async def set_role(self, user_id: str, role: str):
+        user = self.documents.get(ObjectId(user_id))
+        if user:
+            user["role"] = role
+
+class MemoryEvents:
+    def __init__(self):
+        self.documents = {}
+
+    async def get(self, event_id: str, primary: bool = False) -> Optional[dict]:
+        return copy(self.documents.get(ObjectId(event_id)))
+
+    async def list(self, status: Optional[str] = None, fields: Optional[List[str]] = None,
+                   limit: Optional[int] = None) -> List[dict]:
+        events = [copy(event, fields) for event in self.documents.values() if not status or event["status"] == status]
+        return events[:limit]
+
+    async def nearby(self, longitude: float, latitude: float, max_distance: float, status: Optional[str],
+                     starts_from: Optional[datetime], starts_to: Optional[datetime],
+                     offset: int, limit: int) -> List[dict]:
+        found = []
+        for event in self.documents.values():
+            if not event.get("geo") or (status and event["status"] != status):
+                continue
+            starts_at = event.get("starts_at")
+            if (starts_from or starts_to) and starts_at is None:
+                continue
+            if (starts_from and starts_at < starts_from) or (starts_to and starts_at >= starts_to):
+                continue
+            distance = haversine(longitude, latitude, *event["geo"]["coordinates"])
+            if distance <= max_distance:
+                found.append(dict(event, distance=distance))
+        found.sort(key=lambda event: event["distance"])
+        return found[offset:offset + limit]
+
+    async def create(self, event: dict) -> str:
+        event.setdefault("_id", ObjectId())
+        self.documents[event["_id"]] = dict(event)
+        return str(event["_id"])
+
+    async def update(self, event_id: str, fields: dict, unset: Iterable[str] = ()) -> bool:
+        event = self.documents.get(ObjectId(event_id))
+        if event is None:
+            return False
+        event.update(fields)
+        for field in unset:
+            event.pop(field, None)
+        return True
+
+    async def delete(self, event_id: str) -> bool:
+        return self.documents.pop(ObjectId(event_id), None) is not None
+
+def haversine(longitude: float, latitude: float, other_longitude: float, other_latitude: float) -> float:
+    """Distance in meters between two points on the sphere."""
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    a = math.sin((other_phi - phi) / 2) ** 2 + \
+        math.cos(phi) * math.cos(other_phi) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+class MemoryProducts:
+    def __init__(self):
+        self.documents = {}
+        self.by_event = {}  # event id -> {product id: None}, in insertion order
+
+    async def get(self, product_id: str) -> Optional[dict]:
+        return copy(self.documents.get(ObjectId(product_id)))
+
+    async def list_by_event(self, event_id: str) -> List[dict]:
+        return [copy(self.documents[product_id]) for product_id in self.by_event.get(event_id, ())][:1000]
+
+    async def list(self, fields: Optional[List[str]] = None) -> List[dict]:
+        return [copy(product, fields) for product in self.documents.values()]
+
+    async def create(self, product: dict) -> str:
+        product.setdefault("_id", ObjectId())
+        self.documents[product["_id"]] = dict(product)
+        self.by_event.setdefault(product["event_id"], {})[product["_id"]] = None
+        return str(product["_id"])
+
+    async def update(self, product_id: str, fields: dict) -> Optional[dict]:
+        product = self.documents.get(ObjectId(product_id))
+        if product is None:
+            return None
+        before = dict(product)
+        product.update(fields)
+        return before
+
+    async def delete(self, product_id: str) -> Optional[dict]:
+        product = self.documents.pop(ObjectId(product_id), None)
+        if product is not None:
+            self.by_event.get(product["event_id"], {}).pop(product["_id"], None)
+        return product
+
+    async def take(self, product_id: str, quantity: int, held: int) -> bool:
+        product = self.documents.get(ObjectId(product_id))
+        if product is None or (quantity > held and available_stock(product) < quantity - held):
+            return False
+        product["stock"] -= quantity
+        product["reserved"] = product.get("reserved", 0) - held
+        return True
+
+    async def restock(self, product_id: str, quantity: int):
+        product = self.documents.get(ObjectId(product_id))
+        if product is not None:
+            product["stock"] += quantity
+
+    async def reserve(self, product_id: str, quantity: int) -> bool:
+        product = self.documents.get(ObjectId(product_id))
+        if product is None or available_stock(product) < quantity:
+            return False
+        product["reserved"] = product.get("reserved", 0) + quantity
+        return True
+
+    async def release(self, product_id: str, quantity: int):
+        product = self.documents.get(ObjectId(product_id))
+        if product is not None:
+            product["reserved"] = product.get("reserved", 0) - quantity
+
+class MemoryOrderTable:
+    """One order collection (hot or archive) with its indexes."""
+
+    def __init__(self):
+        self.documents = {}
+        self.by_user = {}  # user id -> {order id: None}, in insertion order
+        self.by_qr_code = {}
+        self.by_event = {}
+
+    def insert(self, order: dict):
+        if order["_id"] in self.documents:
+            return
+        self.documents[order["_id"]] = dict(order)
+        self.by_user.setdefault(order["user_id"], {})[order["_id"]] = None
+        self.by_qr_code[order["qr_code"]] = order["_id"]
+        self.by_event.setdefault(order["event_id"], {})[order["_id"]] = None
+
+class MemoryOrders:
+    def __init__(self):
+        self.hot = MemoryOrderTable()
+        self.archive = MemoryOrderTable()
+
+    def table(self, archived: bool) -> MemoryOrderTable:
+        return self.archive if archived else self.hot
+
+    async def insert(self, order: dict):
+        self.hot.insert(order)
+
+    async def insert_many(self, orders: List[dict]):
+        for order in orders:
+            self.hot.insert(order)
+
+    async def get(self, order_id: str, archived: bool = False) -> Optional[dict]:
+        return copy(self.table(archived).documents.get(ObjectId(order_id)))
+
+    async def get_by_qr_code(self, qr_code: str, archived: bool = False) -> Optional[dict]:
+        table = self.table(archived)
+        return copy(table.documents.get(table.by_qr_code.get(qr_code)))
+
+    async def list_by_user(self, user_id: str, archived: bool = False) -> List[dict]:
+        table = self.table(archived)
+        return [copy(table.documents[order_id]) for order_id in table.by_user.get(user_id, ())][:1000]
+
+    async def lookup(self, order_ids: List[ObjectId], qr_codes: List[str], fields: Optional[List[str]] = None,
+                     archived: bool = False) -> List[dict]:
+        table = self.table(archived)
+        found = dict.fromkeys(order_id for order_id in order_ids if order_id in table.documents)
+        found.update(dict.fromkeys(table.by_qr_code[qr_code] for qr_code in qr_codes if qr_code in table.by_qr_code))
+        return [copy(table.documents[order_id], fields) for order_id in found]
+
+    async def existing_ids(self, order_ids: List[ObjectId]) -> set:
+        return {order_id for order_id in order_ids if order_id in self.hot.documents}
+
+    async def set_validated(self, order_id: ObjectId, validated_at: datetime):
+        order = self.hot.documents.get(order_id)
+        if order is not None:
+            order.update(status="validated", validated_at=validated_at)
+
+    async def list_recent(self, event_id: Optional[str], created_from: Optional[datetime],
+                          created_to: Optional[datetime], limit: int) -> List[dict]:
+        if event_id:
+            orders = (self.hot.documents[order_id] for order_id in self.hot.by_event.get(event_id, ()))
+        else:
+            orders = self.hot.documents.values()
+        orders = [
+            order for order in orders
+            if (not created_from or order["created_at"] >= created_from) and (not created_to or order["created_at"] < created_to)
+        ]
+        orders.sort(key=lambda order: order["created_at"], reverse=True)
+        return [copy(order) for order in orders[:limit]]
+
+    async def list_paid(self, limit: int) -> List[dict]:
+        orders = (order for order in self.hot.documents.values() if order["payment_status"] == "paid")
+        return [copy(order) for _, order in zip(range(limit), orders)]
+
+    async def recent_user_ids(self, created_from: datetime, limit: int) -> List[str]:
+        last_order_at = {}
+        for order in self.hot.documents.values():
+            if order["created_at"] >= created_from:
+                user_id = order["user_id"]
+                last_order_at[user_id] = max(last_order_at.get(user_id, order["created_at"]), order["created_at"])
+        return sorted(last_order_at, key=last_order_at.get, reverse=True)[:limit]
+
+    async def list_qr_codes(self, event_id: str, status: Optional[str], limit: int) -> List[dict]:
+        orders = [
+            copy(self.hot.documents[order_id], ["qr_code"]) for order_id in sorted(self.hot.by_event.get(event_id, ()))
+            if not status or self.hot.documents[order_id]["status"] == status
+        ]
+        return orders[:limit]
+
+class MemoryCredits:
+    def __init__(self, users: MemoryUsers):
+        self.users = users
+        self.transactions = {}
+
+    async def add(self, user_id: str, amount: float, kind: str):
+        user = self.users.documents.get(ObjectId(user_id))
+        if user is not None:
+            user["credits"] = user.get("credits", 0.0) + amount
+        transaction_id = ObjectId()
+        self.transactions[transaction_id] = {
+            "_id": transaction_id,
+            "user_id": user_id,
+            "amount": amount,
+            "type": kind,
+            "created_at": datetime.utcnow()
+        }
+
+    async def spend(self, user_id: str, amount: float) -> bool:
+        user = self.users.documents.get(ObjectId(user_id))
+        if user is None or user.get("credits", 0.0) < amount:
+            return False
+        user["credits"] -= amount
+        return True
+
+    async def refund(self, user_id: str, amount: float):
+        user = self.users.documents.get(ObjectId(user_id))
+        if user is not None:
+            user["credits"] = user.get("credits", 0.0) + amount
+
+    async def debit_orders(self, debits: List[dict]):
+        for debit in debits:
+            user = self.users.documents.get(ObjectId(debit["user_id"]))
+            if user is None or debit["_id"] in user.get("recent_debits", ()):
+                continue
+            user["credits"] = user.get("credits", 0.0) - debit["credits_used"]
+            user["recent_debits"] = (user.get("recent_debits", []) + [debit["_id"]])[-DEBIT_MEMORY:]
+
+    async def record_purchases(self, debits: List[dict]):
+        for debit in debits:
+            self.transactions.setdefault(debit["_id"], purchase_transaction(debit))
+
+class MemoryHolds:
+    def __init__(self):
+        self.documents = {}
+        self.by_user_product = {}  # (user id, product id) -> hold id, the unique index
+
+    async def list_active(self, user_id: str) -> List[dict]:
+        now = datetime.utcnow()
+        return [
+            copy(hold) for hold in self.documents.values()
+            if hold["user_id"] == user_id and hold["expires_at"] > now
+        ][:1000]
+
+    async def get(self, user_id: str, product_id: str) -> Optional[dict]:
+        return copy(self.documents.get(self.by_user_product.get((user_id, product_id))))
+
+    async def create(self, hold: dict) -> Optional[str]:
+        key = (hold["user_id"], hold["product_id"])
+        if key in self.by_user_product:
+            return None
+        hold.setdefault("_id", ObjectId())
+        self.documents[hold["_id"]] = dict(hold)
+        self.by_user_product[key] = hold["_id"]
+        return str(hold["_id"])
+
+    async def update(self, hold_id: ObjectId, held: int, quantity: int, expires_at: datetime) -> bool:
+        hold = self.documents.get(hold_id)
+        if hold is None or hold["quantity"] != held:
+            return False
+        hold.update(quantity=quantity, expires_at=expires_at)
+        return True
+
+    async def remove(self, hold_id: ObjectId, held: int) -> bool:
+        hold = self.documents.get(hold_id)
+        if hold is None or hold["quantity"] != held:
+            return False
+        self.pop(hold_id)
+        return True
+
+    async def delete(self, hold_id: str, user_id: str) -> Optional[dict]:
+        hold = self.documents.get(ObjectId(hold_id))
+        if hold is None or hold["user_id"] != user_id:
+            return None
+        return self.pop(hold["_id"])
+
+    async def take(self, user_id: str, product_id: str) -> Optional[dict]:
+        hold = self.documents.get(self.by_user_product.get((user_id, product_id)))
+        if hold is None or hold["expires_at"] <= datetime.utcnow():
+            return None
+        return self.pop(hold["_id"])
+
+    async def pop_expired(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        for hold in self.documents.values():
+            if hold["expires_at"] <= now:
+                return self.pop(hold["_id"])
+        return None
+
+    def pop(self, hold_id: ObjectId) -> dict:
+        hold = self.documents.pop(hold_id)
+        del self.by_user_product[(hold["user_id"], hold["product_id"])]
+        return hold
+
+class MemoryOutbox:
+    def __init__(self):
+        self.documents = {}
+        self.dead_letters = {}
+
+    async def add(self, entries: List[dict]):
+        for entry in entries:
+            self.documents.setdefault(entry["_id"], dict(entry, pending=list(entry["pending"])))
+
+    async def lease(self, now: datetime, limit: int, owner: str, locked_until: datetime) -> List[dict]:
+        due = sorted(
+            (entry for entry in self.documents.values()
+             if entry["next_attempt_at"] <= now and entry["locked_until"] <= now),
+            key=lambda entry: entry["next_attempt_at"]
+        )[:limit]
+        for entry in due:
+            entry.update(locked_until=locked_until, owner=owner)
+        # Entries are mutated by the dispatcher, hand out copies of the lists too
+        return [dict(copy(entry), pending=list(entry["pending"])) for entry in due]
+
+    async def delete(self, entry_ids: List[ObjectId]):
+        for entry_id in entry_ids:
+            self.documents.pop(entry_id, None)
+
+    async def postpone(self, entry_ids: List[ObjectId], next_attempt_at: datetime, now: datetime):
+        for entry_id in entry_ids:
+            entry = self.documents.get(entry_id)
+            if entry is not None:
+                entry.update(next_attempt_at=next_attempt_at, locked_until=now)
+
+    async def update(self, entry_id: ObjectId, fields: dict):
+        entry = self.documents.get(entry_id)
+        if entry is not None:
+            entry.update(fields)
+
+    async def dead_letter(self, entry: dict):
+        self.dead_letters[entry["_id"]] = copy(entry)
+        self.documents.pop(entry["_id"], None)
+
+    async def get_dead_letter(self, entry_id: str) -> Optional[dict]:
+        return copy(self.dead_letters.get(ObjectId(entry_id)))
+
+    async def delete_dead_letter(self, entry_id: ObjectId):
+        self.dead_letters.pop(entry_id, None)
+
+    async def counts(self) -> dict:
+        return {"pending": len(self.documents), "dead_letter": len(self.dead_letters)}
+
+def memory_storage() -> Storage:
+    users = MemoryUsers()
+    return Storage(
+        users=users,
+        events=MemoryEvents(),
+        products=MemoryProducts(),
+        orders=MemoryOrders(),
+        credits=MemoryCredits(users),
+        holds=MemoryHolds(),
+        outbox=MemoryOutbox(),
+    )
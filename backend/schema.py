@@ -0,0 +1,64 @@
+"""Document formats and collection setup shared by the API and the maintenance scripts.
+
+Kept out of server.py so archive_orders.py and migrate_datetimes.py do not
+build the whole app (Mongo client, middlewares, background tasks) to reuse them.
+"""
+import logging
+from datetime import datetime
+from typing import Optional
+
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Mongo's error code for a collection that already exists
+NAMESPACE_EXISTS = 48
+
+EVENT_DATE_FORMATS = ["%d/%m/%Y %H:%M", "%d/%m/%Y", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+def parse_event_date(text: str) -> Optional[datetime]:
+    # Event dates are free text typed by admins, keep a native copy when it parses
+    text = text.strip()
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        pass
+    for date_format in EVENT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+# Order archive
+# Validated and cancelled orders of finished events are moved to orders_archive by
+# archive_orders.py, keeping the hot orders collection and its indexes small.
+ARCHIVABLE_ORDER_STATUSES = ["validated", "cancelled"]
+
+async def create_collection(database, name: str, **options) -> bool:
+    """Creates the collection, False if it already exists (another worker got there first)."""
+    try:
+        await database.create_collection(name, **options)
+    except CollectionInvalid:
+        return False
+    except OperationFailure as e:
+        if e.code != NAMESPACE_EXISTS:
+            raise
+        return False
+    return True
+
+async def ensure_order_archive(database):
+    if "orders_archive" not in await database.list_collection_names():
+        try:
+            # Cold data is rarely read, trade some CPU on reads for a smaller footprint
+            await create_collection(
+                database, "orders_archive",
+                storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}}
+            )
+        except OperationFailure as e:
+            # Servers built without zstd, or not on WiredTiger
+            logger.warning("orders_archive created without zstd: %s", e)
+            await create_collection(database, "orders_archive")
+    await database.orders_archive.create_index("user_id")
+    await database.orders_archive.create_index("qr_code")
+    await database.orders_archive.create_index([("event_id", 1), ("created_at", 1)])
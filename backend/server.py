@@ -1,74 +1,2179 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
+import json
+import re
+import bisect
+import gzip
+import hashlib
+import heapq
+import zlib
 import logging
+import math
+import queue
+import random
+import time
+import unicodedata
+from contextvars import Context, ContextVar
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 import jwt
 from bson import ObjectId
+import pymongo
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from pymongo import monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
+
+import image_variants
+from image_variants import image_pool, prepare_image
+from schema import ensure_order_archive, parse_event_date
+from repositories import Storage, available_stock, motor_storage
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, compressed responses fall back to gzip
+    brotli = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, analytics post-processing falls back to pure Python
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, catalog publishing is then unlocked (run a single worker)
+    fcntl = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Mongo timeouts. Driver defaults wait up to 30s for a server and forever for a
+# pooled connection, so a slow database would pile requests up in every worker.
+# Each request also gets a total database budget per route class (pymongo.timeout,
+# which sends maxTimeMS with every command and bounds selection and pool waits).
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 2000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 2000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 1000))
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_REQUEST_TIMEOUT_MS = int(os.environ.get('MONGO_REQUEST_TIMEOUT_MS', 3000))
+MONGO_CATALOG_TIMEOUT_MS = int(os.environ.get('MONGO_CATALOG_TIMEOUT_MS', 1000))
+MONGO_ADMIN_TIMEOUT_MS = int(os.environ.get('MONGO_ADMIN_TIMEOUT_MS', 30000))
+
+# Circuit breaker: after DB_BREAKER_FAILURE_THRESHOLD consecutive database failures
+# requests stop waiting on Mongo for DB_BREAKER_RESET_SECONDS, then a single probe
+# request is let through to check whether it recovered
+DB_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('DB_BREAKER_FAILURE_THRESHOLD', 5))
+DB_BREAKER_RESET_SECONDS = float(os.environ.get('DB_BREAKER_RESET_SECONDS', 10))
+CATALOG_FALLBACK_MAX_ENTRIES = int(os.environ.get('CATALOG_FALLBACK_MAX_ENTRIES', 1000))
+
+# Admission control: each route class has its own concurrency limit and wait queue
+# (ADMISSION_LIMITS="scan=64,...", ADMISSION_QUEUES likewise). While a class has
+# requests waiting, the classes below it are shed, so gate scans and checkouts keep
+# the workers and the Mongo pool during a rush
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.environ.get('ADMISSION_QUEUE_TIMEOUT_MS', 2000))
+ADMISSION_LIMITS = dict(
+    {"scan": 64, "checkout": 64, "browse": 128, "admin": 4},
+    **{name: int(limit) for name, _, limit in (
+        entry.partition("=") for entry in os.environ.get('ADMISSION_LIMITS', '').split(",") if entry
+    )}
+)
+ADMISSION_QUEUES = dict(
+    {"scan": 512, "checkout": 256, "browse": 128, "admin": 8},
+    **{name: int(size) for name, _, size in (
+        entry.partition("=") for entry in os.environ.get('ADMISSION_QUEUES', '').split(",") if entry
+    )}
+)
+
+# Timeouts, lost connections and unreachable servers, not query errors
+DATABASE_UNAVAILABLE_ERRORS = (ConnectionFailure, ExecutionTimeout)
+
+class CircuitBreaker:
+    """Consecutive-failure breaker shared by every handler of this worker."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self.times_opened = 0
+        self.shed = 0
+        # Successes are reported from the driver's executor threads
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.probe_at = 0.0
+            # One probe per reset window until a command succeeds
+            if self.state == "half_open" and now - self.probe_at >= self.reset_seconds:
+                self.probe_at = now
+                return True
+            self.shed += 1
+            return False
+
+    def record_success(self):
+        if self.state == "closed" and not self.failures:
+            return
+        with self._lock:
+            if self.state != "closed":
+                logger.warning("database circuit closed")
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.warning("database circuit open", extra={"failures": self.failures})
+
+    def retry_after(self) -> int:
+        if self.state == "closed":
+            return 1
+        return max(int(self.reset_seconds - (time.monotonic() - self.opened_at)), 1)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+            "shed": self.shed,
+        }
+
+# Set by DatabaseBreakerMiddleware for the requests the breaker guards. Motor runs
+# commands with a copy of the caller's context, so the listener sees it
+breaker_tracked: ContextVar[bool] = ContextVar("breaker_tracked", default=False)
+
+def start_background_task(coro) -> asyncio.Task:
+    """Runs `coro` in a task with a fresh context.
+
+    A task copies the context of whoever creates it, so work scheduled by a handler
+    would inherit the request's pymongo.timeout deadline (long gone once a debounce
+    ends) and its breaker accounting.
+    """
+    return Context().run(asyncio.create_task, coro)
+
+class BreakerCommandListener(monitoring.CommandListener):
+    """Closes the breaker on request-path successes.
+
+    Background pollers (outbox, hold sweeper, warm-up) keep succeeding on cheap
+    queries while requests time out, so their commands do not count. Failures are
+    recorded where the error surfaces, once per request, not per command.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if breaker_tracked.get():
+            db_breaker.record_success()
+
+    def failed(self, event):
+        pass
+
+db_breaker = CircuitBreaker(DB_BREAKER_FAILURE_THRESHOLD, DB_BREAKER_RESET_SECONDS)
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+client = AsyncIOMotorClient(
+    mongo_url,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    event_listeners=[BreakerCommandListener()]
+)
+
+# Read preference per route class. Catalog and report reads may go to secondaries
+# (bounded by READ_MAX_STALENESS_SECONDS, Mongo's minimum is 90), everything else,
+# including auth, order reads and QR validation, stays on the primary.
+CATALOG_READ_PREFERENCE = os.environ.get('CATALOG_READ_PREFERENCE', 'primary')
+REPORTS_READ_PREFERENCE = os.environ.get('REPORTS_READ_PREFERENCE', 'primary')
+READ_MAX_STALENESS_SECONDS = int(os.environ.get('READ_MAX_STALENESS_SECONDS', 90))
+
+READ_PREFERENCE_MODES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def read_preference(mode: str):
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCE_MODES[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+
+db = client.get_database(os.environ['DB_NAME'], read_preference=Primary())
+catalog_db = client.get_database(os.environ['DB_NAME'], read_preference=read_preference(CATALOG_READ_PREFERENCE))
+reports_db = client.get_database(os.environ['DB_NAME'], read_preference=read_preference(REPORTS_READ_PREFERENCE))
+
+# Users, events, products, orders and credits go through the repositories of
+# `storage` (see repositories.py), handlers get it with Depends(get_storage)
+storage = motor_storage(db, catalog_db, reports_db)
+
+def get_storage() -> Storage:
+    return storage
+
+# JWT Configuration
+SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+
+# Stock holds (cart reservations)
+STOCK_HOLD_TTL_SECONDS = int(os.environ.get('STOCK_HOLD_TTL_SECONDS', 600))  # 10 minutes
+STOCK_HOLD_SWEEP_INTERVAL_SECONDS = int(os.environ.get('STOCK_HOLD_SWEEP_INTERVAL_SECONDS', 15))
+
+# Order ingestion: "direct" writes every order on the request path, "queued" accepts
+# the order into a journaled in-process queue and persists it in batches
+ORDER_INGESTION_MODE = os.environ.get('ORDER_INGESTION_MODE', 'direct')
+ORDER_OUTBOX_PATH = Path(os.environ.get('ORDER_OUTBOX_PATH', ROOT_DIR / 'order_outbox.ndjson'))
+ORDER_OUTBOX_FSYNC = os.environ.get('ORDER_OUTBOX_FSYNC', 'true').lower() == 'true'
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', 500))
+ORDER_BATCH_INTERVAL_MS = int(os.environ.get('ORDER_BATCH_INTERVAL_MS', 50))
+
+# Post-order side effects (credit debit, ledger entry) go through the `outbox`
+# collection: the entry is written before the order and a dispatcher applies it
+# in batches, with retries and a dead-letter collection
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 200))
+OUTBOX_POLL_INTERVAL_MS = int(os.environ.get('OUTBOX_POLL_INTERVAL_MS', 500))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS', 30))
+# Entries whose order never reached Mongo (the request failed after the outbox write)
+OUTBOX_ORPHAN_SECONDS = int(os.environ.get('OUTBOX_ORPHAN_SECONDS', 300))
+
+# Menu snapshots: writes to an event or its products schedule a rebuild of that
+# event's snapshot, coalesced within MENU_SNAPSHOT_DEBOUNCE_MS. Stock-only changes
+# (orders, cart holds) are coalesced over MENU_SNAPSHOT_STOCK_DEBOUNCE_MS, a rush
+# would otherwise rebuild every menu continuously. Rebuilds compress at the levels
+# below, the startup build at the best ratio
+MENU_SNAPSHOT_DEBOUNCE_MS = int(os.environ.get('MENU_SNAPSHOT_DEBOUNCE_MS', 250))
+MENU_SNAPSHOT_STOCK_DEBOUNCE_MS = int(os.environ.get('MENU_SNAPSHOT_STOCK_DEBOUNCE_MS', 5000))
+MENU_SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get('MENU_SNAPSHOT_MAX_AGE_SECONDS', 30))
+MENU_SNAPSHOT_GZIP_LEVEL = int(os.environ.get('MENU_SNAPSHOT_GZIP_LEVEL', 6))
+MENU_SNAPSHOT_BROTLI_QUALITY = int(os.environ.get('MENU_SNAPSHOT_BROTLI_QUALITY', 5))
+
+# Response compression
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+COMPRESSION_CONTENT_TYPES = os.environ.get('COMPRESSION_CONTENT_TYPES', 'application/json,text/').split(',')
+
+# Static catalog publishing: with CATALOG_PUBLISH_DIR set, the public catalog
+# (/api/events, each event and its products) is also written there as static JSON
+# so nginx or a CDN can serve it without Python
+CATALOG_PUBLISH_DIR = os.environ.get('CATALOG_PUBLISH_DIR')
+CATALOG_PUBLISH_DEBOUNCE_MS = int(os.environ.get('CATALOG_PUBLISH_DEBOUNCE_MS', 1000))
+CATALOG_PUBLISH_MAX_AGE_SECONDS = int(os.environ.get('CATALOG_PUBLISH_MAX_AGE_SECONDS', 10))
+
+# Catalog search: an in-memory index of events and products, rebuilt after catalog
+# writes and at least every SEARCH_INDEX_MAX_AGE_SECONDS for other workers' writes
+SEARCH_INDEX_DEBOUNCE_MS = int(os.environ.get('SEARCH_INDEX_DEBOUNCE_MS', 500))
+SEARCH_INDEX_MAX_AGE_SECONDS = int(os.environ.get('SEARCH_INDEX_MAX_AGE_SECONDS', 60))
+SEARCH_MAX_LIMIT = 50
+
+# Principals: identity and role of authenticated users, kept PRINCIPAL_CACHE_TTL_SECONDS
+# so a promotion or a deleted user is seen within that time. Admins are read again on
+# every request, a demoted admin loses access at once. Balances are never cached
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.environ.get('PRINCIPAL_CACHE_MAX_ENTRIES', 50000))
+PRINCIPAL_CACHE_TTL_SECONDS = int(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', 60))
+
+# Warm-up: at startup the caches are filled (catalog fallback, menus, search index and
+# the users with orders in the last WARMUP_PRINCIPAL_HOURS) before /ready answers 200.
+# Whatever is not done after WARMUP_BUDGET_SECONDS is left to the first requests
+WARMUP_BUDGET_SECONDS = float(os.environ.get('WARMUP_BUDGET_SECONDS', 15))
+WARMUP_PRINCIPAL_HOURS = int(os.environ.get('WARMUP_PRINCIPAL_HOURS', 24))
+WARMUP_PRINCIPAL_LIMIT = int(os.environ.get('WARMUP_PRINCIPAL_LIMIT', 10000))
+
+# Nearby events: radius in km
+NEARBY_DEFAULT_RADIUS_KM = float(os.environ.get('NEARBY_DEFAULT_RADIUS_KM', 50))
+NEARBY_MAX_RADIUS_KM = float(os.environ.get('NEARBY_MAX_RADIUS_KM', 500))
+NEARBY_MAX_LIMIT = 100
+
+# Sales analytics: buckets that ended more than this long ago are closed and cached
+ANALYTICS_CLOSE_GRACE_SECONDS = int(os.environ.get('ANALYTICS_CLOSE_GRACE_SECONDS', 120))
+
+# Batch order lookup
+ORDER_LOOKUP_MAX_KEYS = int(os.environ.get('ORDER_LOOKUP_MAX_KEYS', 500))
+
+# Checkout quotes: priced from the menu snapshot's price table and signed, so
+# create_order can trust them without reading the event or its products again.
+# Their audience keeps them from being accepted as access tokens and back
+QUOTE_TTL_SECONDS = int(os.environ.get('QUOTE_TTL_SECONDS', 300))
+QUOTE_AUDIENCE = "eventpay:quote"
+PLATFORM_FEE_RATE = 0.10
+
+# Server-side QR rendering: rendered images are cached per code, format and size,
+# bulk ticket exports are rendered on the image process pool in chunks
+QR_CACHE_MAX_ENTRIES = int(os.environ.get('QR_CACHE_MAX_ENTRIES', 4096))
+QR_MIN_SIZE = 64
+QR_MAX_SIZE = 2048
+QR_BULK_MAX_ORDERS = int(os.environ.get('QR_BULK_MAX_ORDERS', 20000))
+QR_BULK_CHUNK_SIZE = int(os.environ.get('QR_BULK_CHUNK_SIZE', 500))
+
+# Password hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+security = HTTPBearer()
+
+# Create the main app
+app = FastAPI()
+api_router = APIRouter(prefix="/api")
+
+# Configure logging
+# Handlers only enqueue records, a background listener thread formats them as JSON
+# and writes them out, so logging never blocks the event loop on I/O. Records at
+# INFO and below are sampled per route (LOG_SAMPLE_RATES="create_order=0.01,...");
+# the decision is taken once per request so a sampled request keeps all its lines.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATE_DEFAULT = float(os.environ.get('LOG_SAMPLE_RATE_DEFAULT', 1.0))
+LOG_SAMPLE_RATES = {
+    route: float(rate)
+    for route, _, rate in (
+        entry.partition("=") for entry in os.environ.get('LOG_SAMPLE_RATES', '').split(",") if entry
+    )
+}
+
+request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default=None)
+
+LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "request_id"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        scope = request_scope.get()
+        if scope is None:
+            return True
+        record.request_id = scope["request_id"]
+        if record.levelno > logging.INFO:
+            return True
+        if "log_sampled" not in scope:
+            # The endpoint is only known after routing, so the decision is made on the first record
+            endpoint = scope.get("endpoint")
+            rate = LOG_SAMPLE_RATES.get(getattr(endpoint, "__name__", None), LOG_SAMPLE_RATE_DEFAULT)
+            scope["log_sampled"] = random.random() < rate
+        return scope["log_sampled"]
+
+class NonBlockingQueueHandler(QueueHandler):
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Keep the record as is, formatting happens on the listener thread
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+def configure_logging() -> QueueListener:
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+
+class RequestContextMiddleware:
+    """Tags every request with an id (X-Request-ID) and emits a sampled access log line."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+        scope["request_id"] = request_id or uuid.uuid4().hex
+        token = request_scope.set(scope)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"x-request-id", scope["request_id"].encode("latin-1"))
+                ])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            logger.info("request", extra={
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": getattr(scope.get("endpoint"), "__name__", None),
+                "status": status_code,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+            })
+            request_scope.reset(token)
+
+def service_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Serviço temporariamente indisponível, tente novamente",
+        headers={"Retry-After": str(db_breaker.retry_after())}
+    )
+
+def is_catalog_read(scope) -> bool:
+    return scope["method"] in ("GET", "HEAD") and scope["path"].startswith(("/api/events", "/api/search"))
+
+class DatabaseBreakerMiddleware:
+    """Sets the database budget of each request and sheds it while the breaker is open.
+
+    Catalog reads always go through, their handlers fall back to the last-known-good
+    catalog when the database is unavailable.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        
+        if is_catalog_read(scope):
+            budget = MONGO_CATALOG_TIMEOUT_MS
+        elif not db_breaker.allow():
+            error = service_unavailable()
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+            await response(scope, receive, send)
+            return
+        elif scope["path"].startswith("/api/admin/"):
+            budget = MONGO_ADMIN_TIMEOUT_MS
+        else:
+            budget = MONGO_REQUEST_TIMEOUT_MS
+        
+        token = breaker_tracked.set(True)
+        try:
+            with pymongo.timeout(budget / 1000):
+                await self.app(scope, receive, send)
+        finally:
+            breaker_tracked.reset(token)
+
+# Highest priority first
+ADMISSION_CLASSES = ("scan", "checkout", "browse", "admin")
+
+def admission_class(scope) -> str:
+    path = scope["path"]
+    if path.startswith("/api/admin/"):
+        return "admin"
+    if scope["method"] == "POST" and path.startswith("/api/orders/") and path.endswith(("/validate", "/validate-qr")):
+        return "scan"
+    if path.startswith(("/api/cart/", "/api/credits/", "/api/auth/")) or (
+        scope["method"] == "POST" and path in ("/api/orders", "/api/orders/quote")
+    ):
+        return "checkout"
+    return "browse"
+
+class AdmissionLane:
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = Counter()
+        self.wait_ms_max = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit, "queue_size": self.queue_size, "active": self.active,
+            "waiting": len(self.waiters), "admitted": self.admitted, "queued": self.queued,
+            "shed": dict(self.shed), "wait_ms_max": round(self.wait_ms_max, 2)
+        }
+
+class AdmissionController:
+    """Per class concurrency limits and FIFO queues, lower classes shed first."""
+
+    def __init__(self, limits: dict, queue_sizes: dict, queue_timeout: float):
+        self.classes = [AdmissionLane(name, limits[name], queue_sizes[name]) for name in ADMISSION_CLASSES]
+        self.by_name = {lane.name: lane for lane in self.classes}
+        self.queue_timeout = queue_timeout
+
+    def pressured(self, lane: AdmissionLane) -> bool:
+        # Some class above this one is already waiting for slots
+        return any(higher.waiters for higher in self.classes[:self.classes.index(lane)])
+
+    def shed_below(self, lane: AdmissionLane):
+        for lower in self.classes[self.classes.index(lane) + 1:]:
+            while lower.waiters:
+                waiter = lower.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(False)
+                    lower.shed["overload"] += 1
+
+    async def acquire(self, name: str) -> bool:
+        lane = self.by_name[name]
+        if self.pressured(lane):
+            lane.shed["overload"] += 1
+            return False
+        if lane.active < lane.limit and not lane.waiters:
+            lane.active += 1
+            lane.admitted += 1
+            return True
+        if len(lane.waiters) >= lane.queue_size:
+            lane.shed["queue_full"] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        lane.queued += 1
+        self.shed_below(lane)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # A slot handed over while the client went away goes to the next waiter
+            if waiter.done() and waiter.result():
+                self.release(name)
+            waiter.cancel()
+            raise
+        finally:
+            if waiter in lane.waiters:
+                lane.waiters.remove(waiter)
+        # The slot may be handed over right as the timeout fires, it is kept then
+        if not waiter.done():
+            waiter.cancel()
+            lane.shed["timeout"] += 1
+            return False
+        if waiter.result():
+            lane.admitted += 1
+            lane.wait_ms_max = max(lane.wait_ms_max, (time.perf_counter() - started) * 1000)
+        return waiter.result()
+
+    def release(self, name: str):
+        lane = self.by_name[name]
+        # The slot passes straight to the next waiter, active stays the same
+        while lane.waiters:
+            waiter = lane.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        lane.active -= 1
+
+    def stats(self) -> dict:
+        return {lane.name: lane.stats() for lane in self.classes}
+
+admission = AdmissionController(ADMISSION_LIMITS, ADMISSION_QUEUES, ADMISSION_QUEUE_TIMEOUT_MS / 1000)
+
+class AdmissionMiddleware:
+    """Admits API requests through the controller of their route class, 503 when shed."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not ADMISSION_ENABLED or scope["type"] != "http" or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+        
+        name = admission_class(scope)
+        if not await admission.acquire(name):
+            logger.warning("request shed", extra={"admission_class": name, "path": scope["path"]})
+            response = JSONResponse(
+                {"detail": "Servidor sobrecarregado, tente novamente"}, status_code=503, headers={"Retry-After": "1"}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release(name)
+
+class CatalogFallback:
+    """Last successful result of each catalog read, served while Mongo is unavailable."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.served = 0
+
+    def put(self, key: tuple, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: tuple):
+        value = self.entries.get(key)
+        if value is not None:
+            self.served += 1
+        return value
+
+catalog_fallback = CatalogFallback(CATALOG_FALLBACK_MAX_ENTRIES)
+
+class SingleFlight:
+    """Concurrent calls with the same key share one in-flight call and its result."""
+
+    def __init__(self):
+        self.calls = {}
+        self.counters = {}
+
+    async def do(self, key: tuple, fetch):
+        counters = self.counters.setdefault(key[0], {"calls": 0, "coalesced": 0})
+        task = self.calls.get(key)
+        if task is None:
+            counters["calls"] += 1
+            task = asyncio.ensure_future(fetch())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+        else:
+            counters["coalesced"] += 1
+        # A caller that goes away must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def _done(self, key: tuple, task: asyncio.Task):
+        self.calls.pop(key, None)
+        # Marks the error as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), "by_query": self.counters}
+
+catalog_flights = SingleFlight()
+
+async def catalog_read(key: tuple, fetch) -> Optional[Response]:
+    """Serialized catalog read, coalesced per key, with the last-known-good fallback.
+
+    `fetch` returns the JSON body, or None when the document does not exist.
+    """
+    async def guarded_fetch():
+        try:
+            return await fetch()
+        except DATABASE_UNAVAILABLE_ERRORS:
+            db_breaker.record_failure()
+            raise
+    
+    if db_breaker.allow():
+        try:
+            body = await catalog_flights.do(key, guarded_fetch)
+        except DATABASE_UNAVAILABLE_ERRORS:
+            pass
+        else:
+            if body is None:
+                return None
+            catalog_fallback.put(key, body)
+            return Response(content=body, media_type="application/json")
+    
+    body = catalog_fallback.get(key)
+    if body is None:
+        raise service_unavailable()
+    return Response(content=body, media_type="application/json", headers={"X-Catalog-Source": "last-known-good"})
+
+def catalog_body(value) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+# Helper functions
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def to_isoformat(value):
+    # Documents written before the datetime migration still hold ISO strings
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Stored datetimes are naive UTC, query parameters may carry an offset
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def create_access_token(data: dict) -> str:
+    to_encode = data.copy()
+    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+PRINCIPAL_FIELDS = ["email", "name", "phone", "role"]
+
+class PrincipalCache:
+    """Recently authenticated users without their balance, expiring after `ttl_seconds`."""
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        return dict(entry[1])
+
+    def put(self, user: dict) -> dict:
+        principal = {field: user.get(field) for field in ["_id", *PRINCIPAL_FIELDS]}
+        user_id = str(user["_id"])
+        self.entries[user_id] = (time.monotonic(), principal)
+        self.entries.move_to_end(user_id)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return dict(principal)
+
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_MAX_ENTRIES, PRINCIPAL_CACHE_TTL_SECONDS)
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    storage: Storage = Depends(get_storage)
+):
+    token = credentials.credentials
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = payload.get("sub")
+        if user_id is None:
+            raise HTTPException(status_code=401, detail="Token inválido")
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expirado")
+    except jwt.InvalidTokenError:
+        # Quote tokens land here too, they carry an audience
+        raise HTTPException(status_code=401, detail="Token inválido")
+    
+    # The principal only, handlers that need the balance read it with get_credits.
+    # Admin checks never trust a cached role: roles change outside this process
+    principal = principal_cache.get(user_id)
+    if principal is None or principal["role"] == "admin":
+        user = await storage.users.get(user_id)
+        if user is None:
+            principal_cache.invalidate(user_id)
+            raise HTTPException(status_code=401, detail="Usuário não encontrado")
+        principal = principal_cache.put(user)
+    return principal
+
+# Stock helpers
+# Every product keeps a `reserved` counter with the quantity held by carts, so
+# the available stock is read straight from the product document instead of
+# scanning stock_holds.
+async def take_stock(storage: Storage, user_id: str, product_id: str, quantity: int) -> bool:
+    # Consume the user's active hold for this product (if any) and decrement the stock.
+    # Quantity beyond the hold must still be available to everyone else.
+    hold = await storage.holds.take(user_id, product_id)
+    held = hold["quantity"] if hold else 0
+    
+    if not await storage.products.take(product_id, quantity, held):
+        if held:
+            await storage.products.release(product_id, held)
+        return False
+    return True
+
+async def release_expired_holds() -> int:
+    # find_one_and_delete makes sure each expired hold is released exactly once,
+    # even with several workers sweeping at the same time.
+    storage = get_storage()
+    released = 0
+    while True:
+        hold = await storage.holds.pop_expired()
+        if hold is None:
+            return released
+        await storage.products.release(hold["product_id"], hold["quantity"])
+        catalog_changed(hold["event_id"], stock_only=True)
+        released += 1
+
+async def stock_hold_sweeper():
+    while True:
+        try:
+            released = await release_expired_holds()
+            if released:
+                logger.info("Released %d expired stock holds", released)
+        except Exception:
+            logger.exception("Stock hold sweep failed")
+        await asyncio.sleep(STOCK_HOLD_SWEEP_INTERVAL_SECONDS)
+
+# Order ingestion queue
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class OrderIngestionQueue:
+    """Write-behind queue for orders.
+
+    Every accepted order is appended to a local NDJSON journal before it is
+    acknowledged, then inserted with insert_many (after its outbox entries) by
+    a batcher once the batch is full or the interval ends.
+    Orders carry their _id from the start, so replaying the journal after a
+    crash skips the ones that already reached Mongo.
+
+    Each worker process has its own journal (`path` suffixed with the PID), so
+    truncating it never drops another worker's orders. At start a worker takes
+    over the journals of workers that are gone (renaming them first, so only
+    one worker replays each). Appends are group-committed: orders submitted
+    while a write is in progress go out together in the next write, one fsync
+    each, on a thread so the event loop never waits on the disk.
+    """
+
+    def __init__(self, path: Path, batch_size: int, interval_ms: int, fsync: bool):
+        self.base_path = path
+        self.path = path.with_name(f"{path.name}.{os.getpid()}")
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self.fsync = fsync
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending = {}  # order id -> order document not yet persisted
+        self.persisted = 0
+        self.batches = 0
+        self.journal_writes = 0
+        self._journal = None
+        self._task = None
+        self._unwritten = []  # (order, line, future) waiting for the next journal write
+        self._writer = None
+
+    def _orphaned_journals(self) -> List[Path]:
+        # The shared journal of older versions and the journals of dead workers
+        journals = [self.base_path] if self.base_path.exists() else []
+        for journal_path in self.base_path.parent.glob(self.base_path.name + ".*"):
+            pid = journal_path.name[len(self.base_path.name) + 1:].split(".")[0]
+            if pid.isdigit() and (int(pid) == os.getpid() or not process_alive(int(pid))):
+                journals.append(journal_path)
+        return journals
+
+    async def start(self):
+        lines = []
+        claimed = []
+        for i, journal_path in enumerate(self._orphaned_journals()):
+            claim = self.path.with_name(f"{self.path.name}.claimed-{i}")
+            try:
+                os.rename(journal_path, claim)
+            except FileNotFoundError:
+                continue  # taken over by another worker
+            claimed.append(claim)
+            with open(claim) as journal:
+                lines += [line if line.endswith("\n") else line + "\n" for line in journal if line.strip()]
+        self._journal = open(self.path, "a")
+        if lines:
+            # Into this worker's journal before the claimed files go away
+            self._write_journal(lines)
+        for claim in claimed:
+            os.unlink(claim)
+        
+        for order in map(self._load, lines):
+            self.pending[str(order["_id"])] = order
+            self.queue.put_nowait(order)
+        if lines:
+            logger.info("Replaying %d journaled orders", len(lines))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            await asyncio.shield(self._writer)
+        # Everything not persisted yet, the batch the batcher was holding included
+        # (inserts and outbox entries already stored are skipped)
+        batch = list(self.pending.values())
+        if batch:
+            await self._flush(batch)
+        if self._journal:
+            self._journal.close()
+            if not self.pending:
+                self.path.unlink(missing_ok=True)
+
+    async def submit(self, order: dict):
+        """Returns once the order is in the journal and queued."""
+        entry = dict(order, _id=str(order["_id"]), created_at=order["created_at"].isoformat())
+        written = asyncio.get_running_loop().create_future()
+        self._unwritten.append((order, json.dumps(entry) + "\n", written))
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_unwritten())
+        await written
+
+    async def _write_unwritten(self):
+        try:
+            while self._unwritten:
+                group, self._unwritten = self._unwritten, []
+                try:
+                    await asyncio.to_thread(self._write_journal, [line for _, line, _ in group])
+                except Exception as e:
+                    for _, _, written in group:
+                        if not written.done():
+                            written.set_exception(e)
+                    continue
+                # Queued here rather than by submit, a client gone meanwhile does not lose its order
+                for order, _, written in group:
+                    self.pending[str(order["_id"])] = order
+                    self.queue.put_nowait(order)
+                    if not written.done():
+                        written.set_result(None)
+        finally:
+            self._writer = None
+
+    def _write_journal(self, lines: List[str]):
+        self._journal.writelines(lines)
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self.journal_writes += 1
+
+    def get(self, order_id: str) -> Optional[dict]:
+        return self.pending.get(order_id)
+
+    def stats(self) -> dict:
+        return {
+            "mode": ORDER_INGESTION_MODE,
+            "queued": len(self.pending),
+            "persisted": self.persisted,
+            "batches": self.batches,
+            "journal_writes": self.journal_writes
+        }
+
+    def _load(self, line: str) -> dict:
+        order = json.loads(line)
+        order["_id"] = ObjectId(order["_id"])
+        order["created_at"] = datetime.fromisoformat(order["created_at"])
+        return order
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            while True:
+                try:
+                    await self._flush(batch)
+                    break
+                except Exception:
+                    logger.exception("Order batch flush failed, retrying %d orders", len(batch))
+                    await asyncio.sleep(1)
+
+    async def _flush(self, batch: List[dict]):
+        await order_outbox.add([entry for entry in map(order_outbox.entry, batch) if entry])
+        # Orders replayed from the journal may already be stored, they are skipped
+        await get_storage().orders.insert_many(batch)
+        
+        order_outbox.notify()
+        for order in batch:
+            self.pending.pop(str(order["_id"]), None)
+        self.persisted += len(batch)
+        self.batches += 1
+        
+        # Everything journaled so far is in Mongo, start a fresh journal. Not while
+        # a write is in progress on the writer thread, the next flush does it then
+        if not self.pending and self._writer is None and self._journal:
+            self._journal.truncate(0)
+
+order_ingestion = OrderIngestionQueue(
+    ORDER_OUTBOX_PATH, ORDER_BATCH_SIZE, ORDER_BATCH_INTERVAL_MS, ORDER_OUTBOX_FSYNC
+)
+
+# Outbox effects. Each one gets the entries of a batch and must be idempotent: a
+# batch is retried as a whole and a replayed journal can enqueue an entry twice.
+# Credits are debited by create_order itself, debit_credits only serves entries
+# written before that.
+async def debit_credits(entries: List[dict]):
+    await get_storage().credits.debit_orders(entries)
+
+async def write_credit_ledger(entries: List[dict]):
+    await get_storage().credits.record_purchases(entries)
+
+OUTBOX_EFFECTS = {
+    "debit_credits": debit_credits,
+    "credit_ledger": write_credit_ledger,
+}
+
+class OrderOutbox:
+    """Durable post-order side effects.
+
+    An entry (keyed by the order id) is inserted before its order. The dispatcher
+    leases due entries in batches, skips those whose order is not in Mongo yet,
+    runs every effect over the batch and deletes the entries that are done.
+    Failed effects are retried with exponential backoff, entries that still fail
+    after `max_attempts` move to `outbox_dead_letter`.
+    """
+
+    def __init__(self, batch_size: int, poll_interval_ms: int, max_attempts: int, lease_seconds: int, orphan_seconds: int):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval_ms / 1000
+        self.max_attempts = max_attempts
+        self.lease = timedelta(seconds=lease_seconds)
+        self.orphan_age = timedelta(seconds=orphan_seconds)
+        self.worker_id = uuid.uuid4().hex
+        self.dispatched = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.orphaned = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def entry(self, order: dict) -> Optional[dict]:
+        effects = []
+        if order["credits_used"] > 0:
+            effects.append("credit_ledger")
+        if not effects:
+            return None
+        return {
+            "_id": order["_id"],
+            "user_id": order["user_id"],
+            "event_id": order["event_id"],
+            "credits_used": order["credits_used"],
+            "pending": effects,
+            "attempts": 0,
+            "last_error": None,
+            "next_attempt_at": datetime.utcnow(),
+            "locked_until": datetime.utcnow(),
+            "created_at": order["created_at"]
+        }
+
+    async def add(self, entries: List[dict]):
+        if entries:
+            await get_storage().outbox.add(entries)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "dispatched": self.dispatched,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+            "orphaned": self.orphaned
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                leased = await self.dispatch()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                leased = 0
+            if leased < self.batch_size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def dispatch(self) -> int:
+        storage = get_storage()
+        now = datetime.utcnow()
+        # Lease the batch, other workers skip it until the lease runs out
+        entries = await storage.outbox.lease(now, self.batch_size, self.worker_id, now + self.lease)
+        if not entries:
+            return 0
+        
+        persisted = await storage.orders.existing_ids([entry["_id"] for entry in entries])
+        ready = [entry for entry in entries if entry["_id"] in persisted]
+        orphans = [entry["_id"] for entry in entries if entry["_id"] not in persisted and now - entry["created_at"] > self.orphan_age]
+        waiting = [entry["_id"] for entry in entries if entry["_id"] not in persisted and entry["_id"] not in orphans]
+        
+        errors = {}
+        for effect, apply in OUTBOX_EFFECTS.items():
+            group = [entry for entry in ready if effect in entry["pending"] and entry["_id"] not in errors]
+            if not group:
+                continue
+            try:
+                await apply(group)
+            except Exception as e:
+                logger.warning("outbox effect failed", extra={"effect": effect, "entries": len(group), "error": str(e)})
+                for entry in group:
+                    errors[entry["_id"]] = f"{effect}: {e}"
+                continue
+            for entry in group:
+                entry["pending"].remove(effect)
+        
+        done = [entry["_id"] for entry in ready if entry["_id"] not in errors]
+        if done or orphans:
+            await storage.outbox.delete(done + orphans)
+        if waiting:
+            # The order may still be on its way (queued ingestion, slow insert)
+            await storage.outbox.postpone(waiting, now + timedelta(seconds=1), now)
+        for entry in ready:
+            if entry["_id"] in errors:
+                await self._retry_later(entry, errors[entry["_id"]], now)
+        
+        self.dispatched += len(done)
+        self.orphaned += len(orphans)
+        return len(entries)
+
+    async def _retry_later(self, entry: dict, error: str, now: datetime):
+        outbox = get_storage().outbox
+        attempts = entry["attempts"] + 1
+        if attempts >= self.max_attempts:
+            await outbox.dead_letter(dict(entry, attempts=attempts, last_error=error, failed_at=now))
+            self.dead_lettered += 1
+            logger.error("outbox entry dead-lettered", extra={"order_id": str(entry["_id"]), "error": error})
+            return
+        # Effects that already succeeded are not run again
+        await outbox.update(entry["_id"], {
+            "pending": entry["pending"],
+            "attempts": attempts,
+            "last_error": error,
+            "next_attempt_at": now + timedelta(seconds=min(2 ** attempts, 300)),
+            "locked_until": now
+        })
+        self.retried += 1
+
+order_outbox = OrderOutbox(
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL_MS, OUTBOX_MAX_ATTEMPTS, OUTBOX_LEASE_SECONDS, OUTBOX_ORPHAN_SECONDS
+)
+
+ORDER_RESPONSE_FIELDS = [
+    "user_id", "event_id", "event_name", "items", "subtotal", "platform_fee", "credits_used",
+    "total", "organizer_amount", "payment_status", "qr_code", "status", "created_at"
+]
+
+def order_to_response(order: dict) -> dict:
+    return {
+        "id": str(order["_id"]),
+        "user_id": order["user_id"],
+        "event_id": order["event_id"],
+        "event_name": order["event_name"],
+        "items": order["items"],
+        "subtotal": order["subtotal"],
+        "platform_fee": order["platform_fee"],
+        "credits_used": order.get("credits_used", 0.0),
+        "total": order["total"],
+        "organizer_amount": order["organizer_amount"],
+        "payment_status": order["payment_status"],
+        "qr_code": order["qr_code"],
+        "status": order["status"],
+        "created_at": to_isoformat(order["created_at"])
+    }
+
+def image_variant(document: dict, image: str) -> Optional[str]:
+    # Documents saved before the image pipeline only have the original upload
+    if image == "small":
+        return document.get("image_small") or document.get("image_base64")
+    return document.get("image_base64")
+
+def event_to_response(event: dict, image: str = "large") -> dict:
+    return {
+        "id": str(event["_id"]),
+        "name": event["name"],
+        "description": event["description"],
+        "date": event["date"],
+        "location": event["location"],
+        "latitude": event["geo"]["coordinates"][1] if event.get("geo") else None,
+        "longitude": event["geo"]["coordinates"][0] if event.get("geo") else None,
+        "image_base64": image_variant(event, image),
+        "status": event["status"],
+        "organizer_id": event["organizer_id"],
+        "starts_at": to_isoformat(event.get("starts_at")),
+        "created_at": to_isoformat(event["created_at"])
+    }
+
+def product_to_response(product: dict, image: str = "large") -> dict:
+    return {
+        "id": str(product["_id"]),
+        "event_id": product["event_id"],
+        "name": product["name"],
+        "description": product["description"],
+        "price": product["price"],
+        "stock": product["stock"],
+        "available_stock": available_stock(product),
+        "image_base64": image_variant(product, image),
+        "available": product["available"]
+    }
+
+# Image pipeline (image_variants.py, IMAGE_* settings there)
+async def prepare_upload(image_base64: Optional[str]) -> dict:
+    try:
+        return await prepare_image(image_base64)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Imagem inválida ou muito grande")
+
+# QR rendering
+QR_MEDIA_TYPES = {"svg": "image/svg+xml", "png": "image/png"}
+
+class LRUCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+qr_cache = LRUCache(QR_CACHE_MAX_ENTRIES)
+
+def check_qr_request(output: str, size: int):
+    if output not in QR_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Formato deve ser svg ou png")
+    if not QR_MIN_SIZE <= size <= QR_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"Tamanho deve estar entre {QR_MIN_SIZE} e {QR_MAX_SIZE}")
+    if image_variants.qrcode is None or (output == "png" and image_variants.Image is None):
+        raise HTTPException(status_code=503, detail="Renderização de QR code indisponível")
+
+async def render_qr(code: str, output: str, size: int) -> bytes:
+    key = (code, output, size)
+    body = qr_cache.get(key)
+    if body is None:
+        body = await asyncio.get_running_loop().run_in_executor(
+            image_pool(), image_variants.render_qr, code, output, size
+        )
+        qr_cache.put(key, body)
+    return body
+
+# Content negotiation
+def accepted_encodings(accept_encoding: str) -> set:
+    encodings = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        quality = params.strip().replace(" ", "")
+        try:
+            if quality.startswith("q=") and float(quality[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        if name:
+            encodings.add(name)
+    return encodings
+
+def negotiate_encoding(accept_encoding: str, available) -> Optional[str]:
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
+# Response compression
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+def is_compressible(content_type: str) -> bool:
+    content_type = content_type.split(";")[0].strip().lower()
+    # Images are already compressed, recompressing them only burns CPU
+    if content_type.startswith("image/"):
+        return False
+    return any(content_type.startswith(allowed) for allowed in COMPRESSION_CONTENT_TYPES)
+
+class CompressionMiddleware:
+    """Negotiated gzip/brotli compression for JSON and text responses.
+
+    Bodies smaller than COMPRESSION_MIN_SIZE, content types outside the
+    allowlist, image responses and responses that already carry a
+    Content-Encoding (such as the menu snapshots) are passed through untouched.
+    """
+
+    def __init__(self, app, min_size: int = 1024):
+        self.app = app
+        self.min_size = min_size
+        self.encodings = {"gzip"} | ({"br"} if brotli is not None else set())
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding, self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        start = None
+        chunks = []
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                headers = {name.lower(): value for name, value in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if b"content-encoding" in headers or not is_compressible(content_type):
+                    await send(message)
+                else:
+                    start = message
+                return
+            
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            
+            if compressor is None and not more_body:
+                # Whole body in a single message, the usual case for JSON responses
+                body = b"".join(chunks) + body
+                if len(body) < self.min_size:
+                    await send(start)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                compressed = compress_body(body, encoding)
+                await send(self._compressed_start(start, encoding, len(compressed)))
+                await send({"type": "http.response.body", "body": compressed})
+                return
+            
+            if compressor is None:
+                chunks.append(body)
+                if sum(len(chunk) for chunk in chunks) < self.min_size:
+                    return
+                # Streaming response past the threshold, compress incrementally
+                compressor = StreamCompressor(encoding)
+                body = b"".join(chunks)
+                await send(self._compressed_start(start, encoding, None))
+            
+            data = compressor.compress(body)
+            if not more_body:
+                data += compressor.flush()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+    def _compressed_start(self, start: dict, encoding: str, length: Optional[int]) -> dict:
+        headers = []
+        vary = []
+        for name, value in start.get("headers", []):
+            if name.lower() == b"vary":
+                vary += [field.strip() for field in value.split(b",") if field.strip()]
+            elif name.lower() != b"content-length":
+                headers.append((name, value))
+        if b"accept-encoding" not in (field.lower() for field in vary):
+            vary.append(b"Accept-Encoding")
+        headers.append((b"content-encoding", encoding.encode()))
+        headers.append((b"vary", b", ".join(vary)))
+        if length is not None:
+            headers.append((b"content-length", str(length).encode()))
+        return dict(start, headers=headers)
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+# Menu snapshots
+def precompress(body: bytes, gzip_level: int = 9, brotli_quality: int = 11) -> dict:
+    # Defaults to the best ratio, for bodies built once and served many times.
+    # CPU heavy (brotli 11 takes about a second per MB), run it off the event loop
+    bodies = {None: body, "gzip": gzip.compress(body, compresslevel=gzip_level)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body, quality=brotli_quality)
+    return bodies
+
+def render_menu(version: int, event: dict, products: List[dict], gzip_level: int, brotli_quality: int) -> dict:
+    body = json.dumps({
+        "version": version,
+        "event": event_to_response(event),
+        "products": [product_to_response(product, image="small") for product in products]
+    }, separators=(",", ":")).encode()
+    return precompress(body, gzip_level, brotli_quality)
+
+class MenuSnapshot:
+    def __init__(self, event_id: str, version: int, bodies: dict, event: dict, products: List[dict]):
+        self.event_id = event_id
+        self.version = version
+        self.etag = f'"{event_id}-{version}"'
+        self.built_at = datetime.utcnow()
+        self.bodies = bodies
+        self.event_name = event["name"]
+        # Price table for quotes, stock is only indicative (create_order takes it atomically)
+        self.prices = {
+            str(product["_id"]): {
+                "name": product["name"],
+                "price": product["price"],
+                "available": product["available"],
+                "available_stock": available_stock(product),
+            }
+            for product in products
+        }
+
+class MenuSnapshotStore:
+    """In-memory, precompressed snapshots of each event and its full menu."""
+
+    def __init__(self, debounce_ms: int, max_age_seconds: int):
+        self.debounce = debounce_ms / 1000
+        self.max_age = timedelta(seconds=max_age_seconds)
+        self.snapshots = {}
+        self.versions = {}
+        self._scheduled = {}
+
+    def get(self, event_id: str) -> Optional[MenuSnapshot]:
+        snapshot = self.snapshots.get(event_id)
+        # Writes made by other workers only show up after a rebuild
+        if snapshot and datetime.utcnow() - snapshot.built_at > self.max_age:
+            self.schedule(event_id)
+        return snapshot
+
+    async def build(self, event_id: str, best: bool = False) -> Optional[MenuSnapshot]:
+        storage = get_storage()
+        event = await storage.events.get(event_id)
+        if not event:
+            self.drop(event_id)
+            return None
+        products = await storage.products.list_by_event(event_id)
+        
+        version = self.versions.get(event_id, 0) + 1
+        self.versions[event_id] = version
+        levels = (9, 11) if best else (MENU_SNAPSHOT_GZIP_LEVEL, MENU_SNAPSHOT_BROTLI_QUALITY)
+        bodies = await asyncio.to_thread(render_menu, version, event, products, *levels)
+        
+        snapshot = MenuSnapshot(event_id, version, bodies, event, products)
+        # A build started later may have finished first
+        current = self.snapshots.get(event_id)
+        if current is None or current.version < version:
+            self.snapshots[event_id] = snapshot
+        return snapshot
+
+    def schedule(self, event_id: str, delay: Optional[float] = None):
+        delay = self.debounce if delay is None else delay
+        due = asyncio.get_running_loop().time() + delay
+        scheduled = self._scheduled.get(event_id)
+        if scheduled:
+            if scheduled[1] <= due:
+                return
+            # A content change does not wait for a pending stock-only rebuild
+            scheduled[0].cancel()
+        self._scheduled[event_id] = (start_background_task(self._rebuild_later(event_id, delay)), due)
+
+    def drop(self, event_id: str):
+        self.snapshots.pop(event_id, None)
+
+    async def build_active(self, best: bool = False):
+        events = await get_storage().events.list(status="active", fields=["_id"], limit=1000)
+        for event in events:
+            await self.build(str(event["_id"]), best)
+
+    async def _rebuild_later(self, event_id: str, delay: float):
+        # Only cancelled while sleeping, the entry is replaced by then
+        await asyncio.sleep(delay)
+        del self._scheduled[event_id]
+        try:
+            await self.build(event_id)
+        except Exception:
+            logger.exception("Menu snapshot rebuild failed for event %s", event_id)
+
+menu_snapshots = MenuSnapshotStore(MENU_SNAPSHOT_DEBOUNCE_MS, MENU_SNAPSHOT_MAX_AGE_SECONDS)
+
+# Static catalog
+PUBLISHED_SUFFIXES = {None: "", "gzip": ".gz", "br": ".br"}
+VERSIONED_FILE = re.compile(r"\.[0-9a-f]{16}\.json(\.gz|\.br)?$")
+EVENT_FILE = re.compile(r"events/([^/]+)(/products)?\.json")
+
+def catalog_surrogate_keys(path: str) -> List[str]:
+    match = EVENT_FILE.fullmatch(path)
+    if match is None:
+        return ["catalog", "events"]
+    event_id = match.group(1)
+    return ["catalog", f"event-{event_id}"] + ([f"products-{event_id}"] if match.group(2) else [])
+
+class CatalogPublisher:
+    """Writes the public catalog as static, precompressed JSON files.
+
+    Every document is written twice: `events/<id>/products.<hash>.json`, immutable
+    and never rewritten, and `events/<id>/products.json`, the current version under
+    the API path. `manifest.json` maps each path to its current version, cache
+    headers and surrogate keys. Writes are batched every CATALOG_PUBLISH_DEBOUNCE_MS.
+
+    Every worker publishes the writes it handles into the same directory, so the
+    manifest is rebuilt from the files on disk (the current version of a path is
+    the hash of its file), never from what one process wrote. Writers take a lock
+    file in the directory, and a version is only removed once it is neither
+    current nor listed in the manifest being replaced.
+    """
+
+    def __init__(self, root: Optional[str], debounce_ms: int, max_age_seconds: int):
+        self.root = Path(root) if root else None
+        self.debounce = debounce_ms / 1000
+        self.cache_control = f"public, max-age={max_age_seconds}, stale-while-revalidate=60, stale-if-error=86400"
+        self.manifest = {}
+        self.published = 0
+        self._dirty_events = set()
+        self._dirty_lists = False
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def schedule(self, event_id: str, event_list: bool = False):
+        if not self.enabled:
+            return
+        self._dirty_events.add(event_id)
+        self._dirty_lists = self._dirty_lists or event_list
+        if self._task is None:
+            self._task = start_background_task(self._publish_later())
+
+    async def publish_all(self):
+        events = await self._publish_lists()
+        for event in events:
+            await self._publish_event(str(event["_id"]), event)
+        await self._write_manifest()
+
+    async def _publish_later(self):
+        await asyncio.sleep(self.debounce)
+        event_ids, self._dirty_events = self._dirty_events, set()
+        event_list, self._dirty_lists = self._dirty_lists, False
+        self._task = None
+        try:
+            if event_list:
+                await self._publish_lists()
+            for event_id in event_ids:
+                await self._publish_event(event_id)
+            await self._write_manifest()
+        except Exception:
+            logger.exception("Catalog publish failed")
+            # Try again with the next write
+            self._dirty_events |= event_ids
+            self._dirty_lists = self._dirty_lists or event_list
+
+    async def _publish_lists(self) -> list:
+        events = await get_storage().events.list()
+        responses = [event_to_response(event, image="small") for event in events]
+        await self._publish("events.json", catalog_body(responses))
+        statuses = {event["status"] for event in responses}
+        for status in statuses:
+            await self._publish(
+                f"events/status/{status}.json",
+                catalog_body([event for event in responses if event["status"] == status])
+            )
+        # Statuses no event has anymore publish an empty list
+        for path in await asyncio.to_thread(self._current_files):
+            if path.startswith("events/status/") and path[len("events/status/"):-len(".json")] not in statuses:
+                await self._publish(path, catalog_body([]))
+        return events
+
+    async def _publish_event(self, event_id: str, event: Optional[dict] = None):
+        storage = get_storage()
+        event = event or await storage.events.get(event_id)
+        if event is None:
+            for path in (f"events/{event_id}.json", f"events/{event_id}/products.json"):
+                await self._unpublish(path)
+            return
+        products = await storage.products.list_by_event(event_id)
+        await self._publish(f"events/{event_id}.json", catalog_body(event_to_response(event)))
+        await self._publish(
+            f"events/{event_id}/products.json",
+            catalog_body([product_to_response(product, image="small") for product in products])
+        )
+
+    async def _publish(self, path: str, body: bytes):
+        if await asyncio.to_thread(self._write_files, path, body):
+            self.published += 1
+
+    async def _unpublish(self, path: str):
+        # Its versions go with the next manifest
+        await asyncio.to_thread(self._remove_current, path)
+
+    async def _write_manifest(self):
+        self.manifest = await asyncio.to_thread(self._rebuild_manifest)
+
+    @contextmanager
+    def _locked(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / ".publish.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write_files(self, path: str, body: bytes) -> bool:
+        version = hashlib.sha256(body).hexdigest()[:16]
+        if self._current_version(path) == version:
+            return False
+        versioned = f"{path[:-len('.json')]}.{version}.json"
+        bodies = precompress(body)
+        with self._locked():
+            # The versioned file first, the current one never points at a missing version
+            for encoding, content in bodies.items():
+                self._write(versioned + PUBLISHED_SUFFIXES[encoding], content)
+            for encoding, content in bodies.items():
+                self._write(path + PUBLISHED_SUFFIXES[encoding], content)
+        return True
+
+    def _remove_current(self, path: str):
+        with self._locked():
+            self._remove_files(path)
+
+    def _rebuild_manifest(self) -> dict:
+        with self._locked():
+            try:
+                replaced = json.loads((self.root / "manifest.json").read_bytes())["files"]
+            except (FileNotFoundError, ValueError, KeyError):
+                replaced = {}
+            manifest = {}
+            for path, version in self._current_files().items():
+                manifest[path] = {
+                    "version": version,
+                    "file": f"{path[:-len('.json')]}.{version}.json",
+                    "etag": f'"{version}"',
+                    "surrogate_keys": catalog_surrogate_keys(path),
+                    "cache_control": self.cache_control,
+                }
+            self._write("manifest.json", json.dumps({
+                "generated_at": datetime.utcnow().isoformat(),
+                "immutable_cache_control": "public, max-age=31536000, immutable",
+                "files": manifest
+            }, separators=(",", ":")).encode())
+            # Clients holding the replaced manifest may still fetch the versions it lists
+            keep = {entry["file"] for entry in manifest.values()} | {entry["file"] for entry in replaced.values()}
+            self._sweep(keep)
+        return manifest
+
+    def _current_version(self, path: str) -> Optional[str]:
+        try:
+            return hashlib.sha256((self.root / path).read_bytes()).hexdigest()[:16]
+        except FileNotFoundError:
+            return None
+
+    def _current_files(self) -> dict:
+        """Path -> version of every current (unversioned, uncompressed) file on disk."""
+        files = {}
+        for file in self.root.rglob("*.json"):
+            path = file.relative_to(self.root).as_posix()
+            if path != "manifest.json" and not VERSIONED_FILE.search(path):
+                version = self._current_version(path)
+                if version is not None:
+                    files[path] = version
+        return files
+
+    def _write(self, path: str, content: bytes):
+        # Readers only ever see a complete file
+        target = self.root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temporary = target.with_name(f".{target.name}.tmp")
+        temporary.write_bytes(content)
+        os.replace(temporary, target)
+
+    def _remove_files(self, path: str):
+        for suffix in PUBLISHED_SUFFIXES.values():
+            (self.root / (path + suffix)).unlink(missing_ok=True)
+
+    def _sweep(self, keep: set):
+        for file in self.root.rglob("*.json*"):
+            path = file.relative_to(self.root).as_posix()
+            if VERSIONED_FILE.search(path) and re.sub(r"(\.gz|\.br)$", "", path) not in keep:
+                file.unlink(missing_ok=True)
+
+catalog_publisher = CatalogPublisher(CATALOG_PUBLISH_DIR, CATALOG_PUBLISH_DEBOUNCE_MS, CATALOG_PUBLISH_MAX_AGE_SECONDS)
+
+def catalog_changed(event_id: str, event_list: bool = False, stock_only: bool = False):
+    # Products carry available_stock, so stock changes count as catalog writes
+    menu_snapshots.schedule(event_id, MENU_SNAPSHOT_STOCK_DEBOUNCE_MS / 1000 if stock_only else None)
+    catalog_publisher.schedule(event_id, event_list)
+
+# Catalog search
+SEARCH_FIELD_WEIGHTS = {
+    "event": {"name": 3.0, "location": 2.0, "description": 1.0},
+    "product": {"name": 3.0, "description": 1.0},
+}
+SEARCH_TOKEN = re.compile(r"\w+")
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_EXPANSIONS = 50  # indexed words a prefix expands to, the most common first
+SEARCH_FUZZY_MIN_SIMILARITY = 0.4
+
+def normalize_text(text: Optional[str]) -> str:
+    # "Café" and "cafe" are the same word for someone typing on a phone
+    decomposed = unicodedata.normalize("NFKD", (text or "").casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def search_tokens(text: Optional[str]) -> List[str]:
+    return SEARCH_TOKEN.findall(normalize_text(text))
+
+def trigrams(token: str) -> set:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchState:
+    """One build of the search index. Never modified, SearchIndex swaps in a new one."""
+
+    def __init__(self, events: List[dict], products: List[dict]):
+        self.built_at = datetime.utcnow()
+        events_by_id = {str(event["_id"]): event for event in events}
+        self.documents = [{
+            "type": "event",
+            "id": str(event["_id"]),
+            "name": event["name"],
+            "description": event.get("description"),
+            "location": event.get("location"),
+            "date": event.get("date"),
+            "starts_at": to_isoformat(event.get("starts_at")),
+            "status": event.get("status"),
+        } for event in events]
+        for product in products:
+            event = events_by_id.get(product["event_id"])
+            if event is None:
+                continue
+            self.documents.append({
+                "type": "product",
+                "id": str(product["_id"]),
+                "event_id": product["event_id"],
+                "event_name": event["name"],
+                "event_status": event.get("status"),
+                "name": product["name"],
+                "description": product.get("description"),
+                "price": product["price"],
+                "available": product.get("available", True),
+            })
+        
+        # word -> {document position: weight of the best field it appears in}
+        self.postings = {}
+        for position, document in enumerate(self.documents):
+            for field, weight in SEARCH_FIELD_WEIGHTS[document["type"]].items():
+                for token in set(search_tokens(document.get(field))):
+                    entry = self.postings.setdefault(token, {})
+                    entry[position] = max(entry.get(position, 0.0), weight)
+        self.vocabulary = sorted(self.postings)
+        self.trigrams = {}
+        for token in self.vocabulary:
+            for gram in trigrams(token):
+                self.trigrams.setdefault(gram, []).append(token)
+        self.idf = {token: math.log(1 + len(self.documents) / len(entry)) for token, entry in self.postings.items()}
+
+    def expand(self, term: str) -> dict:
+        """Indexed words matching a query word, with how close each match is (0 to 1)."""
+        matches = {term: 1.0} if term in self.postings else {}
+        # A single letter would expand to a good part of the vocabulary
+        if len(term) < SEARCH_MIN_PREFIX:
+            return matches
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + "\uffff")
+        prefixed = self.vocabulary[start:end]
+        if len(prefixed) > SEARCH_MAX_EXPANSIONS:
+            prefixed = heapq.nlargest(SEARCH_MAX_EXPANSIONS, prefixed, key=lambda token: len(self.postings[token]))
+        for token in prefixed:
+            matches.setdefault(token, 0.5 + 0.5 * len(term) / len(token))
+        if matches or len(term) < 3:
+            return matches
+        
+        # Nothing starts with it, likely a typo: words sharing most of its trigrams
+        grams = trigrams(term)
+        shared = Counter(token for gram in grams for token in self.trigrams.get(gram, ()))
+        for token, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(token)) - count)
+            if similarity >= SEARCH_FUZZY_MIN_SIMILARITY:
+                matches[token] = 0.5 * similarity
+        return matches
+
+    def rank(self, query: str, kind: Optional[str], event_id: Optional[str], status: Optional[str]) -> List[tuple]:
+        """(score, document) of every document matching all words of `query`."""
+        scores = None
+        for term in dict.fromkeys(search_tokens(query)):
+            term_scores = {}
+            for token, closeness in self.expand(term).items():
+                idf = self.idf[token]
+                for position, weight in self.postings[token].items():
+                    score = weight * idf * closeness
+                    if score > term_scores.get(position, 0.0):
+                        term_scores[position] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {position: score + term_scores[position] for position, score in scores.items() if position in term_scores}
+            if not scores:
+                return []
+        
+        hits = []
+        for position, score in (scores or {}).items():
+            document = self.documents[position]
+            is_event = document["type"] == "event"
+            if kind and document["type"] != kind:
+                continue
+            if event_id and (document["id"] if is_event else document["event_id"]) != event_id:
+                continue
+            if status and (document["status"] if is_event else document["event_status"]) != status:
+                continue
+            hits.append((score, document))
+        return hits
+
+    def search(self, query: str, kind: Optional[str] = None, event_id: Optional[str] = None,
+               status: Optional[str] = None, limit: int = 20, offset: int = 0) -> tuple:
+        hits = self.rank(query, kind, event_id, status)
+        page = heapq.nsmallest(offset + limit, hits, key=lambda hit: (-hit[0], hit[1]["name"]))[offset:]
+        return len(hits), page
+
+    def suggest(self, query: str, kind: Optional[str] = None, event_id: Optional[str] = None,
+                status: Optional[str] = None, limit: int = 8) -> List[dict]:
+        hits = self.rank(query, kind, event_id, status)
+        # The same product name shows up once per event, suggest it once
+        suggestions = {}
+        for score, document in heapq.nsmallest(limit * 4, hits, key=lambda hit: (-hit[0], hit[1]["name"])):
+            key = (document["type"], normalize_text(document["name"]))
+            if key not in suggestions:
+                suggestions[key] = {"text": document["name"], "type": document["type"], "id": document["id"]}
+                if len(suggestions) == limit:
+                    break
+        return list(suggestions.values())
+
+class SearchIndex:
+    """In-memory search over event name, location and description and product name and description.
+
+    Words are matched by prefix, so it also serves autocomplete, accents and case
+    are ignored and a word nothing starts with falls back to trigram similarity.
+    Each build reads the whole catalog and replaces the index at once.
+    """
+
+    def __init__(self, debounce_ms: int, max_age_seconds: int):
+        self.debounce = debounce_ms / 1000
+        self.max_age = timedelta(seconds=max_age_seconds)
+        self.state = None
+        self.builds = 0
+        self._task = None
+
+    async def current(self) -> SearchState:
+        if self.state is None:
+            if not db_breaker.allow():
+                raise service_unavailable()
+            await self.build()
+        elif datetime.utcnow() - self.state.built_at > self.max_age:
+            # Writes made by other workers only show up after a rebuild
+            self.schedule()
+        return self.state
+
+    async def build(self):
+        # Requests arriving before the first build share it
+        await catalog_flights.do(("search_index",), self._build)
+
+    async def _build(self):
+        storage = get_storage()
+        events = await storage.events.list(fields=["name", "description", "location", "date", "starts_at", "status"])
+        products = await storage.products.list(fields=["event_id", "name", "description", "price", "available"])
+        self.state = await asyncio.to_thread(SearchState, events, products)
+        self.builds += 1
+
+    def schedule(self):
+        if self._task is None:
+            self._task = start_background_task(self._rebuild_later())
+
+    async def _rebuild_later(self):
+        await asyncio.sleep(self.debounce)
+        self._task = None
+        try:
+            await self.build()
+        except Exception:
+            logger.exception("Search index rebuild failed")
+
+    def stats(self) -> dict:
+        if self.state is None:
+            return {"builds": self.builds, "documents": 0, "words": 0, "built_at": None}
+        return {
+            "builds": self.builds,
+            "documents": len(self.state.documents),
+            "words": len(self.state.vocabulary),
+            "built_at": self.state.built_at.isoformat(),
+        }
+
+search_index = SearchIndex(SEARCH_INDEX_DEBOUNCE_MS, SEARCH_INDEX_MAX_AGE_SECONDS)
+
+# Cache warm-up
+class CacheWarmup:
+    """Fills the in-process caches after startup, within a time budget.
+
+    The steps run concurrently in the background so the worker starts at once,
+    `ready` turns true when they are all done or the budget is spent (the caches
+    left cold then fill on demand, as before).
+    """
+
+    def __init__(self, budget_seconds: float):
+        self.budget = budget_seconds
+        self.ready = False
+        self.steps = {}
+        self.duration_ms = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self):
+        started = time.perf_counter()
+        steps = {
+            "catalog": self.warm_catalog,
+            "menus": self.warm_menus,
+            "search": self.warm_search,
+            "principals": self.warm_principals,
+        }
+        tasks = {asyncio.create_task(self._step(name, step)): name for name, step in steps.items()}
+        _, pending = await asyncio.wait(tasks, timeout=self.budget)
+        for task in pending:
+            task.cancel()
+            self.steps[tasks[task]] = {"status": "timed_out"}
+        self.duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.ready = True
+        logger.info("cache warm-up finished", extra={"duration_ms": self.duration_ms, "steps": self.steps})
 
-# JWT Configuration
-SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+    async def _step(self, name: str, step):
+        started = time.perf_counter()
+        try:
+            items = await step()
+        except Exception:
+            logger.exception("Cache warm-up step %s failed", name)
+            self.steps[name] = {"status": "failed"}
+            return
+        self.steps[name] = {
+            "status": "done", "items": items, "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+        }
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-security = HTTPBearer()
+    async def warm_catalog(self) -> int:
+        # Gives the last-known-good fallback something to serve from the first second
+        storage = get_storage()
+        events = await storage.events.list(status="active", fields=["_id"], limit=1000)
+        await get_events("active", storage)
+        await get_events(None, storage)
+        for event in events:
+            await get_event_products(str(event["_id"]), storage)
+        return len(events)
 
-# Create the main app
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+    async def warm_menus(self) -> int:
+        # Menu snapshots are also the price tables of quotes
+        await menu_snapshots.build_active(best=True)
+        return len(menu_snapshots.snapshots)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+    async def warm_search(self) -> int:
+        await search_index.build()
+        return len(search_index.state.documents)
 
-# Helper functions
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    async def warm_principals(self) -> int:
+        storage = get_storage()
+        since = datetime.utcnow() - timedelta(hours=WARMUP_PRINCIPAL_HOURS)
+        user_ids = await storage.orders.recent_user_ids(since, WARMUP_PRINCIPAL_LIMIT)
+        users = await storage.users.get_many(user_ids, fields=PRINCIPAL_FIELDS) if user_ids else []
+        # Least recent first, so the most recent buyers end up last in the LRU order
+        for user in reversed(users):
+            principal_cache.put(user)
+        return len(users)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    def stats(self) -> dict:
+        return {"ready": self.ready, "duration_ms": self.duration_ms, "steps": self.steps}
 
-def create_access_token(data: dict) -> str:
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+cache_warmup = CacheWarmup(WARMUP_BUDGET_SECONDS)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Token inválido")
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expirado")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Token inválido")
-    
-    user = await db.users.find_one({"_id": ObjectId(user_id)})
-    if user is None:
-        raise HTTPException(status_code=401, detail="Usuário não encontrado")
-    return user
+# Sales analytics
+ANALYTICS_BUCKETS = {
+    "5m": ("minute", 5, timedelta(minutes=5)),
+    "15m": ("minute", 15, timedelta(minutes=15)),
+    "hour": ("hour", 1, timedelta(hours=1)),
+    "day": ("day", 1, timedelta(days=1)),
+}
+# $dateTrunc counts bins from this reference date
+ANALYTICS_EPOCH = datetime(2000, 1, 1)
+
+def truncate_to_bucket(value: datetime, bucket: str) -> datetime:
+    size = ANALYTICS_BUCKETS[bucket][2]
+    return ANALYTICS_EPOCH + ((value - ANALYTICS_EPOCH) // size) * size
+
+def date_trunc(field: str, bucket: str) -> dict:
+    unit, bin_size, _ = ANALYTICS_BUCKETS[bucket]
+    return {"$dateTrunc": {"date": field, "unit": unit, "binSize": bin_size}}
+
+class SalesAnalyticsCache:
+    """Per-event, per-bucket sales series.
+
+    Buckets that ended more than ANALYTICS_CLOSE_GRACE_SECONDS ago are closed:
+    they are kept in memory and never queried again. Each refresh only
+    aggregates orders from the oldest open bucket onwards.
+    """
+
+    def __init__(self, grace_seconds: int):
+        self.grace = timedelta(seconds=grace_seconds)
+        self.series = {}
+
+    async def get(self, event_id: str, bucket: str) -> dict:
+        series = self.series.get((event_id, bucket))
+        if series is None:
+            series = {"closed_until": ANALYTICS_EPOCH, "sales": {}, "validations": {}, "products": {}}
+            self.series[(event_id, bucket)] = series
+        
+        since = series["closed_until"]
+        sales, validations, products = await asyncio.gather(
+            self._aggregate_sales(event_id, bucket, since),
+            self._aggregate_validations(event_id, bucket, since),
+            self._aggregate_products(event_id, bucket, since)
+        )
+        for name, fresh in (("sales", sales), ("validations", validations), ("products", products)):
+            kept = {start: value for start, value in series[name].items() if start < since}
+            kept.update(fresh)
+            series[name] = kept
+        
+        series["closed_until"] = truncate_to_bucket(datetime.utcnow() - self.grace, bucket)
+        return series
+
+    async def _aggregate_sales(self, event_id: str, bucket: str, since: datetime) -> dict:
+        pipeline = [
+            {"$match": {"event_id": event_id, "payment_status": "paid", "created_at": {"$gte": since}}},
+            {"$group": {
+                "_id": date_trunc("$created_at", bucket),
+                "orders": {"$sum": 1},
+                "total": {"$sum": "$total"},
+                "subtotal": {"$sum": "$subtotal"},
+                "platform_fee": {"$sum": "$platform_fee"}
+            }}
+        ]
+        rows = await reports_db.orders.aggregate(pipeline).to_list(None)
+        return {row.pop("_id"): row for row in rows}
+
+    async def _aggregate_validations(self, event_id: str, bucket: str, since: datetime) -> dict:
+        pipeline = [
+            {"$match": {"event_id": event_id, "validated_at": {"$gte": since}}},
+            {"$group": {"_id": date_trunc("$validated_at", bucket), "validated": {"$sum": 1}}}
+        ]
+        rows = await reports_db.orders.aggregate(pipeline).to_list(None)
+        return {row["_id"]: row["validated"] for row in rows}
+
+    async def _aggregate_products(self, event_id: str, bucket: str, since: datetime) -> dict:
+        pipeline = [
+            {"$match": {"event_id": event_id, "payment_status": "paid", "created_at": {"$gte": since}}},
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": {"bucket": date_trunc("$created_at", bucket), "product_id": "$items.product_id"},
+                "product_name": {"$first": "$items.product_name"},
+                "units": {"$sum": "$items.quantity"},
+                "revenue": {"$sum": {"$multiply": ["$items.quantity", "$items.unit_price"]}}
+            }}
+        ]
+        products = {}
+        async for row in reports_db.orders.aggregate(pipeline):
+            products.setdefault(row["_id"]["bucket"], {})[row["_id"]["product_id"]] = {
+                "product_name": row["product_name"],
+                "units": row["units"],
+                "revenue": row["revenue"]
+            }
+        return products
+
+sales_analytics = SalesAnalyticsCache(ANALYTICS_CLOSE_GRACE_SECONDS)
+
+def backlog_series(created: list, validated: list) -> list:
+    # Pending orders at the end of each bucket: created so far minus validated so far
+    if np is not None:
+        return np.cumsum(np.array(created) - np.array(validated)).tolist()
+    pending = []
+    total = 0
+    for created_count, validated_count in zip(created, validated):
+        total += created_count - validated_count
+        pending.append(total)
+    return pending
+
+def top_products(buckets: List[dict], sort_by: str, limit: int) -> List[dict]:
+    totals = {}
+    for products in buckets:
+        for product_id, product in products.items():
+            entry = totals.setdefault(product_id, {
+                "product_id": product_id,
+                "product_name": product["product_name"],
+                "units": 0,
+                "revenue": 0.0
+            })
+            entry["units"] += product["units"]
+            entry["revenue"] += product["revenue"]
+    return sorted(totals.values(), key=lambda product: product[sort_by], reverse=True)[:limit]
 
 # Pydantic Models
 class UserRegister(BaseModel):
@@ -94,6 +2199,8 @@ class EventCreate(BaseModel):
     description: str
     date: str
     location: str
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
     image_base64: Optional[str] = None
 
 class EventResponse(BaseModel):
@@ -102,9 +2209,12 @@ class EventResponse(BaseModel):
     description: str
     date: str
     location: str
+    latitude: Optional[float]
+    longitude: Optional[float]
     image_base64: Optional[str]
     status: str
     organizer_id: str
+    starts_at: Optional[str]
     created_at: str
 
 class ProductCreate(BaseModel):
@@ -121,9 +2231,14 @@ class ProductResponse(BaseModel):
     description: str
     price: float
     stock: int
+    available_stock: int
     image_base64: Optional[str]
     available: bool
 
+class StockHoldCreate(BaseModel):
+    product_id: str
+    quantity: int
+
 class OrderItem(BaseModel):
     product_id: str
     product_name: str
@@ -132,9 +2247,23 @@ class OrderItem(BaseModel):
 
 class OrderCreate(BaseModel):
     event_id: str
-    items: List[OrderItem]
+    items: List[OrderItem] = []
+    use_credits: float = 0.0
+    quote_token: Optional[str] = None
+
+class QuoteItem(BaseModel):
+    product_id: str
+    quantity: int
+
+class QuoteRequest(BaseModel):
+    event_id: str
+    items: List[QuoteItem]
     use_credits: float = 0.0
 
+class OrderLookup(BaseModel):
+    order_ids: List[str] = []
+    qr_codes: List[str] = []
+
 class OrderResponse(BaseModel):
     id: str
     user_id: str
@@ -153,9 +2282,9 @@ class OrderResponse(BaseModel):
 
 # AUTH ROUTES
 @api_router.post("/auth/register")
-async def register(user_data: UserRegister):
+async def register(user_data: UserRegister, storage: Storage = Depends(get_storage)):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await storage.users.get_by_email(user_data.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email já cadastrado")
     
@@ -167,11 +2296,10 @@ async def register(user_data: UserRegister):
         "phone": user_data.phone,
         "role": "user",
         "credits": 0.0,
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": datetime.utcnow()
     }
     
-    result = await db.users.insert_one(user_dict)
-    user_id = str(result.inserted_id)
+    user_id = await storage.users.create(user_dict)
     
     # Create token
     token = create_access_token({"sub": user_id, "email": user_data.email})
@@ -189,22 +2317,22 @@ async def register(user_data: UserRegister):
     }
 
 @api_router.post("/auth/login")
-async def login(credentials: UserLogin):
-    user = await db.users.find_one({"email": credentials.email})
-    logger.info(f"Login attempt for: {credentials.email}")
-    logger.info(f"User found: {user is not None}")
+async def login(credentials: UserLogin, storage: Storage = Depends(get_storage)):
+    user = await storage.users.get_by_email(credentials.email)
     
     if not user:
+        logger.info("login failed", extra={"reason": "unknown_user"})
         raise HTTPException(status_code=401, detail="Email ou senha incorretos")
     
     password_valid = verify_password(credentials.password, user["password_hash"])
-    logger.info(f"Password valid: {password_valid}")
     
     if not password_valid:
+        logger.info("login failed", extra={"reason": "wrong_password", "user_id": str(user["_id"])})
         raise HTTPException(status_code=401, detail="Email ou senha incorretos")
     
     user_id = str(user["_id"])
     token = create_access_token({"sub": user_id, "email": user["email"]})
+    logger.info("login", extra={"user_id": user_id})
     
     return {
         "token": token,
@@ -219,194 +2347,364 @@ async def login(credentials: UserLogin):
     }
 
 @api_router.get("/auth/me")
-async def get_me(current_user = Depends(get_current_user)):
+async def get_me(current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     return {
         "id": str(current_user["_id"]),
         "email": current_user["email"],
         "name": current_user["name"],
         "phone": current_user.get("phone"),
         "role": current_user["role"],
-        "credits": current_user.get("credits", 0.0)
+        "credits": await storage.users.get_credits(str(current_user["_id"]))
     }
 
 # EVENT ROUTES
 @api_router.get("/events")
-async def get_events(status: Optional[str] = None):
-    query = {}
-    if status:
-        query["status"] = status
+async def get_events(status: Optional[str] = None, storage: Storage = Depends(get_storage)):
+    async def fetch():
+        events = await storage.events.list(status=status, limit=1000)
+        return catalog_body([event_to_response(event, image="small") for event in events])
     
-    events = await db.events.find(query).to_list(1000)
-    return [{
-        "id": str(event["_id"]),
-        "name": event["name"],
-        "description": event["description"],
-        "date": event["date"],
-        "location": event["location"],
-        "image_base64": event.get("image_base64"),
-        "status": event["status"],
-        "organizer_id": event["organizer_id"],
-        "created_at": event["created_at"]
-    } for event in events]
+    return await catalog_read(("events", status or None), fetch)
+
+def event_geo(event_data: EventCreate) -> Optional[dict]:
+    # GeoJSON, longitude first
+    if event_data.latitude is None and event_data.longitude is None:
+        return None
+    if event_data.latitude is None or event_data.longitude is None:
+        raise HTTPException(status_code=400, detail="Informe latitude e longitude juntas")
+    return {"type": "Point", "coordinates": [event_data.longitude, event_data.latitude]}
 
 @api_router.post("/events")
-async def create_event(event_data: EventCreate, current_user = Depends(get_current_user)):
+async def create_event(event_data: EventCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem criar eventos")
     
+    geo = event_geo(event_data)
+    image = await prepare_upload(event_data.image_base64)
     event_dict = {
         "name": event_data.name,
         "description": event_data.description,
         "date": event_data.date,
         "location": event_data.location,
-        "image_base64": event_data.image_base64,
+        "image_base64": image["image_base64"],
+        "image_small": image["image_small"],
+        "starts_at": parse_event_date(event_data.date),
         "status": "active",
         "organizer_id": str(current_user["_id"]),
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": datetime.utcnow()
     }
+    if geo:
+        event_dict["geo"] = geo
     
-    result = await db.events.insert_one(event_dict)
+    event_id = await storage.events.create(event_dict)
+    catalog_changed(event_id, event_list=True)
+    search_index.schedule()
     
     return {
-        "id": str(result.inserted_id),
+        "id": event_id,
         "name": event_data.name,
         "description": event_data.description,
         "date": event_data.date,
         "location": event_data.location,
-        "image_base64": event_data.image_base64,
+        "latitude": event_data.latitude,
+        "longitude": event_data.longitude,
+        "image_base64": event_dict["image_base64"],
         "status": "active",
         "organizer_id": str(current_user["_id"]),
-        "created_at": event_dict["created_at"]
+        "starts_at": to_isoformat(event_dict["starts_at"]),
+        "created_at": event_dict["created_at"].isoformat()
     }
 
+@api_router.get("/events/nearby")
+async def get_nearby_events(
+    lat: float,
+    lng: float,
+    radius: float = NEARBY_DEFAULT_RADIUS_KM,
+    status: Optional[str] = None,
+    starts_from: Optional[datetime] = None,
+    starts_to: Optional[datetime] = None,
+    limit: int = 20,
+    offset: int = 0,
+    storage: Storage = Depends(get_storage)
+):
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="Coordenadas inválidas")
+    if not 0 < radius <= NEARBY_MAX_RADIUS_KM:
+        raise HTTPException(status_code=400, detail=f"O raio deve ser de até {NEARBY_MAX_RADIUS_KM:g} km")
+    # Not coalesced nor kept for the fallback, coordinates rarely repeat
+    if not db_breaker.allow():
+        raise service_unavailable()
+    
+    events = await storage.events.nearby(
+        lng, lat, radius * 1000, status, naive_utc(starts_from), naive_utc(starts_to),
+        max(offset, 0), max(1, min(limit, NEARBY_MAX_LIMIT))
+    )
+    return [
+        dict(event_to_response(event, image="small"), distance_km=round(event["distance"] / 1000, 2))
+        for event in events
+    ]
+
 @api_router.get("/events/{event_id}")
-async def get_event(event_id: str):
-    event = await db.events.find_one({"_id": ObjectId(event_id)})
-    if not event:
+async def get_event(event_id: str, storage: Storage = Depends(get_storage)):
+    async def fetch():
+        event = await storage.events.get(event_id)
+        return catalog_body(event_to_response(event)) if event else None
+    
+    response = await catalog_read(("event", event_id), fetch)
+    if response is None:
         raise HTTPException(status_code=404, detail="Evento não encontrado")
     
-    return {
-        "id": str(event["_id"]),
-        "name": event["name"],
-        "description": event["description"],
-        "date": event["date"],
-        "location": event["location"],
-        "image_base64": event.get("image_base64"),
-        "status": event["status"],
-        "organizer_id": event["organizer_id"],
-        "created_at": event["created_at"]
-    }
+    return response
+
+@api_router.get("/events/{event_id}/menu")
+async def get_event_menu(event_id: str, request: Request):
+    # Event and products in one precompressed document, served from memory
+    snapshot = menu_snapshots.get(event_id)
+    if snapshot is None:
+        if not db_breaker.allow():
+            raise service_unavailable()
+        snapshot = await menu_snapshots.build(event_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Evento não encontrado")
+    
+    headers = {"ETag": snapshot.etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+    
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), snapshot.bodies)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=snapshot.bodies[encoding], media_type="application/json", headers=headers)
 
 @api_router.put("/events/{event_id}")
-async def update_event(event_id: str, event_data: EventCreate, current_user = Depends(get_current_user)):
+async def update_event(event_id: str, event_data: EventCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem editar eventos")
     
-    result = await db.events.update_one(
-        {"_id": ObjectId(event_id)},
-        {"$set": event_data.dict()}
-    )
+    geo = event_geo(event_data)
+    image = await prepare_upload(event_data.image_base64)
+    fields = dict(event_data.dict(exclude={"latitude", "longitude"}), starts_at=parse_event_date(event_data.date), **image)
+    # Sending no coordinates removes them, the event leaves nearby searches
+    if geo:
+        found = await storage.events.update(event_id, dict(fields, geo=geo))
+    else:
+        found = await storage.events.update(event_id, fields, unset=["geo"])
     
-    if result.matched_count == 0:
+    if not found:
         raise HTTPException(status_code=404, detail="Evento não encontrado")
     
+    catalog_changed(event_id, event_list=True)
+    search_index.schedule()
     return {"message": "Evento atualizado com sucesso"}
 
 @api_router.delete("/events/{event_id}")
-async def delete_event(event_id: str, current_user = Depends(get_current_user)):
+async def delete_event(event_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem deletar eventos")
     
-    result = await db.events.delete_one({"_id": ObjectId(event_id)})
-    if result.deleted_count == 0:
+    if not await storage.events.delete(event_id):
         raise HTTPException(status_code=404, detail="Evento não encontrado")
     
+    menu_snapshots.drop(event_id)
+    catalog_publisher.schedule(event_id, event_list=True)
+    search_index.schedule()
     return {"message": "Evento deletado com sucesso"}
 
 # PRODUCT ROUTES
 @api_router.get("/events/{event_id}/products")
-async def get_event_products(event_id: str):
-    products = await db.products.find({"event_id": event_id}).to_list(1000)
-    return [{
-        "id": str(product["_id"]),
-        "event_id": product["event_id"],
-        "name": product["name"],
-        "description": product["description"],
-        "price": product["price"],
-        "stock": product["stock"],
-        "image_base64": product.get("image_base64"),
-        "available": product["available"]
-    } for product in products]
+async def get_event_products(event_id: str, storage: Storage = Depends(get_storage)):
+    async def fetch():
+        products = await storage.products.list_by_event(event_id)
+        return catalog_body([product_to_response(product, image="small") for product in products])
+    
+    return await catalog_read(("products", event_id), fetch)
 
 @api_router.post("/events/{event_id}/products")
-async def create_product(event_id: str, product_data: ProductCreate, current_user = Depends(get_current_user)):
+async def create_product(event_id: str, product_data: ProductCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem criar produtos")
     
+    image = await prepare_upload(product_data.image_base64)
     product_dict = {
         "event_id": event_id,
         "name": product_data.name,
         "description": product_data.description,
         "price": product_data.price,
         "stock": product_data.stock,
-        "image_base64": product_data.image_base64,
+        "reserved": 0,
+        "image_base64": image["image_base64"],
+        "image_small": image["image_small"],
         "available": True,
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": datetime.utcnow()
     }
     
-    result = await db.products.insert_one(product_dict)
+    product_id = await storage.products.create(product_dict)
+    catalog_changed(event_id)
+    search_index.schedule()
     
     return {
-        "id": str(result.inserted_id),
+        "id": product_id,
         "event_id": event_id,
         "name": product_data.name,
         "description": product_data.description,
         "price": product_data.price,
         "stock": product_data.stock,
-        "image_base64": product_data.image_base64,
+        "available_stock": product_data.stock,
+        "image_base64": product_dict["image_base64"],
         "available": True
     }
 
 @api_router.put("/products/{product_id}")
-async def update_product(product_id: str, product_data: ProductCreate, current_user = Depends(get_current_user)):
+async def update_product(product_id: str, product_data: ProductCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem editar produtos")
     
-    result = await db.products.update_one(
-        {"_id": ObjectId(product_id)},
-        {"$set": product_data.dict()}
-    )
+    image = await prepare_upload(product_data.image_base64)
+    product = await storage.products.update(product_id, dict(product_data.dict(), **image))
     
-    if result.matched_count == 0:
+    if product is None:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
+    catalog_changed(product["event_id"])
+    search_index.schedule()
     return {"message": "Produto atualizado com sucesso"}
 
 @api_router.delete("/products/{product_id}")
-async def delete_product(product_id: str, current_user = Depends(get_current_user)):
+async def delete_product(product_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem deletar produtos")
     
-    result = await db.products.delete_one({"_id": ObjectId(product_id)})
-    if result.deleted_count == 0:
+    product = await storage.products.delete(product_id)
+    if product is None:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
     
+    catalog_changed(product["event_id"])
+    search_index.schedule()
     return {"message": "Produto deletado com sucesso"}
 
+# SEARCH ROUTES
+def check_search_request(kind: Optional[str], limit: int, max_limit: int) -> int:
+    if kind not in (None, "event", "product"):
+        raise HTTPException(status_code=400, detail="Tipo de busca inválido")
+    return max(1, min(limit, max_limit))
+
+@api_router.get("/search")
+async def search_catalog(q: str, type: Optional[str] = None, event_id: Optional[str] = None,
+                         status: Optional[str] = None, limit: int = 20, offset: int = 0):
+    limit = check_search_request(type, limit, SEARCH_MAX_LIMIT)
+    offset = max(offset, 0)
+    index = await search_index.current()
+    total, hits = index.search(q, type, event_id, status, limit, offset)
+    return {
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "results": [dict(document, score=round(score, 3)) for score, document in hits]
+    }
+
+@api_router.get("/search/autocomplete")
+async def autocomplete_catalog(q: str, type: Optional[str] = None, event_id: Optional[str] = None,
+                               status: Optional[str] = None, limit: int = 8):
+    limit = check_search_request(type, limit, SEARCH_MAX_LIMIT)
+    index = await search_index.current()
+    return {"suggestions": index.suggest(q, type, event_id, status, limit)}
+
 # ORDER ROUTES
-@api_router.post("/orders")
-async def create_order(order_data: OrderCreate, current_user = Depends(get_current_user)):
-    # Get event
-    event = await db.events.find_one({"_id": ObjectId(order_data.event_id)})
-    if not event:
+def read_quote(token: str, user_id: str, event_id: str) -> dict:
+    try:
+        quote = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], audience=QUOTE_AUDIENCE)
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=400, detail="Cotação inválida ou expirada, atualize o carrinho")
+    if quote.get("user_id") != user_id or quote.get("event_id") != event_id:
+        raise HTTPException(status_code=400, detail="Cotação inválida ou expirada, atualize o carrinho")
+    return quote
+
+@api_router.post("/orders/quote")
+async def quote_order(quote_data: QuoteRequest, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    snapshot = menu_snapshots.get(quote_data.event_id) or await menu_snapshots.build(quote_data.event_id)
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="Evento não encontrado")
     
+    items = []
+    problems = []
+    for item in quote_data.items:
+        product = snapshot.prices.get(item.product_id)
+        if product is None or not product["available"]:
+            raise HTTPException(status_code=400, detail="Produto indisponível no cardápio")
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="Quantidade inválida")
+        if item.quantity > product["available_stock"]:
+            problems.append(f"Estoque insuficiente para {product['name']}")
+        items.append({
+            "product_id": item.product_id,
+            "product_name": product["name"],
+            "quantity": item.quantity,
+            "unit_price": product["price"],
+        })
+    
+    subtotal = sum(item["unit_price"] * item["quantity"] for item in items)
+    platform_fee = subtotal * PLATFORM_FEE_RATE
+    credits_available = await storage.users.get_credits(str(current_user["_id"]))
+    credits_used = min(max(quote_data.use_credits, 0.0), credits_available, subtotal + platform_fee)
+    expires_at = datetime.utcnow() + timedelta(seconds=QUOTE_TTL_SECONDS)
+    
+    quote = {
+        "event_id": quote_data.event_id,
+        "items": items,
+        "subtotal": subtotal,
+        "platform_fee": platform_fee,
+        "credits_available": credits_available,
+        "credits_used": credits_used,
+        "total": subtotal + platform_fee - credits_used,
+        "problems": problems,
+        "quote_token": None,
+        "expires_at": None,
+    }
+    # Only a cart that can be bought gets a token
+    if items and not problems:
+        quote["quote_token"] = jwt.encode({
+            "aud": QUOTE_AUDIENCE,
+            "user_id": str(current_user["_id"]),
+            "event_id": quote_data.event_id,
+            "event_name": snapshot.event_name,
+            "items": items,
+            "credits_used": credits_used,
+            "exp": expires_at,
+        }, SECRET_KEY, algorithm=ALGORITHM)
+        quote["expires_at"] = expires_at.isoformat()
+    return quote
+
+@api_router.post("/orders")
+async def create_order(order_data: OrderCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    if order_data.quote_token:
+        # Server-side prices from the quote, no event or product reads
+        quote = read_quote(order_data.quote_token, str(current_user["_id"]), order_data.event_id)
+        event = {"name": quote["event_name"]}
+        order_data.items = [OrderItem(**item) for item in quote["items"]]
+        requested_credits = quote["credits_used"]
+    else:
+        # Get event
+        event = await storage.events.get(order_data.event_id, primary=True)
+        if not event:
+            raise HTTPException(status_code=404, detail="Evento não encontrado")
+        # Without a quote the prices come from the products, never from the client
+        for item in order_data.items:
+            product = await storage.products.get(item.product_id)
+            if product is None or product["event_id"] != order_data.event_id or not product["available"]:
+                raise HTTPException(status_code=400, detail="Produto indisponível no cardápio")
+            if item.quantity <= 0:
+                raise HTTPException(status_code=400, detail="Quantidade inválida")
+            item.product_name = product["name"]
+            item.unit_price = product["price"]
+        requested_credits = order_data.use_credits
+    
     # Calculate totals
     subtotal = sum(item.unit_price * item.quantity for item in order_data.items)
-    platform_fee = subtotal * 0.10  # 10% fee
+    platform_fee = subtotal * PLATFORM_FEE_RATE
     
-    # Apply credits
-    credits_used = min(order_data.use_credits, current_user.get("credits", 0.0))
+    # Apply credits, the balance may have changed since the quote
+    user_id = str(current_user["_id"])
+    credits_used = min(max(requested_credits, 0.0), await storage.users.get_credits(user_id))
     total = subtotal + platform_fee - credits_used
     
     if total < 0:
@@ -414,12 +2712,29 @@ async def create_order(order_data: OrderCreate, current_user = Depends(get_curre
     
     organizer_amount = subtotal
     
+    # Take stock, consuming the cart holds of this user
+    taken = []
+    for item in order_data.items:
+        if not await take_stock(storage, user_id, item.product_id, item.quantity):
+            for product_id, quantity in taken:
+                await storage.products.restock(product_id, quantity)
+            raise HTTPException(status_code=409, detail=f"Estoque insuficiente para {item.product_name}")
+        taken.append((item.product_id, item.quantity))
+    
+    # Debited here, guarded by the balance, so concurrent orders cannot spend the same credits
+    if credits_used > 0 and not await storage.credits.spend(user_id, credits_used):
+        for product_id, quantity in taken:
+            await storage.products.restock(product_id, quantity)
+        raise HTTPException(status_code=409, detail="Saldo de créditos insuficiente, atualize o carrinho")
+    catalog_changed(order_data.event_id, stock_only=True)
+    
     # Generate unique QR code
     qr_code = f"ORDER-{uuid.uuid4()}"
     
     # Create order
     order_dict = {
-        "user_id": str(current_user["_id"]),
+        "_id": ObjectId(),
+        "user_id": user_id,
         "event_id": order_data.event_id,
         "event_name": event["name"],
         "items": [item.dict() for item in order_data.items],
@@ -431,65 +2746,113 @@ async def create_order(order_data: OrderCreate, current_user = Depends(get_curre
         "payment_status": "paid",  # Mockado como pago
         "qr_code": qr_code,
         "status": "pending",  # pending, validated, cancelled
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": datetime.utcnow()
     }
     
-    result = await db.orders.insert_one(order_dict)
+    try:
+        if ORDER_INGESTION_MODE == "queued":
+            # Order and its outbox entry are persisted by the batcher
+            await order_ingestion.submit(order_dict)
+            return JSONResponse(
+                status_code=202,
+                content=dict(order_to_response(order_dict), ingestion_status="queued")
+            )
+        
+        # The ledger entry is written by the outbox dispatcher, the outbox entry
+        # goes first so an order never exists without it
+        outbox_entry = order_outbox.entry(order_dict)
+        if outbox_entry:
+            await order_outbox.add([outbox_entry])
+        await storage.orders.insert(order_dict)
+    except Exception:
+        # No order was stored, give back what it took
+        if credits_used > 0:
+            await storage.credits.refund(user_id, credits_used)
+        for product_id, quantity in taken:
+            await storage.products.restock(product_id, quantity)
+        raise
+    order_outbox.notify()
     
-    # Update user credits
-    if credits_used > 0:
-        await db.users.update_one(
-            {"_id": current_user["_id"]},
-            {"$inc": {"credits": -credits_used}}
-        )
+    return order_to_response(order_dict)
+
+@api_router.get("/orders")
+async def get_my_orders(include_archived: bool = False, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    user_id = str(current_user["_id"])
+    orders = await storage.orders.list_by_user(user_id)
+    if include_archived:
+        orders += await storage.orders.list_by_user(user_id, archived=True)
+    persisted = {str(order["_id"]) for order in orders}
+    orders += [
+        order for order_id, order in order_ingestion.pending.items()
+        if order["user_id"] == user_id and order_id not in persisted
+    ]
+    return [order_to_response(order) for order in orders]
+
+@api_router.post("/orders/lookup")
+async def lookup_orders(lookup: OrderLookup, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    # Resolves many order ids and QR codes with one $in query, results come back in request order
+    keys = [("id", order_id) for order_id in lookup.order_ids] + [("qr_code", qr_code) for qr_code in lookup.qr_codes]
+    if len(keys) > ORDER_LOOKUP_MAX_KEYS:
+        raise HTTPException(status_code=400, detail=f"Máximo de {ORDER_LOOKUP_MAX_KEYS} pedidos por consulta")
     
-    # Update product stock
-    for item in order_data.items:
-        await db.products.update_one(
-            {"_id": ObjectId(item.product_id)},
-            {"$inc": {"stock": -item.quantity}}
-        )
+    object_ids = [ObjectId(order_id) for order_id in lookup.order_ids if ObjectId.is_valid(order_id)]
     
-    return {
-        "id": str(result.inserted_id),
-        "user_id": str(current_user["_id"]),
-        "event_id": order_data.event_id,
-        "event_name": event["name"],
-        "items": [item.dict() for item in order_data.items],
-        "subtotal": subtotal,
-        "platform_fee": platform_fee,
-        "credits_used": credits_used,
-        "total": total,
-        "organizer_amount": organizer_amount,
-        "payment_status": "paid",
-        "qr_code": qr_code,
-        "status": "pending",
-        "created_at": order_dict["created_at"]
-    }
+    by_id, by_qr_code = {}, {}
+    def index(orders: list, ingestion_status: str):
+        for order in orders:
+            order["ingestion_status"] = ingestion_status
+            by_id.setdefault(str(order["_id"]), order)
+            by_qr_code.setdefault(order["qr_code"], order)
+    
+    index(await storage.orders.lookup(object_ids, lookup.qr_codes, ORDER_RESPONSE_FIELDS), "persisted")
+    requested_ids, requested_qr_codes = set(lookup.order_ids), set(lookup.qr_codes)
+    index([
+        dict(order) for order_id, order in order_ingestion.pending.items()
+        if order_id in requested_ids or order["qr_code"] in requested_qr_codes
+    ], "queued")
+    
+    missing_ids = [oid for oid in object_ids if str(oid) not in by_id]
+    missing_qr_codes = [qr_code for qr_code in lookup.qr_codes if qr_code not in by_qr_code]
+    if missing_ids or missing_qr_codes:
+        index(await storage.orders.lookup(missing_ids, missing_qr_codes, ORDER_RESPONSE_FIELDS, archived=True), "archived")
+    
+    user_id = str(current_user["_id"])
+    is_admin = current_user["role"] == "admin"
+    results = []
+    for kind, key in keys:
+        if kind == "id" and not ObjectId.is_valid(key):
+            results.append({kind: key, "status": 400, "error": "Id de pedido inválido"})
+            continue
+        order = by_id.get(key) if kind == "id" else by_qr_code.get(key)
+        if order is None:
+            results.append({kind: key, "status": 404, "error": "Pedido não encontrado"})
+        elif order["user_id"] != user_id and not is_admin:
+            results.append({kind: key, "status": 403, "error": "Acesso negado"})
+        else:
+            results.append({
+                kind: key,
+                "status": 200,
+                "order": dict(order_to_response(order), ingestion_status=order["ingestion_status"])
+            })
+    
+    return {"results": results}
 
-@api_router.get("/orders")
-async def get_my_orders(current_user = Depends(get_current_user)):
-    orders = await db.orders.find({"user_id": str(current_user["_id"])}).to_list(1000)
-    return [{
-        "id": str(order["_id"]),
-        "user_id": order["user_id"],
-        "event_id": order["event_id"],
-        "event_name": order["event_name"],
-        "items": order["items"],
-        "subtotal": order["subtotal"],
-        "platform_fee": order["platform_fee"],
-        "credits_used": order.get("credits_used", 0.0),
-        "total": order["total"],
-        "organizer_amount": order["organizer_amount"],
-        "payment_status": order["payment_status"],
-        "qr_code": order["qr_code"],
-        "status": order["status"],
-        "created_at": order["created_at"]
-    } for order in orders]
+async def find_order(storage: Storage, order_id: str):
+    """The order and where it is: persisted, still queued for ingestion, or archived."""
+    order = await storage.orders.get(order_id)
+    if order:
+        return order, "persisted"
+    order = order_ingestion.get(order_id)
+    if order:
+        return order, "queued"
+    order = await storage.orders.get(order_id, archived=True)
+    if order:
+        return order, "archived"
+    return None, None
 
 @api_router.get("/orders/{order_id}")
-async def get_order(order_id: str, current_user = Depends(get_current_user)):
-    order = await db.orders.find_one({"_id": ObjectId(order_id)})
+async def get_order(order_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    order, ingestion_status = await find_order(storage, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
     
@@ -497,48 +2860,59 @@ async def get_order(order_id: str, current_user = Depends(get_current_user)):
     if order["user_id"] != str(current_user["_id"]) and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    return {
-        "id": str(order["_id"]),
-        "user_id": order["user_id"],
-        "event_id": order["event_id"],
-        "event_name": order["event_name"],
-        "items": order["items"],
-        "subtotal": order["subtotal"],
-        "platform_fee": order["platform_fee"],
-        "credits_used": order.get("credits_used", 0.0),
-        "total": order["total"],
-        "organizer_amount": order["organizer_amount"],
-        "payment_status": order["payment_status"],
-        "qr_code": order["qr_code"],
-        "status": order["status"],
-        "created_at": order["created_at"]
-    }
+    return dict(order_to_response(order), ingestion_status=ingestion_status)
+
+@api_router.get("/orders/{order_id}/qr")
+async def get_order_qr(order_id: str, request: Request, format: str = "svg", size: int = 512,
+                       current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    check_qr_request(format, size)
+    order, _ = await find_order(storage, order_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Pedido não encontrado")
+    if order["user_id"] != str(current_user["_id"]) and current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    # The code of an order never changes, neither does its image
+    etag = f'"{hashlib.sha256(order["qr_code"].encode()).hexdigest()[:16]}-{size}.{format}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    body = await render_qr(order["qr_code"], format, size)
+    return Response(content=body, media_type=QR_MEDIA_TYPES[format], headers=headers)
 
 @api_router.post("/orders/{order_id}/validate")
-async def validate_order(order_id: str, current_user = Depends(get_current_user)):
+async def validate_order(order_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem validar pedidos")
     
-    order = await db.orders.find_one({"_id": ObjectId(order_id)})
+    order = await storage.orders.get(order_id)
+    if not order:
+        order = await storage.orders.get(order_id, archived=True)
+        if order and order["status"] != "validated":
+            raise HTTPException(status_code=400, detail="Pedido arquivado não pode ser validado")
     if not order:
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
     
     if order["status"] == "validated":
         raise HTTPException(status_code=400, detail="Pedido já foi validado")
     
-    await db.orders.update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": {"status": "validated", "validated_at": datetime.utcnow().isoformat()}}
-    )
+    await storage.orders.set_validated(order["_id"], datetime.utcnow())
     
     return {"message": "Pedido validado com sucesso"}
 
 @api_router.post("/orders/validate-qr")
-async def validate_qr_code(qr_code: str, current_user = Depends(get_current_user)):
+async def validate_qr_code(qr_code: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Apenas administradores podem validar QR codes")
     
-    order = await db.orders.find_one({"qr_code": qr_code})
+    order = await storage.orders.get_by_qr_code(qr_code)
+    if not order:
+        if any(pending["qr_code"] == qr_code for pending in order_ingestion.pending.values()):
+            raise HTTPException(status_code=409, detail="Pedido em processamento, tente novamente")
+        order = await storage.orders.get_by_qr_code(qr_code, archived=True)
+        if order and order["status"] != "validated":
+            raise HTTPException(status_code=400, detail="Pedido arquivado não pode ser validado")
     if not order:
         raise HTTPException(status_code=404, detail="QR Code inválido")
     
@@ -550,14 +2924,11 @@ async def validate_qr_code(qr_code: str, current_user = Depends(get_current_user
                 "event_name": order["event_name"],
                 "total": order["total"],
                 "status": order["status"],
-                "validated_at": order.get("validated_at")
+                "validated_at": to_isoformat(order.get("validated_at"))
             }
         }
     
-    await db.orders.update_one(
-        {"_id": order["_id"]},
-        {"$set": {"status": "validated", "validated_at": datetime.utcnow().isoformat()}}
-    )
+    await storage.orders.set_validated(order["_id"], datetime.utcnow())
     
     return {
         "message": "Pedido validado com sucesso!",
@@ -570,36 +2941,120 @@ async def validate_qr_code(qr_code: str, current_user = Depends(get_current_user
         }
     }
 
+# CART ROUTES
+@api_router.get("/cart/holds")
+async def get_my_holds(current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    holds = await storage.holds.list_active(str(current_user["_id"]))
+    return [{
+        "id": str(hold["_id"]),
+        "product_id": hold["product_id"],
+        "event_id": hold["event_id"],
+        "quantity": hold["quantity"],
+        "expires_at": hold["expires_at"].isoformat()
+    } for hold in holds]
+
+@api_router.post("/cart/holds")
+async def hold_stock(hold_data: StockHoldCreate, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    # Sets the held quantity of a product to the quantity in the cart and renews the hold
+    if hold_data.quantity < 0:
+        raise HTTPException(status_code=400, detail="Quantidade inválida")
+    
+    user_id = str(current_user["_id"])
+    product = await storage.products.get(hold_data.product_id)
+    if not product:
+        raise HTTPException(status_code=404, detail="Produto não encontrado")
+    
+    # An expired hold the sweeper has not released yet still has its stock
+    # reserved, so it is renewed like an active one
+    existing = await storage.holds.get(user_id, hold_data.product_id)
+    if not existing and hold_data.quantity == 0:
+        return {"message": "Reserva liberada"}
+    
+    held = existing["quantity"] if existing else 0
+    delta = hold_data.quantity - held
+    
+    if delta > 0 and not await storage.products.reserve(hold_data.product_id, delta):
+        raise HTTPException(status_code=409, detail="Estoque insuficiente")
+    
+    expires_at = datetime.utcnow() + timedelta(seconds=STOCK_HOLD_TTL_SECONDS)
+    
+    if existing:
+        # Guard against the sweeper or a checkout consuming the hold in the meantime
+        if hold_data.quantity == 0:
+            matched = await storage.holds.remove(existing["_id"], held)
+        else:
+            matched = await storage.holds.update(existing["_id"], held, hold_data.quantity, expires_at)
+        if not matched:
+            if delta > 0:
+                await storage.products.release(hold_data.product_id, delta)
+            raise HTTPException(status_code=409, detail="Reserva alterada, tente novamente")
+        if delta < 0:
+            await storage.products.release(hold_data.product_id, -delta)
+        hold_id = str(existing["_id"])
+    else:
+        hold_id = await storage.holds.create({
+            "user_id": user_id,
+            "product_id": hold_data.product_id,
+            "event_id": product["event_id"],
+            "quantity": hold_data.quantity,
+            "expires_at": expires_at,
+            "created_at": datetime.utcnow()
+        })
+        if hold_id is None:
+            # A concurrent request created the hold first
+            await storage.products.release(hold_data.product_id, delta)
+            raise HTTPException(status_code=409, detail="Reserva alterada, tente novamente")
+    
+    catalog_changed(product["event_id"], stock_only=True)
+    
+    if hold_data.quantity == 0:
+        return {"message": "Reserva liberada"}
+    
+    return {
+        "id": hold_id,
+        "product_id": hold_data.product_id,
+        "event_id": product["event_id"],
+        "quantity": hold_data.quantity,
+        "expires_at": expires_at.isoformat()
+    }
+
+@api_router.delete("/cart/holds/{hold_id}")
+async def release_hold(hold_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    hold = await storage.holds.delete(hold_id, str(current_user["_id"]))
+    if not hold:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    
+    await storage.products.release(hold["product_id"], hold["quantity"])
+    catalog_changed(hold["event_id"], stock_only=True)
+    
+    return {"message": "Reserva liberada"}
+
 # CREDITS ROUTES
 @api_router.get("/credits/balance")
-async def get_credits_balance(current_user = Depends(get_current_user)):
-    return {"credits": current_user.get("credits", 0.0)}
+async def get_credits_balance(current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    return {"credits": await storage.users.get_credits(str(current_user["_id"]))}
 
 @api_router.post("/credits/add")
-async def add_credits(amount: float, current_user = Depends(get_current_user)):
-    # This would be called after an event ends to convert unused balance
-    await db.users.update_one(
-        {"_id": current_user["_id"]},
-        {"$inc": {"credits": amount}}
-    )
+async def add_credits(amount: float, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    # This would be called after an event ends to convert unused balance,
+    # the balance change and its credit transaction
+    await storage.credits.add(str(current_user["_id"]), amount, "conversion")
     
-    # Log credit transaction
-    await db.credit_transactions.insert_one({
-        "user_id": str(current_user["_id"]),
-        "amount": amount,
-        "type": "conversion",
-        "created_at": datetime.utcnow().isoformat()
-    })
-    
-    return {"message": "Créditos adicionados com sucesso", "new_balance": current_user.get("credits", 0.0) + amount}
+    return {"message": "Créditos adicionados com sucesso", "new_balance": await storage.users.get_credits(str(current_user["_id"]))}
 
 # ADMIN ROUTES
 @api_router.get("/admin/orders")
-async def get_all_orders(current_user = Depends(get_current_user)):
+async def get_all_orders(
+    event_id: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    current_user = Depends(get_current_user),
+    storage: Storage = Depends(get_storage)
+):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Acesso negado")
     
-    orders = await db.orders.find().to_list(1000)
+    orders = await storage.orders.list_recent(event_id, naive_utc(created_from), naive_utc(created_to), 1000)
     return [{
         "id": str(order["_id"]),
         "user_id": order["user_id"],
@@ -612,16 +3067,16 @@ async def get_all_orders(current_user = Depends(get_current_user)):
         "payment_status": order["payment_status"],
         "qr_code": order["qr_code"],
         "status": order["status"],
-        "created_at": order["created_at"]
+        "created_at": to_isoformat(order["created_at"])
     } for order in orders]
 
 @api_router.get("/admin/reports")
-async def get_reports(current_user = Depends(get_current_user)):
+async def get_reports(current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Acesso negado")
     
     # Calculate totals
-    orders = await db.orders.find({"payment_status": "paid"}).to_list(10000)
+    orders = await storage.orders.list_paid(10000)
     
     total_sales = sum(order["total"] for order in orders)
     platform_fees = sum(order["platform_fee"] for order in orders)
@@ -634,10 +3089,156 @@ async def get_reports(current_user = Depends(get_current_user)):
         "organizer_amount": organizer_amount
     }
 
+@api_router.get("/admin/events/{event_id}/analytics")
+async def get_event_analytics(
+    event_id: str,
+    bucket: str = "hour",
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    top: int = 10,
+    sort_by: str = "revenue",
+    current_user = Depends(get_current_user)
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    if bucket not in ANALYTICS_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"Intervalo inválido, use {', '.join(ANALYTICS_BUCKETS)}")
+    if sort_by not in ("revenue", "units"):
+        raise HTTPException(status_code=400, detail="Ordenação inválida, use revenue ou units")
+    
+    series = await sales_analytics.get(event_id, bucket)
+    created_from, created_to = naive_utc(created_from), naive_utc(created_to)
+    
+    starts = sorted(set(series["sales"]) | set(series["validations"]))
+    created = [series["sales"].get(start, {}).get("orders", 0) for start in starts]
+    validated = [series["validations"].get(start, 0) for start in starts]
+    pending = backlog_series(created, validated)
+    
+    def in_range(start: datetime) -> bool:
+        return (not created_from or start >= truncate_to_bucket(created_from, bucket)) and \
+            (not created_to or start < created_to)
+    
+    return {
+        "event_id": event_id,
+        "bucket": bucket,
+        "sales": [
+            dict(series["sales"][start], bucket=start.isoformat())
+            for start in starts if start in series["sales"] and in_range(start)
+        ],
+        "backlog": [
+            {"bucket": start.isoformat(), "created": created[i], "validated": validated[i], "pending": pending[i]}
+            for i, start in enumerate(starts) if in_range(start)
+        ],
+        "top_products": top_products(
+            [products for start, products in series["products"].items() if in_range(start)], sort_by, top
+        )
+    }
+
+@api_router.get("/admin/events/{event_id}/tickets")
+async def export_event_tickets(
+    event_id: str,
+    format: str = "png",
+    size: int = 512,
+    status: Optional[str] = None,
+    current_user = Depends(get_current_user),
+    storage: Storage = Depends(get_storage)
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    check_qr_request(format, size)
+    
+    orders = await storage.orders.list_qr_codes(event_id, status, QR_BULK_MAX_ORDERS + 1)
+    if len(orders) > QR_BULK_MAX_ORDERS:
+        raise HTTPException(status_code=400, detail=f"Mais de {QR_BULK_MAX_ORDERS} pedidos, filtre por status")
+    
+    tickets = [(f"{order['_id']}.{format}", order["qr_code"]) for order in orders]
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*(
+        loop.run_in_executor(image_pool(), image_variants.render_qr_batch, tickets[i:i + QR_BULK_CHUNK_SIZE], format, size)
+        for i in range(0, len(tickets), QR_BULK_CHUNK_SIZE)
+    ))
+    body = await asyncio.to_thread(image_variants.zip_files, [file for chunk in chunks for file in chunk])
+    
+    return Response(content=body, media_type="application/zip", headers={
+        "Content-Disposition": f'attachment; filename="tickets-{event_id}.zip"'
+    })
+
+@api_router.get("/admin/ingestion")
+async def get_ingestion_stats(current_user = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    return order_ingestion.stats()
+
+@api_router.get("/admin/outbox")
+async def get_outbox_stats(current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    return dict(order_outbox.stats(), **await storage.outbox.counts())
+
+@api_router.post("/admin/outbox/dead-letter/{entry_id}/retry")
+async def retry_dead_letter(entry_id: str, current_user = Depends(get_current_user), storage: Storage = Depends(get_storage)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    entry = await storage.outbox.get_dead_letter(entry_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Entrada não encontrada")
+    
+    entry.pop("failed_at", None)
+    now = datetime.utcnow()
+    await order_outbox.add([dict(entry, attempts=0, next_attempt_at=now, locked_until=now)])
+    await storage.outbox.delete_dead_letter(entry["_id"])
+    order_outbox.notify()
+    return {"message": "Entrada reenviada para o outbox"}
+
+@api_router.get("/admin/admission")
+async def get_admission_stats(current_user = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    return admission.stats()
+
+@api_router.get("/admin/catalog")
+async def get_catalog_stats(current_user = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acesso negado")
+    
+    return {
+        "single_flight": catalog_flights.stats(),
+        "fallback": {"entries": len(catalog_fallback.entries), "served": catalog_fallback.served},
+        "search": search_index.stats(),
+        "principals": principal_cache.stats(),
+        "warmup": cache_warmup.stats(),
+        "database": db_breaker.stats()
+    }
+
+@app.exception_handler(ConnectionFailure)
+@app.exception_handler(ExecutionTimeout)
+async def database_unavailable_handler(request: Request, exc: Exception):
+    db_breaker.record_failure()
+    logger.warning("database unavailable", extra={"error": type(exc).__name__})
+    error = service_unavailable()
+    return JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+
+@app.get("/ready")
+async def readiness():
+    # Outside /api, so neither admission control nor the database breaker applies
+    if not cache_warmup.ready:
+        return JSONResponse({"status": "warming_up", "warmup": cache_warmup.stats()}, status_code=503)
+    return {"status": "ready", "warmup": cache_warmup.stats()}
+
 # Include router
 app.include_router(api_router)
 
-# CORS
+app.add_middleware(DatabaseBreakerMiddleware)
+app.add_middleware(CompressionMiddleware, min_size=COMPRESSION_MIN_SIZE)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(RequestContextMiddleware)
+
+# CORS, added last so it is the outermost middleware: the 503s of admission
+# control and the breaker need its headers for browsers to read them
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -646,6 +3247,53 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    # One hold per user and product. Older deployments have the same index without
+    # `unique`, which has to go first
+    hold_index = (await db.stock_holds.index_information()).get("user_id_1_product_id_1")
+    if hold_index and not hold_index.get("unique"):
+        await db.stock_holds.drop_index("user_id_1_product_id_1")
+    await db.stock_holds.create_index([("user_id", 1), ("product_id", 1)], unique=True)
+    await db.stock_holds.create_index("expires_at")
+    await db.orders.create_index("created_at")
+    await db.orders.create_index("user_id")
+    await db.orders.create_index("qr_code")
+    await ensure_order_archive(db)
+    await db.orders.create_index([("event_id", 1), ("created_at", 1)])
+    await db.outbox.create_index([("next_attempt_at", 1), ("locked_until", 1)])
+    await db.events.create_index([("geo", "2dsphere")])
+
+@app.on_event("startup")
+async def startup_stock_holds():
+    app.state.stock_hold_sweeper = asyncio.create_task(stock_hold_sweeper())
+
+@app.on_event("startup")
+async def startup_order_outbox():
+    order_outbox.start()
+
+@app.on_event("startup")
+async def startup_order_ingestion():
+    if ORDER_INGESTION_MODE == "queued":
+        await order_ingestion.start()
+
+@app.on_event("startup")
+async def startup_cache_warmup():
+    cache_warmup.start()
+
+@app.on_event("startup")
+async def startup_catalog_publisher():
+    if catalog_publisher.enabled:
+        await catalog_publisher.publish_all()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.stock_hold_sweeper.cancel()
+    cache_warmup.stop()
+    if ORDER_INGESTION_MODE == "queued":
+        await order_ingestion.stop()
+    order_outbox.stop()
+    if image_variants.image_pool_executor is not None:
+        image_variants.image_pool_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
+    log_listener.stop()
@@ -0,0 +1,30 @@
+"""The API on the in-memory storage engine, no MongoDB server needed.
+
+Requests go through the ASGI app with httpx (no network, no lifespan, so the
+background tasks do not start). Tests are plain functions that drive their
+scenario with asyncio.run, the factories are in helpers.py.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+# The Mongo client connects lazily and is never used by these tests
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("DB_NAME", "eventpay_test")
+
+import server  # noqa: E402
+from repositories import memory_storage  # noqa: E402
+
+@pytest.fixture
+def storage(monkeypatch):
+    """A fresh in-memory storage, with the per-process caches reset around it."""
+    storage = memory_storage()
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "principal_cache", server.PrincipalCache(1000, 60))
+    monkeypatch.setattr(server, "menu_snapshots", server.MenuSnapshotStore(
+        server.MENU_SNAPSHOT_DEBOUNCE_MS, server.MENU_SNAPSHOT_MAX_AGE_SECONDS
+    ))
+    return storage
@@ -0,0 +1,45 @@
+"""Factories for the tests, on the storage given by the `storage` fixture."""
+from datetime import datetime
+
+import httpx
+from bson import ObjectId
+
+import server
+
+def api_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+async def create_user(storage, role: str = "user", credits: float = 0.0) -> tuple:
+    """Returns the user id and the Authorization header of a new user."""
+    user_id = await storage.users.create({
+        "email": f"{ObjectId()}@test.com",
+        "password_hash": "unused",
+        "name": "Teste",
+        "phone": None,
+        "role": role,
+        "credits": credits,
+        "created_at": datetime.utcnow()
+    })
+    return user_id, {"Authorization": "Bearer " + server.create_access_token({"sub": user_id})}
+
+async def create_event(storage, name: str = "Festival") -> str:
+    return await storage.events.create({
+        "name": name,
+        "description": "Evento de teste",
+        "date": "20/12/2025 20:00",
+        "location": "Praça",
+        "status": "active",
+        "organizer_id": "organizer",
+        "created_at": datetime.utcnow()
+    })
+
+async def create_product(storage, event_id: str, name: str = "Cerveja", price: float = 10.0, stock: int = 100) -> str:
+    return await storage.products.create({
+        "event_id": event_id,
+        "name": name,
+        "description": "Produto de teste",
+        "price": price,
+        "stock": stock,
+        "available": True,
+        "created_at": datetime.utcnow()
+    })
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import server
+from tests.helpers import api_client, create_event
+
+def controller(queue_timeout: float = 1.0, **limits) -> server.AdmissionController:
+    """One slot and a queue of one per class unless given as name=(limit, queue_size)."""
+    sizes = {name: limits.get(name, (1, 1)) for name in server.ADMISSION_CLASSES}
+    return server.AdmissionController(
+        {name: limit for name, (limit, _) in sizes.items()},
+        {name: queue_size for name, (_, queue_size) in sizes.items()},
+        queue_timeout
+    )
+
+def test_a_full_queue_sheds():
+    async def scenario():
+        admission = controller()
+        assert await admission.acquire("browse")
+        waiting = asyncio.ensure_future(admission.acquire("browse"))
+        await asyncio.sleep(0)
+        shed = await admission.acquire("browse")
+        admission.release("browse")
+        return admission, shed, await waiting
+
+    admission, shed, admitted = asyncio.run(scenario())
+
+    assert shed is False
+    assert admitted is True
+    assert admission.by_name["browse"].shed["queue_full"] == 1
+    # The slot went straight to the waiter
+    assert admission.by_name["browse"].active == 1
+
+def test_waiting_higher_classes_shed_the_lower_ones():
+    async def scenario():
+        admission = controller()
+        assert await admission.acquire("browse")
+        assert await admission.acquire("checkout")
+        browse_waiter = asyncio.ensure_future(admission.acquire("browse"))
+        await asyncio.sleep(0)
+        checkout_waiter = asyncio.ensure_future(admission.acquire("checkout"))
+        await asyncio.sleep(0)
+        # Checkouts are queued, new browse requests are turned away at once
+        pressured = await admission.acquire("browse")
+        admin_pressured = await admission.acquire("admin")
+        # A scan still gets its own slot
+        scan = await admission.acquire("scan")
+        admission.release("checkout")
+        return admission, await browse_waiter, await checkout_waiter, pressured, admin_pressured, scan
+
+    admission, browse_waiter, checkout_waiter, pressured, admin_pressured, scan = asyncio.run(scenario())
+
+    assert browse_waiter is False
+    assert checkout_waiter is True
+    assert pressured is False
+    assert admin_pressured is False
+    assert scan is True
+    assert admission.by_name["browse"].shed["overload"] == 2
+    assert admission.by_name["admin"].shed["overload"] == 1
+
+def test_a_waiter_is_shed_after_the_queue_timeout():
+    async def scenario():
+        admission = controller(queue_timeout=0.02)
+        assert await admission.acquire("browse")
+        return admission, await admission.acquire("browse")
+
+    admission, admitted = asyncio.run(scenario())
+
+    assert admitted is False
+    assert admission.by_name["browse"].shed["timeout"] == 1
+    assert not admission.by_name["browse"].waiters
+
+@pytest.mark.parametrize("method, path, expected", [
+    ("POST", "/api/orders/abc/validate", "scan"),
+    ("POST", "/api/orders", "checkout"),
+    ("POST", "/api/cart/holds", "checkout"),
+    ("GET", "/api/events", "browse"),
+    ("GET", "/api/orders", "browse"),
+    ("GET", "/api/admin/orders", "admin"),
+])
+def test_routes_are_classified(method, path, expected):
+    assert server.admission_class({"method": method, "path": path}) == expected
+
+def test_a_shed_request_gets_a_503_with_cors_headers(storage, monkeypatch):
+    monkeypatch.setattr(server, "admission", controller(browse=(0, 0)))
+
+    async def scenario():
+        event_id = await create_event(storage)
+        async with api_client() as client:
+            return await client.get(f"/api/events/{event_id}", headers={"Origin": "https://app.example.com"})
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert response.headers["access-control-allow-origin"] == "*"
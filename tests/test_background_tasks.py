@@ -0,0 +1,43 @@
+import asyncio
+
+import pymongo
+from pymongo import _csot
+
+import server
+
+def request_context() -> dict:
+    return {"timeout": _csot.get_timeout(), "tracked": server.breaker_tracked.get()}
+
+def test_scheduled_rebuilds_do_not_inherit_the_request_context(storage, tmp_path):
+    seen = {}
+
+    def record(name: str):
+        async def work(*args, **kwargs):
+            seen[name] = request_context()
+        return work
+
+    menus = server.MenuSnapshotStore(debounce_ms=10, max_age_seconds=30)
+    menus.build = record("menu")
+    search = server.SearchIndex(debounce_ms=10, max_age_seconds=60)
+    search.build = record("search")
+    publisher = server.CatalogPublisher(str(tmp_path), debounce_ms=10, max_age_seconds=10)
+    publisher._publish_event = record("publisher")
+    publisher._write_manifest = record("manifest")
+
+    async def scenario():
+        # What DatabaseBreakerMiddleware sets around a request
+        token = server.breaker_tracked.set(True)
+        try:
+            with pymongo.timeout(0.05):
+                assert request_context() == {"timeout": 0.05, "tracked": True}
+                menus.schedule("event")
+                search.schedule()
+                publisher.schedule("event")
+        finally:
+            server.breaker_tracked.reset(token)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+
+    clean = {"timeout": None, "tracked": False}
+    assert seen == {"menu": clean, "search": clean, "publisher": clean, "manifest": clean}
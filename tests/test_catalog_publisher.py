@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+import json
+
+from bson import ObjectId
+
+import server
+from tests.helpers import create_event, create_product
+
+def publisher(root) -> server.CatalogPublisher:
+    return server.CatalogPublisher(str(root), debounce_ms=10, max_age_seconds=10)
+
+def read_manifest(root) -> dict:
+    return json.loads((root / "manifest.json").read_text())["files"]
+
+def versioned_files(root) -> set:
+    return {
+        file.relative_to(root).as_posix() for file in root.rglob("*.json*")
+        if server.VERSIONED_FILE.search(file.name)
+    }
+
+async def publish_event(worker: server.CatalogPublisher, event_id: str):
+    await worker._publish_event(event_id)
+    await worker._write_manifest()
+
+def test_publish_writes_current_and_versioned_files(storage, tmp_path):
+    async def scenario():
+        event_id = await create_event(storage)
+        await create_product(storage, event_id, name="Cerveja")
+        await publisher(tmp_path).publish_all()
+        return event_id
+
+    event_id = asyncio.run(scenario())
+
+    manifest = read_manifest(tmp_path)
+    assert set(manifest) == {"events.json", "events/status/active.json", f"events/{event_id}.json",
+                             f"events/{event_id}/products.json"}
+    entry = manifest[f"events/{event_id}/products.json"]
+    assert entry["surrogate_keys"] == ["catalog", f"event-{event_id}", f"products-{event_id}"]
+    assert manifest["events.json"]["surrogate_keys"] == ["catalog", "events"]
+    current = (tmp_path / "events" / event_id / "products.json").read_bytes()
+    assert json.loads(current)[0]["name"] == "Cerveja"
+    assert (tmp_path / entry["file"]).read_bytes() == current
+    assert gzip.decompress((tmp_path / (entry["file"] + ".gz")).read_bytes()) == current
+
+def test_a_version_is_kept_until_the_manifest_listing_it_is_replaced(storage, tmp_path):
+    async def scenario():
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, price=10.0)
+        worker = publisher(tmp_path)
+        await worker.publish_all()
+        files = [read_manifest(tmp_path)[f"events/{event_id}/products.json"]["file"]]
+        for price in (12.0, 14.0):
+            await storage.products.update(product_id, {"price": price})
+            await publish_event(worker, event_id)
+            files.append(read_manifest(tmp_path)[f"events/{event_id}/products.json"]["file"])
+        return files
+
+    first, second, third = asyncio.run(scenario())
+
+    assert len({first, second, third}) == 3
+    assert not (tmp_path / first).exists()
+    assert (tmp_path / second).exists()
+    assert (tmp_path / third).exists()
+
+def test_an_unpublished_event_goes_away_with_its_versions(storage, tmp_path):
+    async def scenario():
+        event_id = await create_event(storage)
+        await create_product(storage, event_id)
+        worker = publisher(tmp_path)
+        await worker.publish_all()
+        files = {entry["file"] for path, entry in read_manifest(tmp_path).items() if event_id in path}
+        del storage.events.documents[ObjectId(event_id)]
+        await publish_event(worker, event_id)
+        listed = read_manifest(tmp_path)
+        # One more manifest and nobody can hold one listing the old versions
+        await worker._write_manifest()
+        return event_id, files, listed
+
+    event_id, files, listed = asyncio.run(scenario())
+
+    assert not any(event_id in path for path in listed)
+    assert not (tmp_path / "events" / f"{event_id}.json").exists()
+    assert not (tmp_path / "events" / event_id / "products.json.gz").exists()
+    assert not any((tmp_path / file).exists() for file in files)
+
+def test_versions_left_by_earlier_processes_are_swept(storage, tmp_path):
+    leftover = tmp_path / "events" / "old" / "products.0123456789abcdef.json"
+    leftover.parent.mkdir(parents=True)
+    leftover.write_text("[]")
+    (tmp_path / "events.fedcba9876543210.json.br").write_bytes(b"")
+
+    async def scenario():
+        await create_event(storage)
+        await publisher(tmp_path).publish_all()
+
+    asyncio.run(scenario())
+
+    assert versioned_files(tmp_path) == {
+        file + suffix for file in (entry["file"] for entry in read_manifest(tmp_path).values())
+        for suffix in server.PUBLISHED_SUFFIXES.values() if suffix != ".br" or server.brotli is not None
+    }
+
+def test_workers_sharing_the_directory_publish_one_manifest(storage, tmp_path):
+    async def scenario():
+        first_event = await create_event(storage, name="Festival")
+        second_event = await create_event(storage, name="Show")
+        product_id = await create_product(storage, first_event, price=10.0)
+        first_worker, second_worker = publisher(tmp_path), publisher(tmp_path)
+        await first_worker.publish_all()
+        # The second worker handles a price change, the first one a change to another event
+        await storage.products.update(product_id, {"price": 20.0})
+        await publish_event(second_worker, first_event)
+        await storage.events.update(second_event, {"name": "Show de Rock"})
+        await publish_event(first_worker, second_event)
+        return first_event
+
+    first_event = asyncio.run(scenario())
+
+    manifest = read_manifest(tmp_path)
+    products = manifest[f"events/{first_event}/products.json"]
+    # The first worker's manifest points at the version the second one wrote
+    assert json.loads((tmp_path / products["file"]).read_text())[0]["price"] == 20.0
+    assert all((tmp_path / entry["file"]).exists() for entry in manifest.values())
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import ConnectionFailure
+
+import server
+from tests.helpers import api_client, create_event
+
+@pytest.fixture
+def catalog(monkeypatch):
+    """Fresh coalescing, fallback and breaker state."""
+    monkeypatch.setattr(server, "catalog_flights", server.SingleFlight())
+    monkeypatch.setattr(server, "catalog_fallback", server.CatalogFallback(100))
+    monkeypatch.setattr(server, "db_breaker", server.CircuitBreaker(failure_threshold=1, reset_seconds=60))
+
+@pytest.fixture
+def event_reads(storage, monkeypatch) -> list:
+    """Counts event reads, each one slow enough for concurrent requests to overlap."""
+    reads = []
+    read = storage.events.get
+
+    async def get(event_id: str, primary: bool = False):
+        reads.append(event_id)
+        await asyncio.sleep(0.02)
+        return await read(event_id, primary)
+
+    monkeypatch.setattr(storage.events, "get", get)
+    return reads
+
+def test_concurrent_calls_share_one_fetch():
+    flights = server.SingleFlight()
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return b"body"
+
+    async def scenario():
+        results = await asyncio.gather(*(flights.do(("events", None), fetch) for _ in range(5)))
+        # Done calls are not cached, the next miss fetches again
+        results.append(await flights.do(("events", None), fetch))
+        return results
+
+    results = asyncio.run(scenario())
+
+    assert results == [b"body"] * 6
+    assert len(fetches) == 2
+    assert flights.stats() == {"in_flight": 0, "by_query": {"events": {"calls": 2, "coalesced": 4}}}
+
+def test_every_waiter_gets_the_error_of_the_shared_fetch():
+    flights = server.SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ConnectionFailure("down")
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do(("event", "1"), fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    assert [type(result) for result in results] == [ConnectionFailure] * 3
+    assert flights.calls == {}
+
+def test_a_caller_going_away_does_not_cancel_the_shared_fetch():
+    flights = server.SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return b"body"
+
+    async def scenario():
+        impatient = asyncio.ensure_future(flights.do(("event", "1"), fetch))
+        waiting = asyncio.ensure_future(flights.do(("event", "1"), fetch))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        return await waiting
+
+    assert asyncio.run(scenario()) == b"body"
+
+def test_concurrent_misses_hit_the_database_once(storage, catalog, event_reads):
+    async def scenario():
+        event_id = await create_event(storage)
+        async with api_client() as client:
+            responses = await asyncio.gather(*(client.get(f"/api/events/{event_id}") for _ in range(5)))
+        return event_id, responses
+
+    event_id, responses = asyncio.run(scenario())
+
+    assert [response.status_code for response in responses] == [200] * 5
+    assert {response.json()["id"] for response in responses} == {event_id}
+    assert event_reads == [event_id]
+
+def test_the_last_known_good_body_is_served_while_the_breaker_is_open(storage, catalog, event_reads):
+    async def scenario():
+        event_id = await create_event(storage)
+        async with api_client() as client:
+            fresh = await client.get(f"/api/events/{event_id}")
+            server.db_breaker.record_failure()
+            assert server.db_breaker.state == "open"
+            fallback = await client.get(f"/api/events/{event_id}")
+            never_read = await client.get(f"/api/events/{ObjectId()}")
+        return event_id, fresh, fallback, never_read
+
+    event_id, fresh, fallback, never_read = asyncio.run(scenario())
+
+    assert "x-catalog-source" not in fresh.headers
+    assert fallback.status_code == 200
+    assert fallback.headers["x-catalog-source"] == "last-known-good"
+    assert fallback.content == fresh.content
+    # The open breaker kept both requests away from the database
+    assert event_reads == [event_id]
+    assert never_read.status_code == 503
+
+def test_a_failing_read_falls_back_and_opens_the_breaker(storage, catalog, monkeypatch):
+    async def scenario():
+        event_id = await create_event(storage)
+        async with api_client() as client:
+            fresh = await client.get(f"/api/events/{event_id}")
+
+            async def unavailable(event_id: str, primary: bool = False):
+                raise ConnectionFailure("down")
+
+            monkeypatch.setattr(storage.events, "get", unavailable)
+            fallback = await client.get(f"/api/events/{event_id}")
+        return fresh, fallback
+
+    fresh, fallback = asyncio.run(scenario())
+
+    assert fallback.status_code == 200
+    assert fallback.headers["x-catalog-source"] == "last-known-good"
+    assert fallback.content == fresh.content
+    assert server.db_breaker.state == "open"
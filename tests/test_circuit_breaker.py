@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import time
+
+import pytest
+
+import server
+from tests.helpers import api_client, create_user
+
+RESET_SECONDS = 0.05
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = server.CircuitBreaker(failure_threshold=3, reset_seconds=RESET_SECONDS)
+    monkeypatch.setattr(server, "db_breaker", breaker)
+    return breaker
+
+def open_breaker(breaker: server.CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats()["shed"] == 1
+    assert breaker.stats()["times_opened"] == 1
+
+def test_half_open_lets_one_probe_through_per_window(breaker):
+    open_breaker(breaker)
+    time.sleep(RESET_SECONDS * 1.2)
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+def test_a_failed_probe_opens_the_breaker_again(breaker):
+    open_breaker(breaker)
+    time.sleep(RESET_SECONDS * 1.2)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.stats()["times_opened"] == 2
+
+def test_only_request_path_commands_close_the_breaker(breaker):
+    listener = server.BreakerCommandListener()
+    open_breaker(breaker)
+
+    # A background poller's command
+    listener.succeeded(None)
+    assert breaker.state == "open"
+
+    def request_command():
+        server.breaker_tracked.set(True)
+        listener.succeeded(None)
+
+    contextvars.copy_context().run(request_command)
+    assert breaker.state == "closed"
+
+def test_open_breaker_sheds_writes_with_retry_after(storage, breaker):
+    async def scenario():
+        _, headers = await create_user(storage)
+        open_breaker(breaker)
+        async with api_client() as client:
+            return await client.post("/api/orders", json={"event_id": "x", "items": []}, headers=headers)
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
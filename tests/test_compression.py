@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+
+import pytest
+
+import server
+
+def streaming_app(chunks: list, content_type: bytes = b"application/json", **headers):
+    """An ASGI app sending `chunks` as separate body messages."""
+    async def app(scope, receive, send):
+        response_headers = [(b"content-type", content_type), (b"content-length", b"0"), (b"vary", b"Origin")]
+        response_headers += [(name.replace("_", "-").encode(), value) for name, value in headers.items()]
+        await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+        for number, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": number < len(chunks) - 1})
+    return app
+
+def call(app, accept_encoding: str = "gzip", min_size: int = 100) -> list:
+    """The messages the compression middleware sends for one request."""
+    middleware = server.CompressionMiddleware(app, min_size=min_size)
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    return sent
+
+def headers_of(messages: list) -> dict:
+    start = messages[0]
+    assert start["type"] == "http.response.start"
+    return {name.decode(): value.decode() for name, value in start["headers"]}
+
+def body_of(messages: list) -> bytes:
+    return b"".join(message.get("body", b"") for message in messages[1:])
+
+def test_a_stream_crossing_the_threshold_is_compressed_incrementally():
+    chunks = [b"a" * 60, b"b" * 60, b"c" * 60, b"d" * 60]
+
+    messages = call(streaming_app(chunks))
+
+    headers = headers_of(messages)
+    assert headers["content-encoding"] == "gzip"
+    assert "content-length" not in headers
+    # Kept from the app, with Accept-Encoding added
+    assert headers["vary"] == "Origin, Accept-Encoding"
+    # The first chunk is held back until the threshold is reached
+    assert [message["more_body"] for message in messages[1:]] == [True, True, False]
+    # The final message flushes the compressor, the stream decodes as a whole
+    assert gzip.decompress(body_of(messages)) == b"".join(chunks)
+
+def test_a_stream_ending_below_the_threshold_is_sent_as_is():
+    chunks = [b"a" * 30, b"b" * 30]
+
+    messages = call(streaming_app(chunks))
+
+    assert "content-encoding" not in headers_of(messages)
+    assert body_of(messages) == b"".join(chunks)
+
+def test_a_stream_reaching_the_threshold_on_its_last_chunk_gets_a_length():
+    chunks = [b"a" * 60, b"b" * 60]
+
+    messages = call(streaming_app(chunks))
+
+    headers = headers_of(messages)
+    assert headers["content-encoding"] == "gzip"
+    assert int(headers["content-length"]) == len(body_of(messages))
+    assert gzip.decompress(body_of(messages)) == b"".join(chunks)
+
+def test_a_brotli_stream_is_finished():
+    if server.brotli is None:
+        pytest.skip("brotli is not installed")
+    chunks = [b"a" * 60, b"b" * 60, b"c" * 60]
+
+    messages = call(streaming_app(chunks), accept_encoding="br")
+
+    assert headers_of(messages)["content-encoding"] == "br"
+    assert server.brotli.decompress(body_of(messages)) == b"".join(chunks)
+
+@pytest.mark.parametrize("app", [
+    streaming_app([b"\x89PNG" + b"x" * 300], content_type=b"image/png"),
+    streaming_app([b"x" * 150, b"x" * 150], content_type=b"image/webp"),
+    streaming_app([gzip.compress(b"x" * 300)], content_encoding=b"gzip"),
+    streaming_app([b"x" * 150, b"x" * 150], content_type=b"application/octet-stream"),
+])
+def test_exempt_responses_pass_through_untouched(app):
+    assert call(app) == call(app, accept_encoding="identity")
+
+def test_without_an_accepted_encoding_the_response_is_untouched():
+    chunks = [b"a" * 300]
+
+    messages = call(streaming_app(chunks), accept_encoding="identity")
+
+    assert "content-encoding" not in headers_of(messages)
+    assert body_of(messages) == chunks[0]
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from tests.helpers import api_client, create_event, create_product, create_user
+
+async def place_order(client, headers: dict, event_id: str, product_id: str, quantity: int, use_credits: float):
+    return await client.post("/api/orders", json={"event_id": event_id, "use_credits": use_credits, "items": [
+        {"product_id": product_id, "product_name": "Cerveja", "quantity": quantity, "unit_price": 10.0}
+    ]}, headers=headers)
+
+@pytest.fixture
+def stale_balance_reads(storage, monkeypatch):
+    """Every order reads the balance before any of them debits it."""
+    read = storage.users.get_credits
+
+    async def get_credits(user_id: str) -> float:
+        balance = await read(user_id)
+        await asyncio.sleep(0.01)
+        return balance
+
+    monkeypatch.setattr(storage.users, "get_credits", get_credits)
+
+def test_concurrent_orders_cannot_spend_the_same_credits(storage, stale_balance_reads):
+    async def scenario():
+        user_id, headers = await create_user(storage, credits=50.0)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, price=10.0, stock=20)
+        async with api_client() as client:
+            responses = await asyncio.gather(*(
+                place_order(client, headers, event_id, product_id, quantity=5, use_credits=50.0) for _ in range(3)
+            ))
+        return user_id, product_id, responses
+
+    user_id, product_id, responses = asyncio.run(scenario())
+
+    assert sorted(response.status_code for response in responses) == [200, 409, 409]
+    placed = next(response.json() for response in responses if response.status_code == 200)
+    assert placed["credits_used"] == 50.0
+    assert asyncio.run(storage.users.get_credits(user_id)) == 0.0
+    # The rejected orders gave their stock back
+    assert asyncio.run(storage.products.get(product_id))["stock"] == 15
+    assert [entry["pending"] for entry in storage.outbox.documents.values()] == [["credit_ledger"]]
+
+def test_credits_used_are_capped_at_the_balance(storage):
+    async def scenario():
+        user_id, headers = await create_user(storage, credits=8.0)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, price=10.0)
+        async with api_client() as client:
+            response = await place_order(client, headers, event_id, product_id, quantity=2, use_credits=100.0)
+        return user_id, response
+
+    user_id, response = asyncio.run(scenario())
+
+    assert response.status_code == 200
+    assert response.json()["credits_used"] == 8.0
+    assert asyncio.run(storage.users.get_credits(user_id)) == 0.0
+
+def test_a_failed_insert_refunds_credits_and_stock(storage, monkeypatch):
+    async def failing_insert(order: dict):
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(storage.orders, "insert", failing_insert)
+
+    async def scenario():
+        user_id, headers = await create_user(storage, credits=20.0)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, price=10.0, stock=10)
+        async with api_client() as client:
+            with pytest.raises(RuntimeError):
+                await place_order(client, headers, event_id, product_id, quantity=2, use_credits=20.0)
+        return user_id, product_id
+
+    user_id, product_id = asyncio.run(scenario())
+
+    assert asyncio.run(storage.users.get_credits(user_id)) == 20.0
+    assert asyncio.run(storage.products.get(product_id))["stock"] == 10
+
+def test_spend_only_takes_a_covered_amount(storage):
+    async def scenario():
+        user_id, _ = await create_user(storage, credits=30.0)
+        spent = [await storage.credits.spend(user_id, amount) for amount in (20.0, 20.0, 10.0)]
+        return spent, await storage.users.get_credits(user_id)
+
+    spent, balance = asyncio.run(scenario())
+
+    assert spent == [True, False, True]
+    assert balance == 0.0
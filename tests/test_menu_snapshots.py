@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+from pymongo import _csot
+from pymongo.errors import ExecutionTimeout
+
+import server
+from tests.helpers import api_client, create_event, create_product, create_user
+
+async def get_menu(event_id: str, **headers):
+    async with api_client() as client:
+        return await client.get(f"/api/events/{event_id}/menu", headers=headers)
+
+def test_menu_is_served_with_an_etag_and_revalidated(storage):
+    async def scenario():
+        event_id = await create_event(storage)
+        await create_product(storage, event_id, name="Cerveja", price=12.0)
+        first = await get_menu(event_id, **{"Accept-Encoding": "identity"})
+        again = await get_menu(event_id, **{"If-None-Match": first.headers["etag"]})
+        return event_id, first, again
+
+    event_id, first, again = asyncio.run(scenario())
+
+    assert first.status_code == 200
+    assert first.headers["etag"] == f'"{event_id}-1"'
+    assert "content-encoding" not in first.headers
+    assert first.headers["vary"] == "Accept-Encoding"
+    menu = first.json()
+    assert menu["event"]["id"] == event_id
+    assert [(product["name"], product["price"]) for product in menu["products"]] == [("Cerveja", 12.0)]
+    assert again.status_code == 304
+    assert again.headers["etag"] == first.headers["etag"]
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip", "gzip"),
+    ("gzip, br", "br"),
+    ("br;q=0, gzip", "gzip"),
+    ("*", "br"),
+    ("deflate", None),
+])
+def test_menu_encoding_is_negotiated(storage, accept_encoding, expected):
+    if expected == "br" and server.brotli is None:
+        pytest.skip("brotli is not installed")
+
+    async def scenario():
+        event_id = await create_event(storage)
+        await create_product(storage, event_id)
+        return await get_menu(event_id, **{"Accept-Encoding": accept_encoding})
+
+    response = asyncio.run(scenario())
+
+    assert response.headers.get("content-encoding") == expected
+    # httpx decodes gzip and br, the menu must come out intact either way
+    assert response.json()["products"][0]["name"] == "Cerveja"
+
+def test_precompressed_bodies_match_the_identity_body():
+    bodies = server.precompress(json.dumps({"products": ["x"] * 1000}).encode(), gzip_level=6, brotli_quality=5)
+    assert gzip.decompress(bodies["gzip"]) == bodies[None]
+    if server.brotli is not None:
+        assert server.brotli.decompress(bodies["br"]) == bodies[None]
+
+def test_a_rebuild_gets_a_new_etag(storage):
+    async def scenario():
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, price=10.0)
+        first = await get_menu(event_id)
+        await storage.products.update(product_id, {"price": 15.0})
+        await server.menu_snapshots.build(event_id)
+        stale = await get_menu(event_id, **{"If-None-Match": first.headers["etag"]})
+        return first, stale
+
+    first, stale = asyncio.run(scenario())
+
+    assert stale.status_code == 200
+    assert stale.headers["etag"] != first.headers["etag"]
+    assert stale.json()["products"][0]["price"] == 15.0
+
+def test_a_content_change_does_not_wait_for_a_stock_only_rebuild(storage):
+    async def scenario():
+        event_id = await create_event(storage)
+        await create_product(storage, event_id)
+        store = server.MenuSnapshotStore(debounce_ms=10, max_age_seconds=30)
+        await store.build(event_id)
+        store.schedule(event_id, delay=60)
+        stock_only = store._scheduled[event_id][0]
+        store.schedule(event_id)
+        # A later stock-only change keeps the earlier rebuild
+        store.schedule(event_id, delay=60)
+        await asyncio.sleep(0.1)
+        return store.snapshots[event_id], stock_only, store._scheduled
+
+    snapshot, stock_only, scheduled = asyncio.run(scenario())
+
+    assert stock_only.cancelled()
+    assert snapshot.version == 2
+    assert scheduled == {}
+
+def test_a_stock_only_change_shows_up_after_the_debounce(storage, monkeypatch):
+    # The rebuild wakes long after the order request's deadline has passed
+    monkeypatch.setattr(server, "MENU_SNAPSHOT_STOCK_DEBOUNCE_MS", 50)
+    monkeypatch.setattr(server, "MONGO_REQUEST_TIMEOUT_MS", 20)
+    list_by_event = storage.products.list_by_event
+
+    async def deadline_bound_list(event_id: str):
+        # What a Motor read does under an expired pymongo.timeout
+        remaining = _csot.remaining()
+        if remaining is not None and remaining <= 0:
+            raise ExecutionTimeout("operation exceeded time limit")
+        return await list_by_event(event_id)
+
+    monkeypatch.setattr(storage.products, "list_by_event", deadline_bound_list)
+
+    async def scenario():
+        _, headers = await create_user(storage)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, stock=10)
+        before = await get_menu(event_id)
+        async with api_client() as client:
+            order = await client.post("/api/orders", json={"event_id": event_id, "items": [
+                {"product_id": product_id, "product_name": "Cerveja", "quantity": 3, "unit_price": 10.0}
+            ]}, headers=headers)
+        await asyncio.sleep(0.15)
+        return before, order, await get_menu(event_id)
+
+    before, order, after = asyncio.run(scenario())
+
+    assert order.status_code == 200
+    assert before.json()["products"][0]["available_stock"] == 10
+    assert after.json()["products"][0]["available_stock"] == 7
+    assert after.json()["version"] == 2
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime
+
+from bson import ObjectId
+
+import server
+
+def make_order(credits_used: float = 0.0) -> dict:
+    return {
+        "_id": ObjectId(),
+        "user_id": "user",
+        "event_id": "event",
+        "event_name": "Festival",
+        "items": [],
+        "subtotal": 10.0,
+        "platform_fee": 1.0,
+        "credits_used": credits_used,
+        "total": 11.0 - credits_used,
+        "organizer_amount": 10.0,
+        "payment_status": "paid",
+        "qr_code": f"ORDER-{uuid.uuid4()}",
+        "status": "pending",
+        "created_at": datetime.utcnow()
+    }
+
+def journal_line(order: dict) -> str:
+    return json.dumps(dict(order, _id=str(order["_id"]), created_at=order["created_at"].isoformat())) + "\n"
+
+def dead_pid() -> int:
+    pid = 4_000_000
+    while server.process_alive(pid):
+        pid -= 1
+    return pid
+
+async def drain(queue: server.OrderIngestionQueue):
+    for _ in range(200):
+        if not queue.pending:
+            return
+        await asyncio.sleep(0.01)
+
+def test_replays_the_journal_of_a_dead_worker(storage, tmp_path):
+    base = tmp_path / "orders.ndjson"
+    orders = [make_order(), make_order(credits_used=5.0), make_order()]
+    dead_journal = base.with_name(f"{base.name}.{dead_pid()}")
+    dead_journal.write_text("".join(map(journal_line, orders)))
+    # Another worker that is still running keeps its journal
+    live_journal = base.with_name(f"{base.name}.{os.getppid()}")
+    live_journal.write_text(journal_line(make_order()))
+
+    async def scenario():
+        # Stored before the crash, the replay must not insert it twice
+        await storage.orders.insert(dict(orders[0]))
+        queue = server.OrderIngestionQueue(base, batch_size=10, interval_ms=10, fsync=False)
+        await queue.start()
+        assert len(queue.pending) == 3
+        await drain(queue)
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+
+    assert set(storage.orders.hot.documents) == {order["_id"] for order in orders}
+    assert list(storage.outbox.documents) == [orders[1]["_id"]]
+    assert not dead_journal.exists()
+    assert live_journal.exists()
+    assert not queue.path.exists()
+
+def test_concurrent_submits_share_journal_writes(storage, tmp_path):
+    orders = [make_order() for _ in range(50)]
+
+    async def scenario():
+        queue = server.OrderIngestionQueue(tmp_path / "orders.ndjson", batch_size=20, interval_ms=10, fsync=False)
+        await queue.start()
+        await asyncio.gather(*(queue.submit(order) for order in orders))
+        await queue.stop()
+        return queue
+
+    queue = asyncio.run(scenario())
+
+    assert queue.journal_writes < len(orders)
+    assert len(storage.orders.hot.documents) == len(orders)
+    assert not queue.path.exists()
+
+def test_a_journaled_order_survives_a_crash(storage, tmp_path):
+    order = make_order()
+    base = tmp_path / "orders.ndjson"
+
+    async def crash():
+        queue = server.OrderIngestionQueue(base, batch_size=10, interval_ms=60_000, fsync=True)
+        await queue.start()
+        await queue.submit(order)
+        # Killed before the batch is flushed: no stop(), the journal stays
+        queue._task.cancel()
+        queue._journal.close()
+        return queue.path
+
+    journal = asyncio.run(crash())
+    assert storage.orders.hot.documents == {}
+    # The next worker takes over the journal as if its PID were gone
+    journal.rename(base.with_name(f"{base.name}.{dead_pid()}"))
+
+    async def restart():
+        queue = server.OrderIngestionQueue(base, batch_size=10, interval_ms=10, fsync=False)
+        await queue.start()
+        await drain(queue)
+        await queue.stop()
+
+    asyncio.run(restart())
+    assert list(storage.orders.hot.documents) == [order["_id"]]
@@ -0,0 +1,124 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+import server
+from tests.helpers import api_client, create_user
+
+def make_order(user_id: str) -> dict:
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "event_id": "event",
+        "event_name": "Festival",
+        "items": [],
+        "subtotal": 10.0,
+        "platform_fee": 1.0,
+        "credits_used": 0.0,
+        "total": 11.0,
+        "organizer_amount": 10.0,
+        "payment_status": "paid",
+        "qr_code": f"ORDER-{uuid.uuid4()}",
+        "status": "pending",
+        "created_at": datetime.utcnow()
+    }
+
+@pytest.fixture
+def queued(monkeypatch) -> dict:
+    """Orders accepted but not yet written by the ingestion batcher."""
+    pending = {}
+    monkeypatch.setattr(server.order_ingestion, "pending", pending)
+    return pending
+
+async def lookup(headers: dict, order_ids: list = (), qr_codes: list = ()):
+    async with api_client() as client:
+        return await client.post("/api/orders/lookup", json={"order_ids": list(order_ids), "qr_codes": list(qr_codes)},
+                                 headers=headers)
+
+def test_each_key_gets_its_own_outcome_in_request_order(storage, queued):
+    async def scenario():
+        user_id, headers = await create_user(storage)
+        other_id, _ = await create_user(storage)
+        persisted, archived, waiting = (make_order(user_id) for _ in range(3))
+        foreign = make_order(other_id)
+        await storage.orders.insert(dict(persisted))
+        await storage.orders.insert(dict(foreign))
+        storage.orders.archive.insert(dict(archived))
+        queued[str(waiting["_id"])] = waiting
+        response = await lookup(
+            headers,
+            order_ids=[str(archived["_id"]), "not-an-id", str(foreign["_id"]), str(ObjectId()), str(persisted["_id"])],
+            qr_codes=[waiting["qr_code"], "ORDER-unknown", persisted["qr_code"]]
+        )
+        return persisted, archived, waiting, foreign, response
+
+    persisted, archived, waiting, foreign, response = asyncio.run(scenario())
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(next(iter(result)), result["status"]) for result in results] == [
+        ("id", 200), ("id", 400), ("id", 403), ("id", 404), ("id", 200), ("qr_code", 200), ("qr_code", 404), ("qr_code", 200)
+    ]
+    assert results[0]["order"]["id"] == str(archived["_id"])
+    assert results[0]["order"]["ingestion_status"] == "archived"
+    assert results[1] == {"id": "not-an-id", "status": 400, "error": "Id de pedido inválido"}
+    assert "order" not in results[2]
+    assert results[4]["order"]["ingestion_status"] == "persisted"
+    assert results[5]["order"]["id"] == str(waiting["_id"])
+    assert results[5]["order"]["ingestion_status"] == "queued"
+    assert results[7]["order"]["id"] == str(persisted["_id"])
+
+def test_an_admin_sees_every_order(storage, queued):
+    async def scenario():
+        other_id, _ = await create_user(storage)
+        _, admin_headers = await create_user(storage, role="admin")
+        order = make_order(other_id)
+        await storage.orders.insert(dict(order))
+        return order, await lookup(admin_headers, order_ids=[str(order["_id"])])
+
+    order, response = asyncio.run(scenario())
+
+    assert [(result["status"], result["order"]["id"]) for result in response.json()["results"]] == [(200, str(order["_id"]))]
+
+def test_a_persisted_order_wins_over_its_queued_copy(storage, queued):
+    async def scenario():
+        user_id, headers = await create_user(storage)
+        order = make_order(user_id)
+        await storage.orders.insert(dict(order))
+        # Written by the batcher, not yet dropped from the queue
+        queued[str(order["_id"])] = dict(order)
+        return await lookup(headers, order_ids=[str(order["_id"])], qr_codes=[order["qr_code"]])
+
+    results = asyncio.run(scenario()).json()["results"]
+
+    assert [result["order"]["ingestion_status"] for result in results] == ["persisted", "persisted"]
+
+def test_too_many_keys_are_refused(storage, queued):
+    async def scenario():
+        _, headers = await create_user(storage)
+        return await lookup(headers, qr_codes=[f"ORDER-{number}" for number in range(server.ORDER_LOOKUP_MAX_KEYS + 1)])
+
+    assert asyncio.run(scenario()).status_code == 400
+
+def test_admin_orders_accept_dates_with_an_offset(storage):
+    async def scenario():
+        user_id, _ = await create_user(storage)
+        _, admin_headers = await create_user(storage, role="admin")
+        order = make_order(user_id)
+        order["created_at"] = datetime(2025, 12, 20, 23, 30)
+        await storage.orders.insert(order)
+        async with api_client() as client:
+            return [
+                await client.get("/api/admin/orders", params=params, headers=admin_headers) for params in (
+                    {"created_from": "2025-12-20T20:00:00-03:00", "created_to": "2025-12-21T00:00:00Z"},
+                    {"created_from": "2025-12-20T21:00:00-03:00"},
+                )
+            ]
+
+    responses = asyncio.run(scenario())
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert [len(response.json()) for response in responses] == [1, 0]
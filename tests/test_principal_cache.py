@@ -0,0 +1,44 @@
+import asyncio
+
+import server
+from tests.helpers import api_client, create_user
+
+async def get_outbox_stats(headers: dict) -> int:
+    async with api_client() as client:
+        return (await client.get("/api/admin/outbox", headers=headers)).status_code
+
+def test_a_demoted_admin_loses_access_at_once(storage):
+    async def scenario():
+        user_id, headers = await create_user(storage, role="admin")
+        statuses = [await get_outbox_stats(headers)]
+        await storage.users.set_role(user_id, "user")
+        statuses.append(await get_outbox_stats(headers))
+        return statuses
+
+    assert asyncio.run(scenario()) == [200, 403]
+
+def test_a_deleted_admin_loses_access_at_once(storage):
+    async def scenario():
+        user_id, headers = await create_user(storage, role="admin")
+        statuses = [await get_outbox_stats(headers)]
+        storage.users.documents.clear()
+        statuses.append(await get_outbox_stats(headers))
+        return user_id, statuses
+
+    user_id, statuses = asyncio.run(scenario())
+
+    assert statuses == [200, 401]
+    assert user_id not in server.principal_cache.entries
+
+def test_a_promotion_is_seen_after_invalidation(storage):
+    async def scenario():
+        user_id, headers = await create_user(storage)
+        statuses = [await get_outbox_stats(headers)]
+        await storage.users.set_role(user_id, "admin")
+        # Cached as a user until the TTL runs out or the entry is dropped
+        statuses.append(await get_outbox_stats(headers))
+        server.principal_cache.invalidate(user_id)
+        statuses.append(await get_outbox_stats(headers))
+        return statuses
+
+    assert asyncio.run(scenario()) == [403, 403, 200]
@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+import server
+from tests.helpers import api_client, create_event, create_product, create_user
+
+def quote_claims(user_id: str, event_id: str, product_id: str, **overrides) -> dict:
+    return dict({
+        "aud": server.QUOTE_AUDIENCE,
+        "user_id": user_id,
+        "event_id": event_id,
+        "event_name": "Festival",
+        "items": [{"product_id": product_id, "product_name": "Cerveja", "quantity": 1, "unit_price": 0.01}],
+        "credits_used": 0.0,
+        "exp": datetime.utcnow() + timedelta(minutes=5),
+    }, **overrides)
+
+async def setup(storage, price: float = 10.0, stock: int = 10):
+    user_id, headers = await create_user(storage, credits=5.0)
+    event_id = await create_event(storage)
+    product_id = await create_product(storage, event_id, price=price, stock=stock)
+    return user_id, headers, event_id, product_id
+
+def test_an_order_from_a_quote_uses_the_quoted_prices(storage):
+    async def scenario():
+        _, headers, event_id, product_id = await setup(storage, price=10.0)
+        async with api_client() as client:
+            quote = (await client.post("/api/orders/quote", json={
+                "event_id": event_id, "items": [{"product_id": product_id, "quantity": 3}], "use_credits": 5.0
+            }, headers=headers)).json()
+            order = await client.post("/api/orders", json={"event_id": event_id, "quote_token": quote["quote_token"]}, headers=headers)
+        return quote, order
+
+    quote, order = asyncio.run(scenario())
+
+    assert quote["subtotal"] == 30.0
+    assert quote["credits_used"] == 5.0
+    assert quote["problems"] == []
+    assert order.status_code == 200
+    assert order.json()["subtotal"] == 30.0
+    assert order.json()["credits_used"] == 5.0
+
+def test_a_cart_that_cannot_be_bought_gets_no_token(storage):
+    async def scenario():
+        _, headers, event_id, product_id = await setup(storage, stock=2)
+        async with api_client() as client:
+            return (await client.post("/api/orders/quote", json={
+                "event_id": event_id, "items": [{"product_id": product_id, "quantity": 3}]
+            }, headers=headers)).json()
+
+    quote = asyncio.run(scenario())
+
+    assert quote["problems"]
+    assert quote["quote_token"] is None
+
+@pytest.mark.parametrize("forge", [
+    pytest.param(lambda claims: jwt.encode(claims, "another-key", algorithm=server.ALGORITHM), id="wrong key"),
+    pytest.param(lambda claims: jwt.encode(dict(claims, aud="other"), server.SECRET_KEY, algorithm=server.ALGORITHM), id="wrong audience"),
+    pytest.param(lambda claims: jwt.encode(dict(claims, user_id="someone-else"), server.SECRET_KEY, algorithm=server.ALGORITHM), id="other user"),
+    pytest.param(lambda claims: jwt.encode(dict(claims, event_id="other-event"), server.SECRET_KEY, algorithm=server.ALGORITHM), id="other event"),
+    pytest.param(lambda claims: jwt.encode(dict(claims, exp=datetime.utcnow() - timedelta(seconds=1)), server.SECRET_KEY, algorithm=server.ALGORITHM), id="expired"),
+    pytest.param(lambda claims: server.create_access_token({"sub": claims["user_id"]}), id="access token"),
+])
+def test_invalid_quote_tokens_are_rejected(storage, forge):
+    async def scenario():
+        user_id, headers, event_id, product_id = await setup(storage)
+        token = forge(quote_claims(user_id, event_id, product_id))
+        async with api_client() as client:
+            return await client.post("/api/orders", json={"event_id": event_id, "quote_token": token}, headers=headers)
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 400
+    assert storage.orders.hot.documents == {}
+
+def test_a_quote_token_is_not_an_access_token(storage):
+    async def scenario():
+        user_id, _, event_id, product_id = await setup(storage)
+        token = jwt.encode(dict(quote_claims(user_id, event_id, product_id), sub=user_id), server.SECRET_KEY, algorithm=server.ALGORITHM)
+        async with api_client() as client:
+            return await client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+
+    assert asyncio.run(scenario()).status_code == 401
+
+def test_an_order_without_a_quote_ignores_client_prices(storage):
+    async def scenario():
+        _, headers, event_id, product_id = await setup(storage, price=10.0)
+        async with api_client() as client:
+            return await client.post("/api/orders", json={"event_id": event_id, "items": [
+                {"product_id": product_id, "product_name": "Grátis", "quantity": 2, "unit_price": 0.01}
+            ]}, headers=headers)
+
+    response = asyncio.run(scenario())
+
+    assert response.status_code == 200
+    assert response.json()["subtotal"] == 20.0
+    assert response.json()["items"][0]["product_name"] == "Cerveja"
+
+def test_an_order_without_a_quote_rejects_products_of_other_events(storage):
+    async def scenario():
+        _, headers, event_id, _ = await setup(storage)
+        other_product_id = await create_product(storage, await create_event(storage, name="Outro"))
+        async with api_client() as client:
+            return await client.post("/api/orders", json={"event_id": event_id, "items": [
+                {"product_id": other_product_id, "product_name": "Cerveja", "quantity": 1, "unit_price": 10.0}
+            ]}, headers=headers)
+
+    assert asyncio.run(scenario()).status_code == 400
@@ -0,0 +1,100 @@
+import asyncio
+import json
+from argparse import Namespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import reconcile_credits
+
+def rows(*totals) -> list:
+    return [{"_id": user_id, "total": total} for user_id, total in totals]
+
+def test_streams_are_joined_by_user():
+    joined, unknown = reconcile_credits.merge_join(
+        ["a", "b", "c"],
+        rows(("a", 50.0), ("b", 20.0), ("c", 5.0)),
+        rows(("a", 30.0), ("c", 5.0)),
+        rows(("b", 10.0)),
+    )
+
+    assert joined == [("a", [50.0, 30.0, 0.0]), ("b", [20.0, 0.0, 10.0]), ("c", [5.0, 5.0, 0.0])]
+    assert unknown == []
+
+def test_rows_without_a_user_are_reported_on_either_side():
+    joined, unknown = reconcile_credits.merge_join(
+        ["b", "d"],
+        # Before the first user, between two users and after the last one
+        rows(("a", 1.0), ("b", 10.0), ("c", 2.0), ("d", 20.0), ("e", 3.0)),
+        rows(("c", 4.0), ("d", 5.0)),
+    )
+
+    assert joined == [("b", [10.0, 0.0]), ("d", [20.0, 5.0])]
+    assert sorted(unknown) == ["a", "c", "c", "e"]
+
+def test_users_without_any_rows_expect_nothing():
+    joined, unknown = reconcile_credits.merge_join(["a", "b"], [], [])
+
+    assert joined == [("a", [0.0, 0.0]), ("b", [0.0, 0.0])]
+    assert unknown == []
+
+@pytest.mark.parametrize("ledger, used, in_flight, expected", [
+    (50.0, 30.0, 0.0, 20.0),
+    # Debit still waiting in the outbox, the balance has not gone down yet
+    (50.0, 30.0, 10.0, 30.0),
+    (0.0, 0.0, 0.0, 0.0),
+])
+def test_expected_balance(ledger, used, in_flight, expected):
+    assert reconcile_credits.expected_balance(ledger, used, in_flight) == expected
+
+def test_queued_credit_users_reads_every_journal(tmp_path):
+    journal = tmp_path / "orders.ndjson"
+    journal.write_text(json.dumps({"user_id": "a", "credits_used": 5.0}) + "\n")
+    journal.with_name("orders.ndjson.123").write_text(
+        json.dumps({"user_id": "b", "credits_used": 0.0}) + "\n"
+        + json.dumps({"user_id": "c", "credits_used": 2.0}) + "\n"
+        + '{"user_id": "d", "cred'
+    )
+
+    assert reconcile_credits.queued_credit_users(journal) == {"a", "c"}
+    assert reconcile_credits.queued_credit_users(tmp_path / "missing.ndjson") == set()
+
+def test_fix_skips_users_with_queued_orders(tmp_path, monkeypatch):
+    journal = tmp_path / "orders.ndjson"
+    # Both users spent 10 credits, only the order of "queued" has not reached Mongo yet
+    journal.write_text(json.dumps({"user_id": "queued", "credits_used": 10.0}) + "\n")
+    ledger = {"drifted": 50.0, "queued": 50.0, "even": 50.0}
+    used = {"drifted": 0.0, "queued": 0.0, "even": 10.0}
+
+    async def sums(db, match: dict) -> tuple:
+        user_ids = sorted(user_id for user_id in ledger if user_id == match.get("user_id", user_id))
+        return (
+            rows(*((user_id, ledger[user_id]) for user_id in user_ids)),
+            rows(*((user_id, used[user_id]) for user_id in user_ids if used[user_id])),
+            [],
+        )
+
+    monkeypatch.setattr(reconcile_credits, "sums", sums)
+
+    async def scenario():
+        db = AsyncMongoMockClient()["reconcile"]
+        # "drifted" really lost 10 credits
+        await db.users.insert_many([
+            {"_id": "drifted", "credits": 40.0}, {"_id": "even", "credits": 40.0}, {"_id": "queued", "credits": 40.0}
+        ])
+        users = await db.users.find({}, {"credits": 1}).sort("_id", 1).to_list(None)
+        run = {"_id": "run", "last_user_id": None}
+        args = Namespace(fix=True, tolerance=0.005, journal=journal)
+        counts = await reconcile_credits.reconcile_chunk(db, run, users, True, args)
+        balances = {user["_id"]: user["credits"] for user in await db.users.find().to_list(None)}
+        drifts = {drift["_id"]["user_id"]: drift for drift in await db.credit_drift.find().to_list(None)}
+        return counts, balances, drifts
+
+    counts, balances, drifts = asyncio.run(scenario())
+
+    assert balances == {"drifted": 50.0, "even": 40.0, "queued": 40.0}
+    assert (counts["drifted"], counts["fixed"]) == (2, 1)
+    assert set(drifts) == {"drifted", "queued"}
+    assert drifts["drifted"]["fixed"] is True
+    assert (drifts["queued"]["fixed"], drifts["queued"]["queued_orders"]) == (False, True)
+    assert drifts["queued"]["drift"] == -10.0
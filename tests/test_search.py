@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+import server
+from tests.helpers import api_client, create_event, create_product
+
+def event(event_id: str, name: str, **fields) -> dict:
+    return dict({"_id": event_id, "name": name, "status": "active"}, **fields)
+
+def product(product_id: str, event_id: str, name: str, **fields) -> dict:
+    return dict({"_id": product_id, "event_id": event_id, "name": name, "price": 10.0}, **fields)
+
+def names(hits) -> list:
+    return [document["name"] for _, document in hits]
+
+@pytest.fixture
+def state() -> server.SearchState:
+    return server.SearchState(
+        [event("festival", "Festival de Verão", location="Praça"), event("show", "Show", location="Estádio")],
+        [
+            product("cerveja", "festival", "Cerveja"),
+            product("cervejinha", "festival", "Cervejinha"),
+            product("cervejaria", "festival", "Cervejaria"),
+            product("cafe", "festival", "Café", description="Coado na hora"),
+            product("agua", "show", "Água"),
+            product("refri", "show", "Refrigerante", description="Sem água gaseificada"),
+        ]
+    )
+
+@pytest.fixture
+def search_index(monkeypatch) -> server.SearchIndex:
+    index = server.SearchIndex(server.SEARCH_INDEX_DEBOUNCE_MS, server.SEARCH_INDEX_MAX_AGE_SECONDS)
+    monkeypatch.setattr(server, "search_index", index)
+    return index
+
+def test_a_word_matches_by_prefix(state):
+    assert set(state.expand("cerv")) == {"cerveja", "cervejaria", "cervejinha"}
+    assert set(names(state.rank("cerv", None, None, None))) == {"Cerveja", "Cervejaria", "Cervejinha"}
+
+def test_a_single_letter_only_matches_whole_words(state):
+    assert state.expand("c") == {}
+
+def test_a_typo_falls_back_to_trigram_similarity(state):
+    closeness = state.expand("cervja")
+    assert "cerveja" in closeness
+    assert 0 < closeness["cerveja"] < 0.5
+    assert "Cerveja" in names(state.rank("cervja", None, None, None))
+    assert state.expand("xyzw") == {}
+
+@pytest.mark.parametrize("query", ["cafe", "CAFÉ", "Cafe"])
+def test_accents_and_case_are_ignored(state, query):
+    assert names(state.rank(query, None, None, None)) == ["Café"]
+
+def test_accented_documents_match_plain_queries(state):
+    _, hits = state.search("verao")
+    assert names(hits) == ["Festival de Verão"]
+
+def test_name_matches_rank_above_description_matches(state):
+    _, hits = state.search("agua")
+    assert names(hits) == ["Água", "Refrigerante"]
+    assert hits[0][0] > hits[1][0]
+
+def test_whole_words_rank_above_prefixes(state):
+    _, hits = state.search("cerveja")
+    assert names(hits) == ["Cerveja", "Cervejaria"]
+    assert hits[0][0] > hits[1][0]
+
+def test_every_query_word_must_match(state):
+    assert names(state.rank("cerveja festival", None, None, None)) == []
+    assert names(state.rank("festival verao", None, None, None)) == ["Festival de Verão"]
+
+def test_filters_apply_to_products_through_their_event(state):
+    assert names(state.search("cerveja", event_id="festival")[1]) == ["Cerveja", "Cervejaria"]
+    assert state.search("cerveja", event_id="show") == (0, [])
+    assert state.search("cerveja", status="finished") == (0, [])
+    assert names(state.search("agua", kind="event")[1]) == []
+
+def test_search_pages_with_offset_and_limit(storage, search_index):
+    async def scenario():
+        event_id = await create_event(storage)
+        for number in range(5):
+            await create_product(storage, event_id, name=f"Cerveja {number}")
+        async with api_client() as client:
+            pages = [(await client.get("/api/search", params={"q": "cerveja", "limit": 2, "offset": offset})).json()
+                     for offset in (0, 2, 4)]
+        return pages
+
+    pages = asyncio.run(scenario())
+
+    assert [page["total"] for page in pages] == [5, 5, 5]
+    # Equal scores are ordered by name, so the pages neither overlap nor skip
+    assert [[result["name"] for result in page["results"]] for page in pages] == [
+        ["Cerveja 0", "Cerveja 1"], ["Cerveja 2", "Cerveja 3"], ["Cerveja 4"]
+    ]
+
+def test_an_invalid_type_is_refused(storage, search_index):
+    async def scenario():
+        async with api_client() as client:
+            return await client.get("/api/search", params={"q": "cerveja", "type": "order"})
+
+    assert asyncio.run(scenario()).status_code == 400
+
+def test_autocomplete_suggests_a_name_once(storage, search_index):
+    async def scenario():
+        for name in ("Festival", "Show", "Feira"):
+            event_id = await create_event(storage, name=name)
+            await create_product(storage, event_id, name="Cerveja")
+        await create_product(storage, event_id, name="CERVEJA")
+        await create_product(storage, event_id, name="Cervejinha")
+        async with api_client() as client:
+            return (await client.get("/api/search/autocomplete", params={"q": "cerv"})).json()
+
+    suggestions = asyncio.run(scenario())["suggestions"]
+
+    # Four products are named cerveja, whatever the case
+    assert len(suggestions) == 2
+    assert sorted(suggestion["text"].casefold() for suggestion in suggestions) == ["cerveja", "cervejinha"]
+    assert {suggestion["type"] for suggestion in suggestions} == {"product"}
@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+from tests.helpers import api_client, create_event, create_product, create_user
+
+async def hold(client, headers: dict, product_id: str, quantity: int):
+    return await client.post("/api/cart/holds", json={"product_id": product_id, "quantity": quantity}, headers=headers)
+
+def test_holds_reserve_stock_and_checkout_consumes_them(storage):
+    async def scenario():
+        _, headers = await create_user(storage)
+        _, other_headers = await create_user(storage)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, stock=5)
+        async with api_client() as client:
+            held = await hold(client, headers, product_id, 4)
+            # Only one unit is left for everyone else
+            other = await hold(client, other_headers, product_id, 2)
+            holds = (await client.get("/api/cart/holds", headers=headers)).json()
+            order = await client.post("/api/orders", json={"event_id": event_id, "items": [
+                {"product_id": product_id, "product_name": "Cerveja", "quantity": 4, "unit_price": 10.0}
+            ]}, headers=headers)
+        return product_id, held, other, holds, order
+
+    product_id, held, other, holds, order = asyncio.run(scenario())
+
+    assert held.status_code == 200
+    assert other.status_code == 409
+    assert [(entry["product_id"], entry["quantity"]) for entry in holds] == [(product_id, 4)]
+    assert order.status_code == 200
+    product = asyncio.run(storage.products.get(product_id))
+    assert (product["stock"], product["reserved"]) == (1, 0)
+    assert storage.holds.documents == {}
+
+def test_concurrent_holds_keep_one_hold_per_product(storage, monkeypatch):
+    read = storage.holds.get
+
+    async def get(user_id: str, product_id: str):
+        # Every request looks for the hold before any of them creates it
+        found = await read(user_id, product_id)
+        await asyncio.sleep(0.01)
+        return found
+
+    monkeypatch.setattr(storage.holds, "get", get)
+
+    async def scenario():
+        _, headers = await create_user(storage)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, stock=10)
+        async with api_client() as client:
+            responses = await asyncio.gather(*(hold(client, headers, product_id, 3) for _ in range(4)))
+        return product_id, responses
+
+    product_id, responses = asyncio.run(scenario())
+
+    assert sorted(response.status_code for response in responses) == [200, 409, 409, 409]
+    assert len(storage.holds.documents) == 1
+    assert asyncio.run(storage.products.get(product_id))["reserved"] == 3
+
+def test_a_second_hold_for_the_same_product_is_refused_by_the_repository(storage):
+    document = {"user_id": "user", "product_id": "product", "event_id": "event", "quantity": 1,
+                "expires_at": datetime.utcnow() + timedelta(minutes=5), "created_at": datetime.utcnow()}
+
+    async def scenario():
+        return await storage.holds.create(dict(document)), await storage.holds.create(dict(document))
+
+    first, second = asyncio.run(scenario())
+
+    assert first is not None
+    assert second is None
+
+def test_expired_holds_are_released_once(storage):
+    async def scenario():
+        _, headers = await create_user(storage)
+        event_id = await create_event(storage)
+        product_id = await create_product(storage, event_id, stock=5)
+        async with api_client() as client:
+            await hold(client, headers, product_id, 2)
+        for document in storage.holds.documents.values():
+            document["expires_at"] = datetime.utcnow() - timedelta(seconds=1)
+        released = [await server.release_expired_holds(), await server.release_expired_holds()]
+        return product_id, released
+
+    product_id, released = asyncio.run(scenario())
+
+    assert released == [1, 0]
+    assert asyncio.run(storage.products.get(product_id))["reserved"] == 0